@@ -0,0 +1,86 @@
+import logging
+import os
+import time
+from typing import Optional, Set
+
+
+class AllowList:
+    """
+    The chat IDs allowed to use the bot, parsed once into a set so that a check is a single lookup.
+
+    The list is a comma-separated string of IDs, or "*" for everyone. If `path` is set it is read
+    from that file (IDs may also be one per line, and "#" starts a comment), which is read again
+    whenever it changes, checked at most every `check_interval` seconds. `reload` reads the file
+    or the environment variable again, e.g. on SIGHUP after the .env file was edited.
+    """
+
+    def __init__(self, ids: str = '*', path: Optional[str] = None, variable: Optional[str] = None,
+                 check_interval: float = 5.0):
+        """
+        :param ids: The allowed IDs, used until the file or the variable is read
+        :param path: The file the allowed IDs are read from
+        :param variable: The environment variable `reload` reads the allowed IDs from if there is no file
+        :param check_interval: Seconds between two checks of whether the file changed
+        """
+        self.path = path
+        self.variable = variable
+        self.check_interval = check_interval
+        self.everyone = False
+        self.ids: Set[int] = set()
+        self._mtime: Optional[float] = None
+        self._checked = float('-inf')
+        self._parse(ids)
+        if path is not None:
+            self._check()
+
+    @classmethod
+    def from_config(cls, config: dict) -> 'AllowList':
+        return cls(config.get('allowed_user_ids', '*'), config.get('allowed_user_ids_file'),
+                   config.get('allowed_user_ids_variable'))
+
+    def __contains__(self, chat_id: int) -> bool:
+        if self.path is not None:
+            self._check()
+        return self.everyone or chat_id in self.ids
+
+    def reload(self):
+        """
+        Reads the allowed IDs again from the file, or else from the environment variable.
+        """
+        if self.path is not None:
+            try:
+                with open(self.path, encoding='utf-8') as file:
+                    text = ','.join(line.split('#', 1)[0] for line in file)
+            except OSError as e:
+                logging.warning(f'Keeping the allowed users, {self.path} cannot be read: {e}')
+                return
+        elif self.variable is not None and self.variable in os.environ:
+            text = os.environ[self.variable]
+        else:
+            return
+        self._parse(text)
+
+    def _check(self):
+        now = time.monotonic()
+        if now - self._checked < self.check_interval:
+            return
+        self._checked = now
+        try:
+            mtime = os.stat(self.path).st_mtime
+        except OSError:
+            return
+        if mtime != self._mtime:
+            self._mtime = mtime
+            self.reload()
+
+    def _parse(self, text: str):
+        entries = {entry.strip() for entry in text.split(',')} - {''}
+        ids = set()
+        for entry in entries - {'*'}:
+            try:
+                ids.add(int(entry))
+            except ValueError:
+                logging.warning(f'Ignoring the allowed user ID {entry!r}, it is not a number')
+        self.everyone = '*' in entries
+        self.ids = ids
+        logging.info('Allowed users: everyone' if self.everyone else f'Allowed users: {len(ids)} IDs')
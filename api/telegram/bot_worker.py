@@ -0,0 +1,136 @@
+import asyncio
+import logging
+import multiprocessing
+import time
+from typing import Optional, Set
+
+from telethon import TelegramClient
+
+from core.cache import TTLCache
+from core.dispatcher import Update
+from core.openai_helper import AsyncOpenAIHelper
+from core.sqlite_session_store import SqliteSessionStore
+
+from api.telegram.client import start_client, telethon_proxy
+from api.telegram.telegram_bot import TelegramBotApp
+
+
+class ForwardedMessage:
+    """
+    The message of a text update, as the handlers read it.
+    """
+    __slots__ = ('id', 'text', 'voice', 'audio', 'file')
+
+    def __init__(self, update: Update):
+        self.id = update.message_id
+        self.text = update.text
+        self.voice = None
+        self.audio = None
+        self.file = None
+
+
+class ForwardedEvent:
+    """
+    The parts of a NewMessage event the handlers use, rebuilt in a worker from the update it was handed.
+    """
+
+    def __init__(self, client: TelegramClient, update: Update, chat, message=None):
+        """
+        :param chat: The entity of the chat
+        :param message: The message as fetched from Telegram, if its media are needed
+        """
+        self.client = client
+        self.chat = chat
+        self.chat_id = update.chat_id
+        self.message = message if message is not None else ForwardedMessage(update)
+
+    async def reply(self, *args, **kwargs):
+        return await self.client.send_message(self.chat_id, *args, reply_to=self.message.id, **kwargs)
+
+
+class BotWorker:
+    """
+    Handles the updates of the chats of one shard with a TelegramBotApp of its own, which answers
+    through its own client, so that its sessions and modes stay in this process.
+    """
+
+    def __init__(self, index: int, bot: TelegramBotApp, max_chats: int = 10000):
+        """
+        :param index: The shard of the worker
+        :param bot: The bot the updates are handled by, whose handlers are not registered on its client
+        :param max_chats: The number of chat entities kept resolved
+        """
+        self.index = index
+        self.bot = bot
+        self._chats = TTLCache(max_size=max_chats)
+        self._tasks: Set[asyncio.Task] = set()
+
+    async def serve(self, inbox: 'multiprocessing.Queue', done: Optional['multiprocessing.Queue'] = None):
+        """
+        Handles the updates of `inbox` until it yields None, then waits for the updates being handled.
+        """
+        loop = asyncio.get_running_loop()
+        while True:
+            update = await loop.run_in_executor(None, inbox.get)
+            if update is None:
+                break
+            task = asyncio.ensure_future(self.handle(update, done))
+            self._tasks.add(task)
+            task.add_done_callback(self._tasks.discard)
+        if self._tasks:
+            await asyncio.gather(*self._tasks, return_exceptions=True)
+
+    async def handle(self, update: Update, done: Optional['multiprocessing.Queue'] = None):
+        try:
+            event = await self.event(update)
+            await getattr(self.bot, update.handler)(event)
+        except Exception as e:
+            logging.exception(e)
+        finally:
+            if done is not None:
+                done.put((self.index, update.message_id, time.perf_counter()))
+
+    async def event(self, update: Update) -> ForwardedEvent:
+        chat = await self._chats.aget_or_compute(update.chat_id, lambda: self.bot.client.get_entity(update.chat_id))
+        message = None
+        if update.media:
+            message = await self.bot.client.get_messages(chat, ids=update.message_id)
+        return ForwardedEvent(self.bot.client, update, chat, message)
+
+
+def run_worker(index: int, inbox: 'multiprocessing.Queue', done: 'multiprocessing.Queue', bot_config: dict,
+               openai_config: dict):
+    """
+    The entry point of a worker process of a ShardedDispatcher.
+    """
+    logging.basicConfig(
+        format=f'%(asctime)s - worker {index} - %(name)s - %(levelname)s - %(message)s',
+        level=logging.INFO
+    )
+    asyncio.run(_serve(index, inbox, done, bot_config, openai_config))
+
+
+async def _serve(index: int, inbox: 'multiprocessing.Queue', done: 'multiprocessing.Queue', bot_config: dict,
+                 openai_config: dict):
+    openai_config = dict(openai_config)
+    cache = openai_config.get('response_cache')
+    if cache and cache.get('path'):
+        # Every worker saves its own cache on exit
+        openai_config['response_cache'] = dict(cache, path=f"{cache['path']}.{index}")
+    helper = AsyncOpenAIHelper(openai_config, SqliteSessionStore.from_config(openai_config))
+    # Updates only reach the dispatcher, the workers just answer
+    client = TelegramClient(f'.chatgpt-telegram-bot-worker{index}', bot_config["telegram_app_id"],
+                            bot_config["telegram_app_hash"], proxy=telethon_proxy(bot_config.get('telegram_proxy')),
+                            receive_updates=False)
+    # The dispatcher checks the allow-list, reloading it on SIGHUP, before handing an update over
+    bot = TelegramBotApp(dict(bot_config, allowed_user_ids='*', allowed_user_ids_file=None), helper, client=client)
+    try:
+        if await start_client(client, f'worker {index}', bot_config.get('connect_timeout'),
+                              bot_token=bot_config['token']):
+            await BotWorker(index, bot).serve(inbox, done)
+        else:
+            logging.error(f'Worker {index} exits, the dispatcher refuses the updates of its chats')
+    finally:
+        bot.transcription.close()
+        await client.disconnect()
+        await helper.close()
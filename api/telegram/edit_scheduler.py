@@ -0,0 +1,239 @@
+# -*- coding: utf-8 -*-
+# @Time    : 4/16/2023
+# @Author  : nzooherd
+# @File    : edit_scheduler.py
+# @Software: PyCharm
+import asyncio
+import logging
+import time
+from collections import OrderedDict
+from typing import Optional
+
+from telethon import TelegramClient
+from telethon.errors import FloodWaitError, MessageNotModifiedError, MessageTooLongError
+
+from core import metrics
+
+TELEGRAM_SECONDS = metrics.histogram(
+    'chatgpt_telegram_request_seconds', 'Time Telegram took to send or edit a message', ['method'])
+FLOOD_WAITS = metrics.counter('chatgpt_telegram_flood_waits_total', 'FloodWait errors received from Telegram')
+_SEND_SECONDS = TELEGRAM_SECONDS.labels('send')
+_EDIT_SECONDS = TELEGRAM_SECONDS.labels('edit')
+# The longest text of a Telegram message
+MAX_MESSAGE_LENGTH = 4096
+
+
+class EditBudget:
+    """
+    Per-chat token bucket for message sends and edits, shared by every answer streamed to a chat.
+    A chat whose bucket refilled to `burst` is forgotten, it would get a full bucket anyway.
+    """
+
+    def __init__(self, rate: float = 1.0, burst: int = 3):
+        """
+        :param rate: The number of edits per second a chat regains
+        :param burst: The number of edits a chat may make back to back
+        """
+        self.rate = rate
+        self.burst = burst
+        # {chat_id: [tokens, last refill, blocked until]}, least recently refilled first
+        self._buckets: OrderedDict[int, list] = OrderedDict()
+
+    def try_acquire(self, chat_id: int) -> bool:
+        """
+        Takes an edit from the chat's budget if one is available.
+        """
+        bucket = self._refill(chat_id)
+        if bucket[0] < 1 or bucket[2] > time.monotonic():
+            return False
+        bucket[0] -= 1
+        return True
+
+    async def acquire(self, chat_id: int):
+        """
+        Waits until the chat's budget allows an edit and takes it.
+        """
+        while not self.try_acquire(chat_id):
+            await asyncio.sleep(self.delay(chat_id))
+
+    def delay(self, chat_id: int) -> float:
+        """
+        Returns how long the chat has to wait for its next edit.
+        """
+        tokens, _, blocked_until = self._refill(chat_id)
+        now = time.monotonic()
+        return max(blocked_until - now, (1 - tokens) / self.rate, 0.01)
+
+    def block(self, chat_id: int, seconds: float):
+        """
+        Stops every edit to the chat for the given time, after Telegram answered with a FloodWait.
+        """
+        bucket = self._refill(chat_id)
+        bucket[0] = 0
+        bucket[2] = time.monotonic() + seconds
+
+    def _refill(self, chat_id: int) -> list:
+        now = time.monotonic()
+        bucket = self._buckets.get(chat_id)
+        if bucket is None:
+            self._prune(now)
+            bucket = self._buckets[chat_id] = [self.burst, now, 0.0]
+        else:
+            bucket[0] = min(self.burst, bucket[0] + (now - bucket[1]) * self.rate)
+            bucket[1] = now
+            self._buckets.move_to_end(chat_id)
+        return bucket
+
+    def _prune(self, now: float):
+        while self._buckets:
+            tokens, refilled, blocked_until = next(iter(self._buckets.values()))
+            if tokens + (now - refilled) * self.rate < self.burst or blocked_until > now:
+                # The buckets after it were refilled later, they are not full either
+                return
+            self._buckets.popitem(last=False)
+
+
+class StreamEditor:
+    """
+    Shows a streamed answer by sending it as a message and then editing that message.
+
+    The first text is sent as soon as it arrives. After that an edit is made once at least
+    `min_interval` seconds have passed and either `min_chars` new characters arrived or
+    `max_delay` seconds have passed, so fast streams are coalesced and slow streams never
+    lag by more than `max_delay`. The final text is always flushed.
+
+    An answer longer than a Telegram message goes on in a new message once the current one is full.
+    """
+
+    def __init__(self, client: TelegramClient, chat_id: int, budget: EditBudget, min_interval: float = 1.0,
+                 min_chars: int = 40, max_delay: float = 3.0, max_interval: float = 10.0, reply_to: Optional[int] = None):
+        """
+        :param client: The client the messages are sent with
+        :param chat_id: The chat the answer is sent to
+        :param budget: The per-chat edit budget
+        :param min_interval: The minimum number of seconds between two edits
+        :param min_chars: The minimum number of new characters that justifies an edit
+        :param max_delay: The maximum number of seconds new text waits before it is shown
+        :param max_interval: The upper bound of `min_interval` when backing off after a FloodWait
+        :param reply_to: The message the answer replies to
+        """
+        self.client = client
+        self.chat_id = chat_id
+        self.budget = budget
+        self.min_interval = min_interval
+        self.min_chars = min_chars
+        self.max_delay = max_delay
+        self.max_interval = max_interval
+        self.reply_to = reply_to
+
+        self.message = None
+        self.text = ''
+        self.shown = ''
+        self.edits = 0
+        self.flood_waits = 0
+        self.started = time.monotonic()
+        self.first_visible: Optional[float] = None
+        self._last_flush = 0.0
+        # Where the text of the current message starts, and the most it may hold
+        self._offset = 0
+        self._max_length = MAX_MESSAGE_LENGTH
+        self._lock = asyncio.Lock()
+        self._timer: Optional[asyncio.Task] = None
+        # Whether the timer is still waiting, rather than flushing
+        self._timer_sleeping = False
+
+    async def update(self, text: str):
+        """
+        Records the text streamed so far and shows it if an edit is due.
+        """
+        self.text = text
+        if not text.strip():
+            return
+        elapsed = time.monotonic() - self._last_flush
+        due = self.message is None or (
+                elapsed >= self.min_interval and
+                (len(text) - len(self.shown) >= self.min_chars or elapsed >= self.max_delay))
+        if due and self.budget.try_acquire(self.chat_id):
+            await self._flush()
+        elif self._timer is None or self._timer.done():
+            self._timer_sleeping = True
+            self._timer = asyncio.create_task(self._flush_later())
+
+    async def finish(self, text: Optional[str] = None) -> int:
+        """
+        Shows the final text, waiting for the edit budget if needed.
+        :return: The number of messages sent or edited for this answer
+        """
+        if text is not None:
+            self.text = text
+        timer = self._timer
+        if timer is not None and not timer.done():
+            if self._timer_sleeping:
+                timer.cancel()
+            else:
+                # Interrupting its send would leave `message` unset and show the first text twice
+                await asyncio.wait({timer})
+        while self.text.strip() and self.text != self.shown:
+            await self.budget.acquire(self.chat_id)
+            await self._flush()
+        logging.info(f'Streamed answer to chat {self.chat_id} with {self.edits} sends/edits, '
+                     f'first text visible after {self.time_to_first_visible or 0:.2f}s')
+        return self.edits
+
+    @property
+    def time_to_first_visible(self) -> Optional[float]:
+        if self.first_visible is None:
+            return None
+        return self.first_visible - self.started
+
+    async def _flush_later(self):
+        await asyncio.sleep(max(self.max_delay - (time.monotonic() - self._last_flush),
+                                self.budget.delay(self.chat_id)))
+        self._timer_sleeping = False
+        if self.text != self.shown and self.budget.try_acquire(self.chat_id):
+            try:
+                await self._flush()
+            except Exception as e:
+                logging.exception(e)
+
+    async def _flush(self):
+        async with self._lock:
+            text = self.text
+            if text == self.shown:
+                return
+            part = text[self._offset:self._offset + self._max_length]
+            full = self._offset + len(part) < len(text)
+            if full:
+                text = text[:self._offset + len(part)]
+            try:
+                if self.message is None:
+                    with _SEND_SECONDS.time():
+                        self.message = await self.client.send_message(self.chat_id, part, reply_to=self.reply_to)
+                    if self.first_visible is None:
+                        self.first_visible = time.monotonic()
+                else:
+                    with _EDIT_SECONDS.time():
+                        await self.client.edit_message(entity=self.message, message=part)
+                self.edits += 1
+            except MessageNotModifiedError:
+                pass
+            except MessageTooLongError:
+                # Telegram counts the length differently, e.g. in UTF-16 units, the next flush sends less
+                self._max_length = len(part) * 3 // 4
+                logging.warning(f'Message to chat {self.chat_id} too long, splitting at {self._max_length} characters')
+                return
+            except FloodWaitError as e:
+                self.flood_waits += 1
+                FLOOD_WAITS.inc()
+                self.budget.block(self.chat_id, e.seconds)
+                self.min_interval = min(self.min_interval * 2, self.max_interval)
+                logging.warning(f'FloodWait of {e.seconds}s editing chat {self.chat_id}, '
+                                f'edit interval raised to {self.min_interval}s')
+                return
+            self.shown = text
+            self._last_flush = time.monotonic()
+            if full:
+                # The message is full, the rest of the answer goes on in a new one
+                self._offset = len(text)
+                self._max_length = MAX_MESSAGE_LENGTH
+                self.message = None
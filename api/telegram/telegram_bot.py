@@ -1,37 +1,67 @@
 import asyncio
+import io
 import logging
-import os
-from random import random
+import time
+from typing import Callable, Dict, List, Optional, Tuple
 
 from telethon import TelegramClient, events
 from telethon.events import NewMessage
 
-from core.openai_helper import OpenAIHelper
-from pydub import AudioSegment
+from core import metrics
+from core.dispatcher import ShardedDispatcher, Update
+from core.openai_helper import AsyncOpenAIHelper
+from core.scheduler import ChatScheduler
+from core.transcription import TranscriptionPipeline
 
-from api.telegram.telegram_mode import TelegramMode
+from api.telegram.allow_list import AllowList
+from api.telegram.client import start_client, telethon_proxy
+from api.telegram.edit_scheduler import EditBudget, StreamEditor
+from api.telegram.telegram_mode import ChatModes, TelegramMode
 from api.telegram.telegram_user import TelegramUserApp
 
+MESSAGES = metrics.counter('chatgpt_telegram_messages_total', 'Messages received, by handler', ['handler'])
+HANDLER_SECONDS = metrics.histogram(
+    'chatgpt_telegram_handler_seconds', 'Time from a message being handled to its reply being fully shown', ['handler'])
+HANDLER_ERRORS = metrics.counter('chatgpt_telegram_handler_errors_total', 'Messages whose handling failed', ['handler'])
+FIRST_VISIBLE_SECONDS = metrics.histogram(
+    'chatgpt_telegram_first_visible_seconds', 'Time until the first text of a reply was shown', ['handler'])
+
 
 class TelegramBotApp:
     """
     Class representing a Chat-GPT3 Telegram Bot.
     """
 
-    def __init__(self, config: dict, openai: OpenAIHelper):
+    def __init__(self, config: dict, openai: AsyncOpenAIHelper, client: TelegramClient = None,
+                 dispatcher: ShardedDispatcher = None):
         """
         Initializes the bot with the given configuration and GPT-3 bot object.
         :param config: A dictionary containing the bot configuration
-        :param openai: OpenAIHelper object
+        :param openai: AsyncOpenAIHelper object
+        :param client: The Telegram client, a bot client logged in with `config["token"]` by `start` by default
+        :param dispatcher: Hands the messages to worker processes by chat instead of handling them here
         """
         self.config = config
         self.openai = openai
-        self.client = TelegramClient('.chatgpt-telegram-bot', config["telegram_app_id"], config["telegram_app_hash"])\
-            .start(bot_token=config["token"])
+        self.dispatcher = dispatcher
+        if client is None:
+            client = TelegramClient('.chatgpt-telegram-bot', config["telegram_app_id"], config["telegram_app_hash"],
+                                    proxy=telethon_proxy(config.get('telegram_proxy')))
+        self.client = client
+        self.handlers_registered = False
         self.disallowed_message = "Sorry, you are not allowed to use this bot. You can check out the source code at " \
                                   "https://github.com/n3d1117/chatgpt-telegram-bot"
+        self.busy_message = "Sorry, too many messages are waiting to be answered. Please send yours again later."
 
-        self.mode = TelegramMode()
+        self.modes = ChatModes(openai.sessions)
+        self.allowed = AllowList.from_config(config)
+        self.edit_budget = EditBudget(**config.get('edit_budget', {}))
+        self.transcription = TranscriptionPipeline(openai, **config.get('transcription', {}))
+        self.scheduler = ChatScheduler(**config.get('scheduler', {}))
+        self.images_in_flight: Dict[int, int] = {}
+        if openai.idle_worker is not None:
+            # Quiet chats are only prepared while no message waits for its turn
+            openai.idle_worker.busy = lambda: self.scheduler.queue_depth() > 0
 
 
     def add_decorator(self, **kwargs):
@@ -42,13 +72,16 @@ class TelegramBotApp:
         """
         Return current modes
         """
-        await self.client.send_message(event.chat_id, str(self.mode))
+        await self.client.send_message(event.chat_id, str(self.modes[event.chat_id]))
 
     async def help(self, event: NewMessage.Event) -> None:
         """
         Shows the help menu.
         """
         await event.reply("/reset - Reset conversation\n"
+                           "/stop - Stop the answer being written\n"
+                           "/mode - Show the settings of this chat\n"
+                           "/set <setting> <value> - Change a setting, e.g. /set stream off\n"
                            "/image <prompt> - Generate image\n"
                            "/help - Help menu\n\n"
                            "Open source at https://github.com/n3d1117/chatgpt-telegram-bot",
@@ -66,9 +99,24 @@ class TelegramBotApp:
         logging.info(f'Resetting the conversation for user {event.chat.username}...')
 
         chat_id = event.chat_id
+        # The answer being written would otherwise be recorded in the new conversation
+        await self.scheduler.cancel(chat_id)
         self.openai.reset_chat_history(chat_id=chat_id)
         await self.client.send_message(chat_id, 'Done!')
 
+    async def stop(self, event: NewMessage.Event):
+        """
+        Stops the answer being written, keeping what was shown so far.
+        """
+        if not self.is_allowed(event):
+            logging.warning(f'User {event.chat.username} is not allowed to stop answers')
+            await self.send_disallowed_message(event)
+            return
+
+        logging.info(f'Stopping the answer for user {event.chat.username}...')
+        stopped = await self.scheduler.cancel(event.chat_id)
+        await self.client.send_message(event.chat_id, 'Stopped.' if stopped else 'Nothing to stop.')
+
     async def auto_reset_mode(self, event: NewMessage.Event):
         """
         Auto reset conversation
@@ -80,7 +128,7 @@ class TelegramBotApp:
 
         logging.info(f'Reset mode for user {event.chat.username}...')
 
-        self.mode.auto_reset_mode()
+        self.modes.update(event.chat_id, auto_reset=True)
         await self.client.send_message(event.chat_id, 'Auto Reset Mode Start~')
 
     async def cancel_auto_reset_mode(self, event: NewMessage.Event):
@@ -89,40 +137,79 @@ class TelegramBotApp:
         """
         if self.is_allowed(event):
             logging.info(f'Cancel reset mode for user {event.chat.username}...')
-            self.mode.cancel_auto_reset_mode()
+            self.modes.update(event.chat_id, auto_reset=False)
             await self.client.send_message(event.chat_id, 'Cancel Auto Reset Mode~')
 
-    #async def image(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
-    #    """
-    #    Generates an image for the given prompt using DALL·E APIs
-    #    """
-    #    if not self.is_allowed(update):
-    #        logging.warning(f'User {update.message.from_user.name} is not allowed to generate images')
-    #        await self.send_disallowed_message(update, context)
-    #        return
-
-    #    logging.info(f'New image generation request received from user {update.message.from_user.name}')
-
-    #    chat_id = update.effective_chat.id
-    #    image_query = update.message.text.replace('/image', '').strip()
-    #    if image_query == '':
-    #        await context.bot.send_message(chat_id=chat_id, text='Please provide a prompt!')
-    #        return
-
-    #    await context.bot.send_chat_action(chat_id=chat_id, action=constants.ChatAction.UPLOAD_PHOTO)
-    #    try:
-    #        image_url = self.openai.generate_image(prompt=image_query)
-    #        await context.bot.send_photo(
-    #            chat_id=chat_id,
-    #            reply_to_message_id=update.message.message_id,
-    #            photo=image_url
-    #        )
-    #    except:
-    #        await context.bot.send_message(
-    #            chat_id=chat_id,
-    #            reply_to_message_id=update.message.message_id,
-    #            text='Failed to generate image'
-    #        )
+    async def set_mode(self, event: NewMessage.Event):
+        """
+        Changes a setting of the chat: /set <setting> <value>
+        """
+        if not self.is_allowed(event):
+            logging.warning(f'User {event.chat.username} is not allowed to change the settings')
+            await self.send_disallowed_message(event)
+            return
+
+        _, name, value = (event.message.text.split(maxsplit=2) + ['', ''])[:3]
+        try:
+            value = TelegramMode.parse(name, value)
+            if name == 'function' and value not in self.openai.functions:
+                raise ValueError(f'The functions are {", ".join(sorted(self.openai.functions))}')
+            models = self.config.get('chat_models') or [self.openai.config['model']]
+            if name == 'model' and value is not None and value not in models:
+                raise ValueError(f'The models are {", ".join(models)}')
+        except ValueError as e:
+            await event.reply(f'{e}\nUsage: /set <{"|".join(TelegramMode.FIELDS)}> <value>')
+            return
+
+        logging.info(f'Setting {name} to {value} for user {event.chat.username}')
+        mode = self.modes.update(event.chat_id, **{name: value})
+        await self.client.send_message(event.chat_id, str(mode))
+
+    async def image(self, event: NewMessage.Event):
+        """
+        Generates an image for the given prompt using DALL·E APIs
+        """
+        if not self.is_allowed(event):
+            logging.warning(f'User {event.chat.username} is not allowed to generate images')
+            await self.send_disallowed_message(event)
+            return
+
+        logging.info(f'New image generation request received from user {event.chat.username}')
+        MESSAGES.labels('image').inc()
+
+        chat = event.chat
+        chat_id = event.chat_id
+        image_query = event.message.text.replace('/image', '', 1).strip()
+        if image_query == '':
+            await self.client.send_message(chat_id, 'Please provide a prompt!')
+            return
+
+        if self.images_in_flight.get(chat_id, 0) >= self.config.get('image_max_in_flight', 1):
+            await event.reply('Please wait for the images being generated for this chat')
+            return
+
+        started = time.perf_counter()
+        self.images_in_flight[chat_id] = self.images_in_flight.get(chat_id, 0) + 1
+        try:
+            async with self.client.action(chat, 'photo'):
+                image = await self.openai.generate_image_bytes(prompt=image_query)
+                # Uploaded from memory, Telegram does not have to fetch it again
+                file = io.BytesIO(image)
+                file.name = 'image.png'
+                await self.client.send_file(chat, file, reply_to=event.message.id)
+            HANDLER_SECONDS.labels('image').observe(time.perf_counter() - started)
+        except Exception as e:
+            HANDLER_ERRORS.labels('image').inc()
+            logging.exception(e)
+            await self.client.send_message(
+                entity=chat,
+                message='Failed to generate image',
+                reply_to=event.message.id
+            )
+        finally:
+            self.images_in_flight[chat_id] -= 1
+            if not self.images_in_flight[chat_id]:
+                del self.images_in_flight[chat_id]
 
     async def transcribe(self, event: NewMessage.Event):
         """
@@ -143,45 +230,31 @@ class TelegramBotApp:
             return
 
         logging.info(f'New transcribe request received from user {event.chat.username}')
+        MESSAGES.labels('transcribe').inc()
 
-        async with self.client.action(chat, "typing", delay=5):
-            await asyncio.sleep(0.1)
-        filename = event.voice.file_unique_id if event.message.voice else event.message.audio.file_unique_id
-        filename_ogg = f'{filename}.ogg'
-        filename_mp3 = f'{filename}.mp3'
-
+        started = time.perf_counter()
         try:
-            if event.message.voice:
-                await self.client.download_file(event.message.voice.file_id, filename_ogg)
-                ogg_audio = AudioSegment.from_ogg(filename_ogg)
-                ogg_audio.export(filename_mp3, format="mp3")
-
-            elif event.message.audio:
-                await self.client.download_file(event.message.audio.file_id, filename_mp3)
-
-            # Transcribe the audio file
-            transcript = self.openai.transcribe(filename_mp3)
-
-            # Send the transcript
-            await self.client.send_message(
-                entity=chat,
-                message=transcript,
-                reply_to=event.message.id
-            )
-        except:
+            async with self.client.action(chat, "typing"):
+                data = await self.client.download_media(event.message, file=bytes)
+                filename = event.message.file.name or f'audio{event.message.file.ext or ""}'
+
+                # Send the transcript, long recordings are edited in place as their segments complete
+                editor = StreamEditor(self.client, chat.id, self.edit_budget, reply_to=event.message.id,
+                                      **self.config.get('stream_edits', {}))
+                async for transcript in self.transcription.transcribe_progressive(data, filename):
+                    await editor.update(transcript)
+                await editor.finish()
+            HANDLER_SECONDS.labels('transcribe').observe(time.perf_counter() - started)
+            FIRST_VISIBLE_SECONDS.labels('transcribe').observe(editor.time_to_first_visible or 0)
+        except Exception as e:
+            HANDLER_ERRORS.labels('transcribe').inc()
+            logging.exception(e)
             await self.client.send_message(
                 entity=chat,
                 message="Failed to transcribe text",
                 reply_to=event.message.id
             )
 
-        finally:
-            # Cleanup files
-            if os.path.exists(filename_mp3):
-                os.remove(filename_mp3)
-            if os.path.exists(filename_ogg):
-                os.remove(filename_ogg)
-
     @TelegramUserApp.polish_api
     async def prompt(self, event: NewMessage.Event):
         """
@@ -193,42 +266,93 @@ class TelegramBotApp:
             return
 
         logging.info(f'New message received from user {event.chat.username}')
+        MESSAGES.labels('prompt').inc()
+        if self.config.get('cancel_on_new_message', True):
+            # The new message supersedes the answer still being written
+            await self.scheduler.cancel(event.chat_id)
+        await self.scheduler.submit(event.chat_id, self.answer, event,
+                                    mergeable=self.config.get('merge_queued_messages', False))
+
+    async def answer(self, events: List[NewMessage.Event]):
+        """
+        Answers the messages of a chat, in a single turn if several were queued.
+        """
+        event = events[-1]
         chat = event.chat
         chat_id = event.chat_id
+        query = "\n".join(e.message.text for e in events)
+        mode = self.modes[chat_id]
 
+        started = time.perf_counter()
         async with self.client.action(chat, "typing", delay=5):
             await asyncio.sleep(0.1)
-            response = self.openai.get_chat_response(chat_id=chat_id, function="assistant", query=event.message.text, stream=True)
+            if mode.stream and self.openai.config.get('n_choices', 1) > 1:
+                editors = await self.answer_choices(chat, chat_id, query, mode)
+            else:
+                editors = [await self.answer_single(chat, chat_id, query, mode)]
+        HANDLER_SECONDS.labels('prompt').observe(time.perf_counter() - started)
+        visible = [editor.time_to_first_visible for editor in editors if editor.time_to_first_visible is not None]
+        if visible:
+            FIRST_VISIBLE_SECONDS.labels('prompt').observe(min(visible))
+
+        if self.modes[chat_id].is_auto_reset():
+            self.openai.reset_chat_history(chat_id=chat_id)
 
-            text = ""
-            message = None
-            update = False
-            for rep in response:
+    async def answer_single(self, chat, chat_id: int, query: str, mode: TelegramMode) -> StreamEditor:
+        """
+        Streams the answer into one message, or sends it once complete if the chat turned streaming off.
+        """
+        editor = StreamEditor(self.client, chat.id, self.edit_budget, **self.config.get('stream_edits', {}))
+        if not mode.stream:
+            await editor.finish(await self.openai.get_chat_response(
+                chat_id=chat_id, function=mode.function, query=query, model=mode.model, max_tokens=mode.budget))
+            return editor
+
+        response = await self.openai.get_chat_response(chat_id=chat_id, function=mode.function, query=query,
+                                                       stream=True, model=mode.model, max_tokens=mode.budget)
+        text = ""
+        try:
+            async for cur_text in response:
+                text += cur_text
                 try:
-                    cur_text = rep["choices"][0]["delta"]["content"]
-                    text += cur_text
-                    update = True
-                    if random() > 0.2:
-                        continue
-                    if not message:
-                        message = await self.client.send_message(chat.id, text)
-                    else:
-                        await self.client.edit_message(
-                            entity=message,
-                            message=text,
-                        )
-                        update = False
+                    await editor.update(text)
                 except Exception as e:
-                    pass
-
-            if text and message and update:
-                await self.client.edit_message(
-                    entity=message,
-                    message=text,
-                )
+                    logging.exception(e)
+        except asyncio.CancelledError:
+            # Stops the generation upstream, then shows the answer as far as it got
+            await response.aclose()
+            await editor.finish(text)
+            raise
+        await editor.finish(text)
+        return editor
+
+    async def answer_choices(self, chat, chat_id: int, query: str, mode: TelegramMode) -> List[StreamEditor]:
+        """
+        Streams every choice of the answer at the same time, each into its own numbered message.
+        """
+        response = await self.openai.get_chat_choices(chat_id=chat_id, function=mode.function, query=query,
+                                                      model=mode.model, max_tokens=mode.budget)
 
-        if self.mode.is_auto_reset():
-            self.openai.reset_chat_history(chat_id=chat_id)
+        editors, texts = {}, {}
+        try:
+            async for index, delta in response:
+                if index not in editors:
+                    editors[index] = StreamEditor(self.client, chat.id, self.edit_budget,
+                                                  **self.config.get('stream_edits', {}))
+                    texts[index] = f'{index + 1}\u20e3\n'
+                texts[index] += delta
+                try:
+                    await editors[index].update(texts[index])
+                except Exception as e:
+                    logging.exception(e)
+        except asyncio.CancelledError:
+            await response.aclose()
+            for index in sorted(editors):
+                await editors[index].finish(texts[index])
+            raise
+        for index in sorted(editors):
+            await editors[index].finish(texts[index])
+        return [editors[index] for index in sorted(editors)]
 
     async def send_disallowed_message(self, event: NewMessage.Event):
         """
@@ -246,21 +370,63 @@ class TelegramBotApp:
         """
         Checks if the user is allowed to use the bot.
         """
-        if self.config['allowed_user_ids'] == '*':
-            return True
-        return str(event.chat_id) in self.config['allowed_user_ids'].split(',')
+        return event.chat_id in self.allowed
 
     async def any_message_arrived_handler(self, event: NewMessage.Event):
         await event.reply(event.chat_id)
         print('We are handling message events')
 
+    async def start(self, timeout: Optional[float] = None):
+        """
+        Registers the handlers, then logs the bot in, so that the messages waiting for it are handled right away.
+        :raise ConnectionError: If the bot could not log in within `timeout` seconds
+        """
+        self.register_handlers()
+        if not await start_client(self.client, 'bot', timeout, bot_token=self.config['token']):
+            raise ConnectionError('The bot could not connect to Telegram')
+
     def run(self):
         """
         Runs the bot indefinitely until the user presses Ctrl+C
         """
-        self.client.on(events.NewMessage(pattern='/reset'))(self.reset)
-        self.client.on(events.NewMessage(pattern='/mode'))(self.get_mode)
-        self.client.on(events.NewMessage(pattern='/auto_reset'))(self.auto_reset_mode)
-        self.client.on(events.NewMessage(pattern='/cancel_auto_reset'))(self.cancel_auto_reset_mode)
-        self.client.on(events.NewMessage(pattern=lambda x: not x.startswith("/")))(self.prompt)
+        self.register_handlers()
         self.client.run_until_disconnected()
+
+    def handlers(self) -> List[Tuple[events.NewMessage, Callable]]:
+        return [
+            (events.NewMessage(pattern='/reset'), self.reset),
+            (events.NewMessage(pattern='/stop'), self.stop),
+            (events.NewMessage(pattern='/mode'), self.get_mode),
+            (events.NewMessage(pattern='/auto_reset'), self.auto_reset_mode),
+            (events.NewMessage(pattern='/cancel_auto_reset'), self.cancel_auto_reset_mode),
+            (events.NewMessage(pattern=r'/set\b'), self.set_mode),
+            (events.NewMessage(pattern=r'/image\b'), self.image),
+            (events.NewMessage(func=lambda e: e.message.voice or e.message.audio), self.transcribe),
+            (events.NewMessage(pattern=lambda x: x and not x.startswith("/")), self.prompt),
+        ]
+
+    def register_handlers(self):
+        """
+        Registers the handlers on the client, or handlers forwarding the messages to the workers if sharded.
+        """
+        if self.handlers_registered:
+            return
+        self.handlers_registered = True
+        for event, handler in self.handlers():
+            self.client.on(event)(handler if self.dispatcher is None else self._forward(handler.__name__))
+
+    def _forward(self, handler: str) -> Callable:
+        async def forward(event: NewMessage.Event):
+            # The allow-list is only reloaded here, so the workers take every update they are handed as allowed
+            if not self.is_allowed(event):
+                logging.warning(f'Chat {event.chat_id} is not allowed to use the bot')
+                await self.send_disallowed_message(event)
+                return
+            telegram_user_app = getattr(self, 'telegram_user_app', None)
+            if handler == 'prompt' and telegram_user_app is not None:
+                # The user account is only logged in here, so messages are polished before being handed over
+                telegram_user_app.maybe_polish(event)
+            if not self.dispatcher.dispatch(Update(handler, event.chat_id, event.message.id, event.message.text,
+                                                   media=bool(event.message.voice or event.message.audio))):
+                await event.reply(self.busy_message)
+        return forward
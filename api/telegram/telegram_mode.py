@@ -3,10 +3,37 @@
 # @Author  : nzooherd
 # @File    : telegram_mode.py
 # @Software: PyCharm
+import logging
+from typing import Dict, Optional
+
+from core.session_store import SessionStore
+
+SWITCH_VALUES = {'on': True, 'true': True, 'yes': True, '1': True,
+                 'off': False, 'false': False, 'no': False, '0': False}
+
+
 class TelegramMode:
+    """
+    The settings of one chat. Modes are never changed in place: chats that changed no setting share
+    the default mode, and a change replaces the mode of its chat.
+    """
+    FIELDS = ('auto_reset', 'function', 'model', 'stream', 'budget')
+    __slots__ = FIELDS
 
-    def __init__(self):
-        self.auto_reset = False
+    def __init__(self, auto_reset: bool = False, function: str = 'assistant', model: Optional[str] = None,
+                 stream: bool = True, budget: Optional[int] = None):
+        """
+        :param auto_reset: Whether the conversation is forgotten after every answer
+        :param function: The function messages are answered with
+        :param model: The model answers are requested from, the routed model if None
+        :param stream: Whether answers are edited in as they are generated, or sent once complete
+        :param budget: The maximum number of tokens of an answer, the routed `max_tokens` if None
+        """
+        self.auto_reset = auto_reset
+        self.function = function
+        self.model = model
+        self.stream = stream
+        self.budget = budget
 
     def is_auto_reset(self) -> bool:
         """
@@ -14,11 +41,85 @@ class TelegramMode:
         """
         return self.auto_reset
 
-    def auto_reset_mode(self):
-        self.auto_reset = True
+    def replace(self, **changes) -> 'TelegramMode':
+        return TelegramMode(**dict(self.to_dict(), **changes))
+
+    def changes(self, default: 'TelegramMode') -> dict:
+        """
+        Returns the settings that differ from the default mode.
+        """
+        return {name: getattr(self, name) for name in self.FIELDS if getattr(self, name) != getattr(default, name)}
+
+    def to_dict(self) -> dict:
+        return {name: getattr(self, name) for name in self.FIELDS}
+
+    @staticmethod
+    def parse(name: str, value: str):
+        """
+        Converts the text of a `/set <name> <value>` command to the value of a setting.
+        :raise ValueError: If the setting does not exist or the value is not valid for it
+        """
+        value = value.strip()
+        if name in ('auto_reset', 'stream'):
+            if value.lower() not in SWITCH_VALUES:
+                raise ValueError(f'{name} is either on or off')
+            return SWITCH_VALUES[value.lower()]
+        if name in ('model', 'budget') and value.lower() in ('', 'default', 'none'):
+            return None
+        if name == 'budget':
+            if not value.isdigit() or int(value) <= 0:
+                raise ValueError('budget is a number of tokens')
+            return int(value)
+        if name in ('function', 'model') and value:
+            return value
+        raise ValueError(f'Unknown setting {name}, the settings are {", ".join(TelegramMode.FIELDS)}')
 
-    def cancel_auto_reset_mode(self):
-        self.auto_reset = False
+    def __eq__(self, other):
+        return isinstance(other, TelegramMode) and self.to_dict() == other.to_dict()
 
     def __repr__(self):
-        return str(self.__dict__)
+        return str(self.to_dict())
+
+
+class ChatModes:
+    """
+    The modes of all chats by chat ID. Only the chats that changed a setting are held, the others
+    read the default mode, and the changes are saved with the sessions so that they survive restarts.
+    """
+
+    def __init__(self, store: SessionStore, default: Optional[TelegramMode] = None):
+        """
+        :param store: The session store the settings are saved to
+        :param default: The mode of the chats that changed no setting
+        """
+        self.store = store
+        self.default = default or TelegramMode()
+        self._modes: Dict[int, TelegramMode] = {}
+        for chat_id, settings in store.load_settings().items():
+            try:
+                self._set(chat_id, self.default.replace(**settings))
+            except TypeError:
+                logging.warning(f'Ignoring the unknown settings of chat {chat_id}: {settings}')
+
+    def __getitem__(self, chat_id: int) -> TelegramMode:
+        return self._modes.get(chat_id, self.default)
+
+    def __len__(self) -> int:
+        return len(self._modes)
+
+    def update(self, chat_id: int, **changes) -> TelegramMode:
+        """
+        Changes settings of a chat and saves them.
+        :return: The new mode of the chat
+        """
+        mode = self._set(chat_id, self[chat_id].replace(**changes))
+        settings = mode.changes(self.default)
+        self.store.save_settings(chat_id, settings or None)
+        return mode
+
+    def _set(self, chat_id: int, mode: TelegramMode) -> TelegramMode:
+        if mode == self.default:
+            self._modes.pop(chat_id, None)
+            return self.default
+        self._modes[chat_id] = mode
+        return mode
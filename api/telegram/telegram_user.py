@@ -3,41 +3,129 @@
 # @Author  : nzooherd
 # @File    : telegram_user.py
 # @Software: PyCharm
+import asyncio
 import functools
-from typing import Callable
+import logging
+from collections import OrderedDict
+from typing import Callable, Dict, Optional, Set, Tuple
 
-import socks
-from telethon import TelegramClient
+from telethon import TelegramClient, events
 from telethon.events import NewMessage
 
-from core.openai_helper import OpenAIHelper
+from core import metrics
+from core.openai_helper import AsyncOpenAIHelper
+
+from api.telegram.client import resume_client, telethon_proxy
+
+POLISH_SECONDS = metrics.histogram('chatgpt_polish_seconds', 'Time taken to polish and edit a message')
+POLISH_ERRORS = metrics.counter('chatgpt_polish_errors_total', 'Messages whose polish failed')
+POLISH_LOOKUPS = metrics.counter('chatgpt_polish_lookups_total', 'How the polished message was found', ['method'])
 
 
 class TelegramUserApp:
 
-    def __init__(self, config: dict, openai: OpenAIHelper):
+    def __init__(self, config: dict, openai: AsyncOpenAIHelper, client: TelegramClient = None,
+                 max_sent_messages: int = 1000, owner_id: Optional[int] = None):
+        """
+        :param config: A dictionary containing the user account configuration
+        :param openai: AsyncOpenAIHelper object
+        :param client: The Telegram client of the user account, logged in from the saved session by `start`
+                       by default; a given client is taken as logged in already
+        :param max_sent_messages: The number of recently sent messages whose ids are remembered for polishing
+        :param owner_id: The user id of the account, read by `start` once logged in
+        """
         self.config = config
         self.openai = openai
-        self.client = TelegramClient('.chatgpt-telegram-user', config["telegram_app_id"], config["telegram_app_hash"],
-                                     proxy=(socks.SOCKS5, '192.168.10.118', 7891))
-        self.client.start()
+        # Messages are only polished once the user account is logged in
+        self.ready = client is not None
+        self.owner_id = owner_id
+        # A bot token starts with the user id of the bot, the only chat whose messages are polished
+        self.bot_id = int(config['token'].split(':', 1)[0])
+        if client is None:
+            client = TelegramClient('.chatgpt-telegram-user', config["telegram_app_id"], config["telegram_app_hash"],
+                                    proxy=telethon_proxy(config.get('proxy')))
+        self.client = client
+        self.max_sent_messages = max_sent_messages
 
         self.prompts = {
             "polish": "Revise the following sentences to make them more clear, concise, and coherent."
         }
+        # {(chat id, text): message id} of the messages the user sent the bot recently, as the user account
+        # sees them. Message ids of private chats differ between the bot and the user account, so the id
+        # the bot received cannot be used to edit the message
+        self._sent: 'OrderedDict[Tuple[int, str], int]' = OrderedDict()
+        self._entities: Dict[int, asyncio.Future] = {}
+        self._tasks: Set[asyncio.Task] = set()
+        self.client.on(events.NewMessage(outgoing=True, chats=self.bot_id))(self._remember_sent)
+
+    async def start(self, timeout: Optional[float] = None) -> bool:
+        """
+        Logs the user account in from its saved session. Polishing stays off if it cannot within `timeout` seconds.
+        :return: Whether the user account is logged in
+        """
+        ready = await resume_client(self.client, 'user account', timeout)
+        if ready and self.owner_id is None:
+            self.owner_id = (await self.client.get_me()).id
+        self.ready = ready
+        return self.ready
 
-    async def _polish_do(self, versus_event: NewMessage.Event):
-        chat_id = versus_event.chat_id
-        query = f"{self.prompts['polish']}: {versus_event.message.text}"
-        polish_response = self.openai.get_chat_response(chat_id=chat_id, function="polish", query=query, stream=False)
-        response = versus_event.message.text + "\n----\n" + f"**`{polish_response}`**"
-        entity = await self.client.get_entity(versus_event.message.to_id.user_id)
+    def polish_later(self, versus_event: NewMessage.Event) -> asyncio.Task:
+        """
+        Polishes a message in a background task, so that answering it does not wait for the polish.
+        """
+        task = asyncio.ensure_future(self._polish_do(versus_event))
+        self._tasks.add(task)
+        task.add_done_callback(self._tasks.discard)
+        return task
 
+    async def _polish_do(self, versus_event: NewMessage.Event):
+        with POLISH_SECONDS.time():
+            try:
+                await self._polish(versus_event)
+            except Exception as e:
+                POLISH_ERRORS.inc()
+                logging.exception(e)
+
+    async def _polish(self, versus_event: NewMessage.Event):
+        text = versus_event.message.text
+        query = f"{self.prompts['polish']}: {text}"
+        polish_response = await self.openai.get_stateless_response(function="polish", query=query, temperature=0)
+        response = text + "\n----\n" + f"**`{polish_response}`**"
+
+        entity = await self._entity(self.bot_id)
+        message_id = self._sent.pop((self.bot_id, text), None)
+        if message_id is not None:
+            POLISH_LOOKUPS.labels('id').inc()
+            await self.client.edit_message(entity=entity, message=message_id, text=response)
+            return
+
+        # Sent before the user account was listening, look for it among the latest messages to the bot
+        POLISH_LOOKUPS.labels('search').inc()
         async for message in self.client.iter_messages(entity, limit=10):
-            if message.text == versus_event.message.text:
+            if message.out and message.text == text:
                 await self.client.edit_message(entity=entity, message=message, text=response)
                 break
 
+    async def _remember_sent(self, event: NewMessage.Event):
+        key = (event.chat_id, event.message.text)
+        self._sent[key] = event.message.id
+        self._sent.move_to_end(key)
+        while len(self._sent) > self.max_sent_messages:
+            self._sent.popitem(last=False)
+
+    async def _entity(self, chat_id: int):
+        """
+        Resolves a chat once, concurrent polishes of the same chat share the lookup.
+        """
+        entity = self._entities.get(chat_id)
+        if entity is None:
+            entity = self._entities[chat_id] = asyncio.ensure_future(self.client.get_input_entity(chat_id))
+        try:
+            return await asyncio.shield(entity)
+        except Exception:
+            self._entities.pop(chat_id, None)
+            raise
+
 
     @staticmethod
     def polish_api(func: Callable):
@@ -49,17 +137,30 @@ class TelegramUserApp:
                     event = arg
                     break
             if not event:
-                return func(cls, *args, **kwargs)
-
-            self = cls.telegram_user_app
-            if not self._check_need_polish(event) or not self._check_allow_polish(event):
                 return await func(cls, *args, **kwargs)
-            await self._polish_do(event)
+
+            self = getattr(cls, 'telegram_user_app', None)
+            if self is not None:
+                self.maybe_polish(event)
             return await func(cls, *args, **kwargs)
         return wrapped
 
+    def maybe_polish(self, event: NewMessage.Event) -> Optional[asyncio.Task]:
+        """
+        Polishes a message in the background if the user account is logged in and the message needs it.
+        """
+        try:
+            if self.ready and self._check_need_polish(event) and self._check_allow_polish(event):
+                return self.polish_later(event)
+        except Exception as e:
+            logging.exception(e)
+        return None
+
     def _check_allow_polish(self, event: NewMessage.Event) -> bool:
-        return True
+        """
+        Only the messages of the account owner can be edited by the user account.
+        """
+        return self.owner_id is not None and event.sender_id == self.owner_id
 
     def _check_need_polish(self, event: NewMessage.Event) -> bool:
         """
@@ -3,25 +3,215 @@
 # @Author  : nzooherd
 # @File    : query.py
 # @Software: PyCharm
-from functools import lru_cache
+import asyncio
+import json
+import logging
+from typing import AsyncIterator, Dict, List
 
-import cherrypy
+from aiohttp import web
 
-from core.openai_helper import OpenAIHelper
+from core.cache import TTLCache
+from core.history import count_tokens
+from core.openai_helper import AsyncOpenAIHelper
+
+BATCH_PROMPT = "Explain the meaning of each of the following words in Chinese. " \
+               "Reply with only a JSON object that maps every word, exactly as given, to its explanation.\n"
 
 
 class DictionApp(object):
 
-    def __init__(self, openai: OpenAIHelper):
+    def __init__(self, openai: AsyncOpenAIHelper, cache_size: int = 4096, cache_ttl: float = 7 * 24 * 3600,
+                 tokens_per_word: int = 120, max_batch_tokens: int = 2000, max_words: int = 200, workers: int = 4):
+        """
+        :param openai: The helper the lookups are sent with
+        :param cache_size: The maximum number of cached words
+        :param cache_ttl: The number of seconds a cached word stays valid
+        :param tokens_per_word: The expected number of answer tokens per word of a batch
+        :param max_batch_tokens: The maximum number of answer tokens of one batch completion
+        :param max_words: The maximum number of words of one /words request
+        :param workers: The number of batch completions sent at the same time per request
+        """
         self.openai = openai
-        self.chat_id = 21052
+        self.cache = TTLCache(max_size=cache_size, ttl=cache_ttl)
+        self.tokens_per_word = tokens_per_word
+        self.max_batch_tokens = max_batch_tokens
+        self.max_words = max_words
+        self.workers = workers
+
+    def routes(self) -> List[web.RouteDef]:
+        return [
+            web.get('/', self.index),
+            web.get('/word', self.word),
+            web.route('*', '/words', self.words),
+        ]
+
+    async def index(self, request: web.Request) -> web.Response:
+        return web.Response(text="Hello World")
+
+    async def word(self, request: web.Request) -> web.Response:
+        key = self.normalize(request.query.get('word', ''))
+        if not key:
+            raise web.HTTPBadRequest(text="Missing word")
+        try:
+            meaning = await self.cache.aget_or_compute(key, lambda: self.lookup(key))
+        except Exception as e:
+            logging.exception(e)
+            meaning = f"⚠️ _An error has occurred_ ⚠️\n{str(e)}"
+        return web.Response(text=meaning)
+
+    async def words(self, request: web.Request) -> web.StreamResponse:
+        """
+        Looks up many words at once and answers with a JSON object mapping every word to its meaning.
+        Words are given as a comma-separated or repeated `words` parameter, or as a JSON list in the body.
+        With `stream=true` every word is written as its own JSON line as soon as it is known.
+        Words that could not be looked up map to null, so that the client can ask for them again.
+        """
+        keys = await self.parse_words(request)
+        if not keys:
+            raise web.HTTPBadRequest(text="Missing words")
+        if len(keys) > self.max_words:
+            raise web.HTTPRequestEntityTooLarge(max_size=self.max_words, actual_size=len(keys),
+                                                text=f"At most {self.max_words} words per request")
+
+        entries = self.lookup_many(keys)
+        if request.query.get('stream', 'false').lower() != 'true':
+            return web.json_response({word: meaning async for word, meaning in entries},
+                                     dumps=lambda obj: json.dumps(obj, ensure_ascii=False))
+
+        response = web.StreamResponse(headers={'Content-Type': 'application/x-ndjson'})
+        await response.prepare(request)
+        async for word, meaning in entries:
+            line = json.dumps({"word": word, "meaning": meaning}, ensure_ascii=False) + "\n"
+            await response.write(line.encode())
+        await response.write_eof()
+        return response
+
+    async def lookup(self, word: str) -> str:
+        """
+        Asks the model for the meaning of a word, with a fixed prompt and no conversation history.
+        """
+        return await self.openai.get_stateless_response(function="diction", query=word + "是什么意思?")
+
+    async def lookup_many(self, words: List[str]) -> AsyncIterator[tuple]:
+        """
+        Yields `(word, meaning)` pairs: cached words first, then the others as their batch completes.
+        The words of a failed batch are looked up one by one, a word that fails again has the meaning None.
+        """
+        missing = []
+        for word in words:
+            meaning = self.cache.get(word)
+            if meaning is None:
+                missing.append(word)
+            else:
+                yield word, meaning
+
+        semaphore = asyncio.Semaphore(self.workers)
+
+        async def run(batch):
+            async with semaphore:
+                try:
+                    return await self.lookup_batch(batch)
+                except Exception as e:
+                    if len(batch) == 1:
+                        logging.exception(e)
+                        return {batch[0]: None}
+                    logging.warning(f'Looking up {len(batch)} words one by one, their batch failed: {e!r}')
+            meanings = {}
+            for result in await asyncio.gather(*(run([word]) for word in batch)):
+                meanings.update(result)
+            return meanings
+
+        tasks = [asyncio.ensure_future(run(batch)) for batch in self.pack(missing)]
+        try:
+            for task in asyncio.as_completed(tasks):
+                meanings = await task
+                for word, meaning in meanings.items():
+                    yield word, meaning
+        finally:
+            for task in tasks:
+                task.cancel()
+
+    async def lookup_batch(self, words: List[str]) -> Dict[str, str]:
+        """
+        Asks the model for the meaning of several words in one completion and caches the answers.
+        Words missing from the answer are looked up one by one.
+        """
+        if len(words) == 1:
+            return {words[0]: await self.cache.aget_or_compute(words[0], lambda: self.lookup(words[0]))}
+
+        answer = await self.openai.get_stateless_response(
+            function="diction",
+            query=BATCH_PROMPT + json.dumps(words, ensure_ascii=False),
+            max_tokens=min(self.max_batch_tokens, self.tokens_per_word * len(words)),
+            temperature=0,
+        )
+        parsed = self.parse_batch(answer)
+
+        meanings = {}
+        for word in words:
+            meaning = parsed.get(word)
+            if isinstance(meaning, str) and meaning:
+                self.cache.set(word, meaning)
+            else:
+                meaning = await self.cache.aget_or_compute(word, lambda: self.lookup(word))
+            meanings[word] = meaning
+        return meanings
+
+    def pack(self, words: List[str]) -> List[List[str]]:
+        """
+        Splits words into batches whose expected answers fit in `max_batch_tokens`.
+        """
+        batches = []
+        batch, tokens = [], 0
+        for word in words:
+            cost = self.tokens_per_word + count_tokens(word)
+            if batch and tokens + cost > self.max_batch_tokens:
+                batches.append(batch)
+                batch, tokens = [], 0
+            batch.append(word)
+            tokens += cost
+        if batch:
+            batches.append(batch)
+        return batches
+
+    async def parse_words(self, request: web.Request) -> List[str]:
+        """
+        Reads the requested words from the query string or the JSON body, normalised and without duplicates.
+        """
+        words = request.query.getall('words', None)
+        if words is not None:
+            words = [word for param in words for word in param.split(",")]
+        elif request.can_read_body:
+            try:
+                words = await request.json()
+            except ValueError:
+                raise web.HTTPBadRequest(text="Body must be a JSON list of words")
+            if isinstance(words, dict):
+                words = words.get("words")
+        if not isinstance(words, list):
+            return []
+        keys = (self.normalize(str(word)) for word in words)
+        return list(dict.fromkeys(key for key in keys if key))
 
-    @cherrypy.expose
-    def index(self):
-        return "Hello World"
+    @staticmethod
+    def parse_batch(answer: str) -> Dict[str, str]:
+        """
+        Reads the JSON object of a batch answer, tolerating text around it.
+        """
+        start, end = answer.find("{"), answer.rfind("}")
+        if start < 0 or end < start:
+            return {}
+        try:
+            parsed = json.loads(answer[start:end + 1])
+        except ValueError:
+            return {}
+        if not isinstance(parsed, dict):
+            return {}
+        return {DictionApp.normalize(str(word)): meaning for word, meaning in parsed.items()}
 
-    @lru_cache
-    @cherrypy.expose
-    def word(self, word):
-        self.query = word + "是什么意思?"
-        return self.openai.get_chat_response(self.chat_id, function="diction", query=word, stream=False)
+    @staticmethod
+    def normalize(word: str) -> str:
+        """
+        Returns the cache key of a word: trimmed, case-folded and with single spaces.
+        """
+        return " ".join(word.split()).casefold()
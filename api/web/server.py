@@ -0,0 +1,109 @@
+# -*- coding: utf-8 -*-
+# @Time    : 4/18/2023
+# @Author  : nzooherd
+# @File    : server.py
+# @Software: PyCharm
+import asyncio
+import logging
+from typing import Callable, Dict, List, Optional
+
+from aiohttp import web
+
+from core.metrics import REGISTRY, Registry
+
+
+def stats_route(sources: Dict[str, Callable[[], dict]], path: str = '/stats') -> web.RouteDef:
+    """
+    Returns a route that answers with the statistics of every source as one JSON object.
+    :param sources: The functions returning the statistics, by name
+    """
+    async def stats(request: web.Request) -> web.Response:
+        return web.json_response({name: source() for name, source in sources.items()})
+    return web.get(path, stats)
+
+
+def metrics_route(registry: Registry = REGISTRY, path: str = '/metrics') -> web.RouteDef:
+    """
+    Returns a route that answers with the metrics of the process in the Prometheus text format.
+    """
+    async def metrics(request: web.Request) -> web.Response:
+        return web.Response(text=registry.render(), content_type='text/plain', charset='utf-8',
+                            headers={'X-Content-Type-Options': 'nosniff'})
+    return web.get(path, metrics)
+
+
+class WebServer:
+    """
+    HTTP front end that runs on the event loop of the Telegram bot.
+
+    Connections are kept alive between requests, at most `max_concurrency` requests are
+    handled at a time (the others wait up to `queue_timeout` seconds, then get a 503), and
+    `stop` lets in-flight requests finish for up to `shutdown_timeout` seconds.
+    """
+
+    def __init__(self, routes: List[web.RouteDef], host: str = '0.0.0.0', port: int = 5000,
+                 max_concurrency: int = 64, queue_timeout: float = 30.0, keepalive_timeout: float = 75.0,
+                 shutdown_timeout: float = 10.0):
+        """
+        :param routes: The routes of the applications served
+        :param host: The address to listen on
+        :param port: The port to listen on
+        :param max_concurrency: The maximum number of requests handled at the same time
+        :param queue_timeout: The number of seconds a request waits for a free slot
+        :param keepalive_timeout: The number of seconds an idle connection is kept open
+        :param shutdown_timeout: The number of seconds in-flight requests get to finish on shutdown
+        """
+        self.host = host
+        self.port = port
+        self.max_concurrency = max_concurrency
+        self.queue_timeout = queue_timeout
+        self.keepalive_timeout = keepalive_timeout
+        self.shutdown_timeout = shutdown_timeout
+        self.in_flight = 0
+        self.waiting = 0
+        self.rejected = 0
+
+        self.app = web.Application(middlewares=[self._limit_concurrency])
+        self.app.add_routes(routes)
+        self._slots: Optional[asyncio.Semaphore] = None
+        self._runner: Optional[web.AppRunner] = None
+
+    async def start(self):
+        """
+        Starts listening. Must be awaited on the loop the server will run on.
+        """
+        self._slots = asyncio.Semaphore(self.max_concurrency)
+        self._runner = web.AppRunner(self.app, keepalive_timeout=self.keepalive_timeout, access_log=None)
+        await self._runner.setup()
+        site = web.TCPSite(self._runner, self.host, self.port, shutdown_timeout=self.shutdown_timeout)
+        await site.start()
+        logging.info(f'Web API listening on {self.host}:{self.port}')
+
+    async def stop(self):
+        """
+        Stops accepting connections and waits for the in-flight requests.
+        """
+        if self._runner is not None:
+            await self._runner.cleanup()
+            self._runner = None
+
+    def stats(self) -> dict:
+        return {'in_flight': self.in_flight, 'waiting': self.waiting, 'rejected': self.rejected}
+
+    @web.middleware
+    async def _limit_concurrency(self, request: web.Request, handler):
+        self.waiting += 1
+        try:
+            await asyncio.wait_for(self._slots.acquire(), self.queue_timeout)
+        except asyncio.TimeoutError:
+            self.rejected += 1
+            raise web.HTTPServiceUnavailable(text="Too many requests in flight")
+        finally:
+            self.waiting -= 1
+
+        self.in_flight += 1
+        try:
+            return await handler(request)
+        finally:
+            self.in_flight -= 1
+            self._slots.release()
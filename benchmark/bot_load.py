@@ -0,0 +1,268 @@
+"""
+Replays conversations through the handlers of TelegramBotApp and reports throughput and latency.
+
+    python -m benchmark.bot_load --chats 50 --messages 10 --rate 20
+    python -m benchmark.bot_load --replay conversations.jsonl --latency 0.5 --tokens-per-second 30
+
+Telegram is replaced by an in-process fake client that answers sends and edits after a fixed
+latency, and OpenAI by the local streaming stub of benchmark.fake_openai, so nothing leaves the
+machine. Messages come from a JSONL file, one object per line with the message in `text` (or
+`body`, `title`), and optionally its `chat_id` and its arrival time `at` in seconds from the start;
+otherwise a seeded synthetic workload is generated. Messages without an arrival time arrive at
+`--rate` messages per second, as a Poisson process.
+
+Reported: messages answered per second, time until the first text of an answer was shown,
+time until it was complete (p50/p99), sends and edits per answer, and the memory grown by the
+process over the run.
+"""
+import argparse
+import asyncio
+import gc
+import json
+import random
+import resource
+import time
+from collections import defaultdict, deque
+from typing import Deque, Dict, List, Optional
+
+import openai
+
+from benchmark.fake_openai import FakeOpenAI
+from benchmark.history_bench import CONFIG, WORDS
+from core.openai_helper import AsyncOpenAIHelper
+from core.session_store import SessionStore
+from api.telegram.telegram_bot import TelegramBotApp
+
+BOT_CONFIG = {
+    'allowed_user_ids': '*',
+    'stream_edits': {'min_interval': 1.0, 'min_chars': 40, 'max_delay': 3.0},
+    'edit_budget': {'rate': 1.0, 'burst': 3},
+    'scheduler': {'max_in_flight': 8},
+    # Every replayed message is answered in full, as if the chat waited for the previous answer
+    'cancel_on_new_message': False,
+}
+
+
+class Request:
+    """
+    A message replayed to the bot, and what the fake client saw of its answer.
+    """
+    __slots__ = ('chat_id', 'text', 'at', 'started', 'first_visible', 'finished', 'sends', 'edits')
+
+    def __init__(self, chat_id: int, text: str, at: Optional[float]):
+        self.chat_id = chat_id
+        self.text = text
+        self.at = at
+        self.started = 0.0
+        self.first_visible: Optional[float] = None
+        self.finished: Optional[float] = None
+        self.sends = 0
+        self.edits = 0
+
+
+class FakeMessage:
+    def __init__(self, message_id: int, chat_id: int, text: str):
+        self.id = message_id
+        self.chat_id = chat_id
+        self.text = text
+
+
+class FakeChat:
+    def __init__(self, chat_id: int):
+        self.id = chat_id
+        self.username = f'user{chat_id}'
+
+
+class FakeEvent:
+    """
+    The parts of a NewMessage event the handlers use.
+    """
+
+    def __init__(self, client: 'FakeTelegramClient', request: Request, message_id: int):
+        self.client = client
+        self.chat = FakeChat(request.chat_id)
+        self.chat_id = request.chat_id
+        self.message = FakeMessage(message_id, request.chat_id, request.text)
+
+    async def reply(self, text: str):
+        return await self.client.send_message(self.chat_id, text, reply_to=self.message.id)
+
+
+class _Action:
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *exc_info):
+        return False
+
+
+class FakeTelegramClient:
+    """
+    Stands in for TelegramClient: sends and edits take `latency` seconds and are attributed to the
+    oldest unanswered request of their chat, since the bot answers the messages of a chat in order.
+    """
+
+    def __init__(self, latency: float = 0.05):
+        self.latency = latency
+        self.sends = 0
+        self.edits = 0
+        self.outstanding: Dict[int, Deque[Request]] = defaultdict(deque)
+        self._ids = 0
+
+    def action(self, entity, action, delay: float = 4):
+        return _Action()
+
+    async def send_message(self, entity, message: str = '', reply_to: Optional[int] = None, **kwargs):
+        await asyncio.sleep(self.latency)
+        chat_id = entity.id if hasattr(entity, 'id') else entity
+        self.sends += 1
+        request = self._current(chat_id)
+        if request is not None:
+            request.sends += 1
+            if request.first_visible is None:
+                request.first_visible = time.perf_counter()
+        self._ids += 1
+        return FakeMessage(self._ids, chat_id, message)
+
+    async def edit_message(self, entity, message=None, text=None, **kwargs):
+        await asyncio.sleep(self.latency)
+        self.edits += 1
+        entity.text = text if text is not None else message
+        request = self._current(entity.chat_id)
+        if request is not None:
+            request.edits += 1
+        return entity
+
+    def event(self, request: Request) -> FakeEvent:
+        self._ids += 1
+        self.outstanding[request.chat_id].append(request)
+        return FakeEvent(self, request, self._ids)
+
+    def done(self, request: Request):
+        self.outstanding[request.chat_id].remove(request)
+
+    def _current(self, chat_id: int) -> Optional[Request]:
+        queue = self.outstanding.get(chat_id)
+        return queue[0] if queue else None
+
+
+def load_requests(path: str) -> List[Request]:
+    requests = []
+    with open(path, encoding='utf-8') as file:
+        for number, line in enumerate(file):
+            if not line.strip():
+                continue
+            record = json.loads(line)
+            text = record.get('text') or record.get('body') or record.get('title') or ''
+            requests.append(Request(int(record.get('chat_id', number)), text, record.get('at')))
+    return requests
+
+
+def synthetic_requests(chats: int, messages: int, seed: int) -> List[Request]:
+    generator = random.Random(seed)
+    requests = [Request(chat_id, " ".join(generator.choice(WORDS) for _ in range(generator.randint(3, 40))), None)
+                for chat_id in range(chats) for _ in range(messages)]
+    generator.shuffle(requests)
+    return requests
+
+
+def schedule(requests: List[Request], rate: float, seed: int):
+    """
+    Gives the messages without an arrival time one, `rate` messages per second on average.
+    """
+    generator = random.Random(seed)
+    at = 0.0
+    for request in requests:
+        if request.at is None:
+            at += generator.expovariate(rate) if rate > 0 else 0.0
+            request.at = at
+    requests.sort(key=lambda request: request.at)
+
+
+def rss_mib() -> float:
+    """
+    Returns the resident memory of the process, read from /proc where available.
+    """
+    try:
+        with open('/proc/self/statm') as file:
+            return int(file.read().split()[1]) * resource.getpagesize() / 2 ** 20
+    except OSError:
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+
+def percentile(values: List[float], fraction: float) -> float:
+    if not values:
+        return 0.0
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * fraction))]
+
+
+async def replay(args, requests: List[Request]):
+    fake = FakeOpenAI(port=args.port, latency=args.latency, tokens_per_second=args.tokens_per_second,
+                      answer_tokens=args.answer_tokens)
+    await fake.start()
+    openai.api_base = fake.api_base
+    helper = AsyncOpenAIHelper(CONFIG, SessionStore(CONFIG['assistant_prompt'], CONFIG['model']))
+    client = FakeTelegramClient(latency=args.telegram_latency)
+    config = dict(BOT_CONFIG, scheduler={'max_in_flight': args.max_in_flight})
+    bot = TelegramBotApp(config, helper, client=client)
+
+    async def handle(request: Request):
+        await asyncio.sleep(max(0.0, request.at - (time.perf_counter() - start)))
+        request.started = time.perf_counter()
+        try:
+            await bot.prompt(client.event(request))
+        finally:
+            request.finished = time.perf_counter()
+            client.done(request)
+
+    gc.collect()
+    rss_before = rss_mib()
+    start = time.perf_counter()
+    try:
+        await asyncio.gather(*(handle(request) for request in requests))
+    finally:
+        elapsed = time.perf_counter() - start
+        await helper.close()
+        await fake.stop()
+    gc.collect()
+    rss_after = rss_mib()
+
+    answered = [request for request in requests if request.first_visible is not None]
+    first = [(request.first_visible - request.started) * 1000 for request in answered]
+    total = [(request.finished - request.started) * 1000 for request in answered]
+    updates = [request.sends + request.edits for request in answered]
+    sessions = helper.sessions.stats()
+    print(f"messages            {len(requests)} in {elapsed:.2f}s, {len(answered)} answered")
+    print(f"throughput          {len(answered) / elapsed:.1f} messages/s")
+    print(f"first text ms       p50 {percentile(first, 0.5):.0f}  p99 {percentile(first, 0.99):.0f}")
+    print(f"complete answer ms  p50 {percentile(total, 0.5):.0f}  p99 {percentile(total, 0.99):.0f}")
+    print(f"sends+edits/answer  avg {sum(updates) / max(len(updates), 1):.1f}  max {max(updates, default=0)}"
+          f"  ({client.sends} sends, {client.edits} edits)")
+    print(f"OpenAI requests     {fake.requests}")
+    print(f"memory              RSS {rss_before:.1f} -> {rss_after:.1f} MiB (+{rss_after - rss_before:.1f}), "
+          f"{sessions['sessions']} sessions holding {sessions['bytes'] / 1024:.0f} KiB of history")
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--replay', help='JSONL file of messages to replay')
+    parser.add_argument('--chats', type=int, default=50)
+    parser.add_argument('--messages', type=int, default=10, help='Messages per chat of the synthetic workload')
+    parser.add_argument('--rate', type=float, default=20.0, help='Messages per second, 0 to send them all at once')
+    parser.add_argument('--latency', type=float, default=0.3, help='Seconds before the first token')
+    parser.add_argument('--tokens-per-second', type=float, default=50.0)
+    parser.add_argument('--answer-tokens', type=int, default=100)
+    parser.add_argument('--telegram-latency', type=float, default=0.05, help='Seconds a send or edit takes')
+    parser.add_argument('--max-in-flight', type=int, default=8)
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--port', type=int, default=8768)
+    args = parser.parse_args()
+
+    requests = load_requests(args.replay) if args.replay else synthetic_requests(args.chats, args.messages, args.seed)
+    schedule(requests, args.rate, args.seed)
+    asyncio.run(replay(args, requests))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,83 @@
+"""
+Measures the time to build the body of a ChatCompletion request per turn, by history length.
+
+    python -m benchmark.encode_bench --lengths 10 100 1000
+
+For every length, a conversation starting with that many messages gets `--turns` more turns, and
+the body of the request of every turn is built the two ways:
+
+- rebuilt: the former way, a list of dicts of every message, serialised whole with `json.dumps`
+  and the tokens of every message counted again for the rate limiter
+- encoded: the new turn is encoded once when it is appended, the body is joined from the JSON the
+  history keeps and the tokens it counted (`ConversationHistory.encoded_messages`, core.wire)
+
+Both bodies are checked to decode to the same request.
+"""
+import argparse
+import json
+import random
+import time
+
+from benchmark.history_bench import CONFIG, WORDS
+from core.history import ConversationHistory
+from core.rate_limiter import request_tokens
+from core.wire import encode_request
+
+
+def conversation(length: int, words: int) -> ConversationHistory:
+    history = ConversationHistory(CONFIG['assistant_prompt'])
+    for index in range(length):
+        history.append('user' if index % 2 == 0 else 'assistant', " ".join(random.choices(WORDS, k=words)))
+    return history
+
+
+def request(messages) -> dict:
+    return dict(model=CONFIG['model'], messages=messages, temperature=CONFIG['temperature'], n=1,
+                max_tokens=CONFIG['max_tokens'], presence_penalty=0, frequency_penalty=0, stream=True)
+
+
+def rebuilt(history: ConversationHistory, query: str) -> bytes:
+    history.append('user', query)
+    params = request(history.messages)
+    request_tokens(params)
+    return json.dumps(params).encode()
+
+
+def encoded(history: ConversationHistory, query: str) -> bytes:
+    history.append('user', query)
+    params = request(history.encoded_messages())
+    request_tokens(params)
+    return encode_request(params)
+
+
+def run(length: int, args):
+    times = {}
+    for build in (rebuilt, encoded):
+        random.seed(args.seed)
+        history = conversation(length, args.words)
+        queries = [" ".join(random.choices(WORDS, k=args.words)) for _ in range(args.turns)]
+        started = time.perf_counter()
+        for query in queries:
+            body = build(history, query)
+        times[build.__name__] = (time.perf_counter() - started) / args.turns * 1e6
+        times[build.__name__ + '_body'] = body
+    assert json.loads(times['rebuilt_body']) == json.loads(times['encoded_body'])
+    print(f"{length:>8}{len(times['encoded_body']) / 1024:>12.1f}{times['rebuilt']:>14.1f}{times['encoded']:>14.1f}"
+          f"{times['rebuilt'] / times['encoded']:>10.1f}x")
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--lengths', type=int, nargs='+', default=[10, 100, 1000], help='Messages of the history')
+    parser.add_argument('--turns', type=int, default=200, help='Turns timed per length')
+    parser.add_argument('--words', type=int, default=40, help='Words per message')
+    parser.add_argument('--seed', type=int, default=0)
+    args = parser.parse_args()
+
+    print(f"{'messages':>8}{'body KiB':>12}{'rebuilt us':>14}{'encoded us':>14}{'speedup':>11}")
+    for length in args.lengths:
+        run(length, args)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,228 @@
+"""
+Local stand-in for the OpenAI API, used by the benchmarks.
+
+    python -m benchmark.fake_openai --port 8765 --latency 0.2 --tokens-per-second 50
+
+Point the bot at it with `openai.api_base = 'http://127.0.0.1:8765/v1'`.
+"""
+import argparse
+import asyncio
+import base64
+import json
+import math
+import random
+import time
+from collections import deque
+
+from aiohttp import web
+
+from core.rate_limiter import request_tokens
+
+WORDS = "the quick brown fox jumps over a lazy dog while seven wizards quietly hex every juror".split()
+
+
+class FakeOpenAI:
+    """
+    Serves `/v1/chat/completions`, streamed or not, after a fixed latency and at a fixed token rate,
+    `/v1/audio/transcriptions` after a latency proportional to the upload size, and
+    `/v1/images/generations` after `image_latency`, as base64 or as a URL to `/images/<id>.png`.
+
+    A `slow_ratio` share of the completions, drawn with a seeded generator, wait `slow_latency`
+    seconds instead of `latency`, to model a slow tail.
+
+    With `requests_per_minute` or `tokens_per_minute` set, requests over the quota of the last
+    `window` seconds are answered with a 429 and a Retry-After header, like the real API.
+    """
+
+    def __init__(self, host: str = '127.0.0.1', port: int = 8765, latency: float = 0.2,
+                 tokens_per_second: float = 50.0, answer_tokens: int = 20, audio_bytes_per_second: float = 2e6,
+                 requests_per_minute: int = None, tokens_per_minute: int = None, window: float = 60.0,
+                 slow_ratio: float = 0.0, slow_latency: float = None, seed: int = 0, image_latency: float = 2.0,
+                 image_bytes: int = 400 * 1024):
+        """
+        :param latency: Seconds before the first token (or the whole answer) is sent
+        :param tokens_per_second: The rate at which answer tokens are produced
+        :param answer_tokens: The number of tokens of every answer
+        :param audio_bytes_per_second: The rate at which uploaded audio is "transcribed"
+        :param requests_per_minute: The number of requests accepted per window, None means unlimited
+        :param tokens_per_minute: The number of tokens accepted per window, None means unlimited
+        :param window: The length of the quota window in seconds
+        :param slow_ratio: The share of completions that wait `slow_latency` instead of `latency`
+        :param slow_latency: Seconds before the first token of a slow completion
+        :param seed: Seeds the choice of the slow completions
+        :param image_latency: Seconds an image takes to generate
+        :param image_bytes: The size of every generated image
+        """
+        self.host = host
+        self.port = port
+        self.latency = latency
+        self.tokens_per_second = tokens_per_second
+        self.answer_tokens = answer_tokens
+        self.audio_bytes_per_second = audio_bytes_per_second
+        self.requests_per_minute = requests_per_minute
+        self.tokens_per_minute = tokens_per_minute
+        self.window = window
+        self.slow_ratio = slow_ratio
+        self.slow_latency = slow_latency
+        self._random = random.Random(seed)
+        self.rate_limited = 0
+        self.cancelled = 0
+        self._accepted = deque()  # (time, tokens) of the requests accepted in the window
+        self.uploads = []
+        self.image_latency = image_latency
+        self.image_bytes = image_bytes
+        self.images = {}
+        self.image_requests = 0
+        self.requests = 0
+        self.request_bytes = 0
+        self._runner = None
+
+    @property
+    def api_base(self) -> str:
+        return f'http://{self.host}:{self.port}/v1'
+
+    def app(self) -> web.Application:
+        app = web.Application(client_max_size=64 * 1024 * 1024)
+        app.router.add_post('/v1/chat/completions', self.chat_completions)
+        app.router.add_post('/v1/audio/transcriptions', self.transcriptions)
+        app.router.add_post('/v1/images/generations', self.image_generations)
+        app.router.add_get('/images/{id}.png', self.image_file)
+        return app
+
+    async def start(self):
+        self._runner = web.AppRunner(self.app(), access_log=None)
+        await self._runner.setup()
+        await web.TCPSite(self._runner, self.host, self.port).start()
+
+    async def stop(self):
+        if self._runner is not None:
+            await self._runner.cleanup()
+
+    def answer(self, n: int = None) -> list:
+        return [WORDS[i % len(WORDS)] + ' ' for i in range(n or self.answer_tokens)]
+
+    async def chat_completions(self, request: web.Request) -> web.StreamResponse:
+        raw = await request.read()
+        self.requests += 1
+        self.request_bytes += len(raw)
+        body = json.loads(raw)
+        limited = self.over_quota(request_tokens(body))
+        if limited is not None:
+            return limited
+        tokens = self.answer(min(body.get('max_tokens') or self.answer_tokens, self.answer_tokens))
+        choices = body.get('n') or 1
+
+        slow = self.slow_latency is not None and self._random.random() < self.slow_ratio
+        await asyncio.sleep(self.slow_latency if slow else self.latency)
+        if not body.get('stream'):
+            await asyncio.sleep(len(tokens) / self.tokens_per_second)
+            content = ''.join(tokens)
+            return web.json_response({
+                'id': f'chatcmpl-{self.requests}', 'object': 'chat.completion', 'created': int(time.time()),
+                'model': body.get('model'),
+                'choices': [{'index': i, 'message': {'role': 'assistant', 'content': content},
+                             'finish_reason': 'stop'} for i in range(choices)],
+                'usage': {'prompt_tokens': 0, 'completion_tokens': len(tokens), 'total_tokens': len(tokens)},
+            })
+
+        response = web.StreamResponse(headers={'Content-Type': 'text/event-stream'})
+        try:
+            await response.prepare(request)
+            for token in tokens:
+                for i in range(choices):
+                    chunk = {'id': f'chatcmpl-{self.requests}', 'object': 'chat.completion.chunk',
+                             'model': body.get('model'),
+                             'choices': [{'index': i, 'delta': {'content': token}, 'finish_reason': None}]}
+                    await response.write(f'data: {json.dumps(chunk)}\n\n'.encode())
+                await asyncio.sleep(1 / self.tokens_per_second)
+            await response.write(b'data: [DONE]\n\n')
+            await response.write_eof()
+        except ConnectionResetError:
+            # The client stopped reading, e.g. a cancelled hedged request
+            self.cancelled += 1
+        return response
+
+    def over_quota(self, tokens: int = 0):
+        """
+        Accepts a request into the quota window, or returns the 429 response if it does not fit.
+        """
+        now = time.monotonic()
+        while self._accepted and self._accepted[0][0] <= now - self.window:
+            self._accepted.popleft()
+        used = sum(accepted for _, accepted in self._accepted)
+        if self.requests_per_minute and len(self._accepted) >= self.requests_per_minute:
+            kind, retry_after = 'requests', self._accepted[0][0] + self.window - now
+        elif self.tokens_per_minute and self._accepted and used + tokens > self.tokens_per_minute:
+            kind, retry_after = 'tokens', self._accepted[0][0] + self.window - now
+        else:
+            self._accepted.append((now, tokens))
+            return None
+        self.rate_limited += 1
+        return web.json_response(
+            {'error': {'message': f'Rate limit reached for {kind} per minute', 'type': kind,
+                       'param': None, 'code': 'rate_limit_exceeded'}},
+            status=429, headers={'Retry-After': str(math.ceil(retry_after * 1000) / 1000)})
+
+    async def transcriptions(self, request: web.Request) -> web.Response:
+        self.requests += 1
+        limited = self.over_quota()
+        if limited is not None:
+            return limited
+        size, filename = 0, None
+        reader = await request.multipart()
+        async for part in reader:
+            if part.name == 'file':
+                filename = part.filename
+                while True:
+                    chunk = await part.read_chunk()
+                    if not chunk:
+                        break
+                    size += len(chunk)
+        self.request_bytes += size
+        self.uploads.append((filename, size))
+        await asyncio.sleep(self.latency + size / self.audio_bytes_per_second)
+        return web.json_response({'text': f'{filename}: {size} bytes of speech'})
+
+
+    async def image_generations(self, request: web.Request) -> web.Response:
+        body = await request.json()
+        self.requests += 1
+        self.image_requests += 1
+        await asyncio.sleep(self.image_latency)
+        image = b'\x89PNG\r\n\x1a\n' + random.randbytes(self.image_bytes - 8)
+        if body.get('response_format') == 'b64_json':
+            return web.json_response({'created': int(time.time()), 'data': [{'b64_json': base64.b64encode(image).decode()}]})
+        self.images[str(self.image_requests)] = image
+        url = f'http://{self.host}:{self.port}/images/{self.image_requests}.png'
+        return web.json_response({'created': int(time.time()), 'data': [{'url': url}]})
+
+    async def image_file(self, request: web.Request) -> web.Response:
+        image = self.images.get(request.match_info['id'])
+        if image is None:
+            raise web.HTTPNotFound()
+        return web.Response(body=image, content_type='image/png')
+
+
+async def serve(fake: FakeOpenAI):
+    await fake.start()
+    print(f'Fake OpenAI API at {fake.api_base}')
+    await asyncio.Event().wait()
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=8765)
+    parser.add_argument('--latency', type=float, default=0.2)
+    parser.add_argument('--tokens-per-second', type=float, default=50.0)
+    parser.add_argument('--answer-tokens', type=int, default=20)
+    parser.add_argument('--requests-per-minute', type=int)
+    parser.add_argument('--tokens-per-minute', type=int)
+    args = parser.parse_args()
+    asyncio.run(serve(FakeOpenAI(args.host, args.port, args.latency, args.tokens_per_second, args.answer_tokens,
+                                 requests_per_minute=args.requests_per_minute,
+                                 tokens_per_minute=args.tokens_per_minute)))
+
+
+if __name__ == '__main__':
+    main()
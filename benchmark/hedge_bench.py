@@ -0,0 +1,73 @@
+"""
+Time to first token of streamed answers with and without hedged requests, against a slow tail.
+
+    python -m benchmark.hedge_bench --requests 200 --latency 0.2 --slow-ratio 0.1 --slow-latency 2
+
+The local stub of benchmark.fake_openai answers a `--slow-ratio` share of completions after
+`--slow-latency` seconds instead of `--latency`. Every case streams the same number of answers,
+`--concurrency` at a time, and reports the time to the first token (p50/p99/max) and the number of
+completions requested upstream.
+"""
+import argparse
+import asyncio
+import time
+
+import openai
+
+from benchmark.bot_load import percentile
+from benchmark.fake_openai import FakeOpenAI
+from benchmark.history_bench import CONFIG
+from core.openai_helper import AsyncOpenAIHelper
+
+
+async def run_case(name: str, args, hedge: dict):
+    fake = FakeOpenAI(port=args.port, latency=args.latency, tokens_per_second=200, answer_tokens=20,
+                      slow_ratio=args.slow_ratio, slow_latency=args.slow_latency, seed=args.seed)
+    await fake.start()
+    openai.api_base = fake.api_base
+    helper = AsyncOpenAIHelper(dict(CONFIG, hedge=hedge))
+    semaphore = asyncio.Semaphore(args.concurrency)
+    firsts = []
+
+    async def ask(chat_id: int):
+        async with semaphore:
+            start = time.perf_counter()
+            response = await helper.get_chat_response(chat_id, 'assistant', 'hello there', stream=True)
+            first = None
+            async for _ in response:
+                if first is None:
+                    first = time.perf_counter() - start
+            firsts.append(first)
+
+    try:
+        await asyncio.gather(*(ask(chat_id) for chat_id in range(args.requests)))
+    finally:
+        await helper.close()
+        await fake.stop()
+    print(f"{name:<26}{percentile(firsts, 0.5) * 1000:>8.0f}{percentile(firsts, 0.99) * 1000:>8.0f}"
+          f"{max(firsts) * 1000:>8.0f}{fake.requests / args.requests:>14.2f}")
+
+
+async def run(args):
+    print(f"{'case':<26}{'p50 ms':>8}{'p99 ms':>8}{'max ms':>8}{'upstream/req':>14}")
+    await run_case('single request', args, {})
+    await run_case(f'hedged after {args.hedge_delay}s', args,
+                   {'models': [CONFIG['model']], 'delay': args.hedge_delay})
+    await run_case('hedged x2 at once', args, {'models': [CONFIG['model']], 'delay': 0})
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--requests', type=int, default=200)
+    parser.add_argument('--concurrency', type=int, default=20)
+    parser.add_argument('--latency', type=float, default=0.2)
+    parser.add_argument('--slow-ratio', type=float, default=0.1)
+    parser.add_argument('--slow-latency', type=float, default=2.0)
+    parser.add_argument('--hedge-delay', type=float, default=0.4)
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--port', type=int, default=8773)
+    asyncio.run(run(parser.parse_args()))
+
+
+if __name__ == '__main__':
+    main()
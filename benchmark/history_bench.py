@@ -0,0 +1,84 @@
+"""
+Replays a long synthetic conversation through OpenAIHelper and reports the prompt size of every request.
+
+    python -m benchmark.history_bench --turns 1000
+
+No network is used: `openai.ChatCompletion.create` is replaced with a fake that answers every
+query (and every summary request) with a fixed-size text and records the prompt it was sent.
+"""
+import argparse
+import random
+import time
+
+import openai
+
+from core.history import TOKENS_PER_MESSAGE, TOKENS_PER_REPLY, count_tokens
+from core.openai_helper import OpenAIHelper
+
+CONFIG = {
+    'api_key': 'sk-benchmark',
+    'proxy': None,
+    'show_usage': False,
+    'model': 'gpt-3.5-turbo',
+    'assistant_prompt': 'You are a helpful assistant.',
+    'temperature': 1,
+    'n_choices': 1,
+    'max_tokens': 1200,
+    'presence_penalty': 0,
+    'frequency_penalty': 0,
+    'image_size': '512x512',
+}
+
+WORDS = "the quick brown fox jumps over a lazy dog while seven wizards quietly hex every juror".split()
+
+
+class FakeChatCompletion:
+
+    def __init__(self, answer_words: int):
+        self.answer_words = answer_words
+        self.prompt_tokens = []
+
+    def create(self, model, messages, **kwargs):
+        tokens = TOKENS_PER_REPLY + sum(TOKENS_PER_MESSAGE + count_tokens(m['content'], model) for m in messages)
+        content = " ".join(random.choice(WORDS) for _ in range(self.answer_words))
+        if messages[0]['content'].startswith('Summarise'):
+            content = content[:400]
+        else:
+            self.prompt_tokens.append(tokens)
+        return openai.openai_object.OpenAIObject.construct_from({
+            'choices': [{'message': {'role': 'assistant', 'content': content}}],
+            'usage': {'total_tokens': tokens, 'prompt_tokens': tokens, 'completion_tokens': 0},
+        })
+
+
+def run(turns: int, summarise: bool, answer_words: int):
+    random.seed(0)
+    fake = FakeChatCompletion(answer_words)
+    openai.ChatCompletion.create = fake.create
+    helper = OpenAIHelper(dict(CONFIG, summarise_history=summarise))
+
+    start = time.perf_counter()
+    for turn in range(turns):
+        query = " ".join(random.choice(WORDS) for _ in range(random.randint(5, 60)))
+        helper.get_chat_response(chat_id=1, function="assistant", query=query)
+    elapsed = time.perf_counter() - start
+    return fake.prompt_tokens, elapsed
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--turns', type=int, default=1000)
+    parser.add_argument('--answer-words', type=int, default=80)
+    args = parser.parse_args()
+
+    checkpoints = [t for t in (1, 10, 100, 500, 1000, args.turns) if t <= args.turns]
+    checkpoints = sorted(set(checkpoints))
+    print(f"{'mode':<10}" + "".join(f"{'turn ' + str(t):>12}" for t in checkpoints) + f"{'max':>10}{'ms/turn':>10}")
+    for mode, summarise in (('trim', False), ('summarise', True)):
+        prompt_tokens, elapsed = run(args.turns, summarise, args.answer_words)
+        row = "".join(f"{prompt_tokens[t - 1]:>12}" for t in checkpoints)
+        print(f"{mode:<10}{row}{max(prompt_tokens):>10}{elapsed * 1000 / args.turns:>10.3f}")
+
+
+if __name__ == '__main__':
+    main()
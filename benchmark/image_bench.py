@@ -0,0 +1,116 @@
+"""
+Measures the latency of /image against the local stub of benchmark.fake_openai.
+
+    python -m benchmark.image_bench --prompts 10 --image-latency 2 --image-kb 400
+
+Scenarios, each with the handler of TelegramBotApp and a fake Telegram client:
+
+- url: the former path, `generate_image` returns a URL which Telegram then downloads from the
+  image API (here the bot downloads it, standing in for Telegram)
+- cold: `/image` with distinct prompts, the image comes back in the response and is uploaded from memory
+- cached: the same prompts again, read back from the disk cache
+- identical: `--concurrent` chats sending the same new prompt at once, generated only once
+- one chat: one chat sending `--concurrent` new prompts at once, beyond `image_max_in_flight`
+
+Reported: the requests, the image requests the stub received, the images sent, and the time
+until the image was sent or refused (p50/p99).
+"""
+import argparse
+import asyncio
+import tempfile
+import time
+
+import aiohttp
+import openai
+
+from benchmark.bot_load import BOT_CONFIG, FakeTelegramClient, Request, percentile
+from benchmark.fake_openai import FakeOpenAI
+from benchmark.history_bench import CONFIG
+from core.openai_helper import AsyncOpenAIHelper
+from api.telegram.telegram_bot import TelegramBotApp
+
+
+class ImageClient(FakeTelegramClient):
+    def __init__(self, latency: float):
+        super().__init__(latency)
+        self.files = 0
+
+    async def send_file(self, entity, file, **kwargs):
+        file.read()
+        self.files += 1
+        await asyncio.sleep(self.latency)
+
+
+async def timed(coroutine) -> float:
+    started = time.perf_counter()
+    await coroutine
+    return (time.perf_counter() - started) * 1000
+
+
+async def url_image(helper: AsyncOpenAIHelper, client: ImageClient, session: aiohttp.ClientSession, prompt: str):
+    url = await helper.generate_image(prompt)
+    # The URL is sent, then fetched by Telegram
+    await asyncio.sleep(client.latency)
+    async with session.get(url) as response:
+        await response.read()
+    client.files += 1
+
+
+def report(name: str, latencies: list, fake: FakeOpenAI, client: ImageClient, before: tuple):
+    print(f"{name:<12}{len(latencies):>10}{fake.image_requests - before[0]:>16}{client.files - before[1]:>8}"
+          f"{percentile(latencies, 0.5):>10.0f}{percentile(latencies, 0.99):>10.0f}")
+
+
+async def run(args):
+    fake = FakeOpenAI(port=args.port, image_latency=args.image_latency, image_bytes=args.image_kb * 1024)
+    await fake.start()
+    openai.api_base = fake.api_base
+    with tempfile.TemporaryDirectory() as directory:
+        helper = AsyncOpenAIHelper(dict(CONFIG, image_cache={'path': directory}))
+        client = ImageClient(args.telegram_latency)
+        bot = TelegramBotApp(BOT_CONFIG, helper, client=client)
+        prompts = [f'a watercolour of fox number {index}' for index in range(args.prompts)]
+        print(f"{'scenario':<12}{'requests':>10}{'image requests':>16}{'sent':>8}{'p50 ms':>10}{'p99 ms':>10}")
+        try:
+            before = (fake.image_requests, client.files)
+            async with aiohttp.ClientSession() as session:
+                latencies = [await timed(url_image(helper, client, session, prompt)) for prompt in prompts]
+            report('url', latencies, fake, client, before)
+
+            for name in ('cold', 'cached'):
+                before = (fake.image_requests, client.files)
+                latencies = [await timed(bot.image(client.event(Request(index, f'/image {prompt}', 0))))
+                             for index, prompt in enumerate(prompts)]
+                report(name, latencies, fake, client, before)
+
+            before = (fake.image_requests, client.files)
+            latencies = await asyncio.gather(*[
+                timed(bot.image(client.event(Request(chat_id, '/image the same lighthouse at dusk', 0))))
+                for chat_id in range(args.concurrent)])
+            report('identical', latencies, fake, client, before)
+
+            before = (fake.image_requests, client.files)
+            latencies = await asyncio.gather(*[
+                timed(bot.image(client.event(Request(0, f'/image a lighthouse number {index}', 0))))
+                for index in range(args.concurrent)])
+            report('one chat', latencies, fake, client, before)
+            print(f"image cache {helper.image_cache.stats()}")
+        finally:
+            await helper.close()
+            await fake.stop()
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--prompts', type=int, default=10)
+    parser.add_argument('--concurrent', type=int, default=8, help='Requests sent at once by the identical and one chat scenarios')
+    parser.add_argument('--image-latency', type=float, default=2.0, help='Seconds an image takes to generate')
+    parser.add_argument('--image-kb', type=int, default=400, help='Size of every image')
+    parser.add_argument('--telegram-latency', type=float, default=0.05, help='Seconds a send takes')
+    parser.add_argument('--port', type=int, default=8781)
+    args = parser.parse_args()
+    asyncio.run(run(args))
+
+
+if __name__ == '__main__':
+    main()
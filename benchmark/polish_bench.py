@@ -0,0 +1,157 @@
+"""
+Measures how long the assistant reply to an English message waits for the polish of that message.
+
+    python -m benchmark.polish_bench --messages 50 --latency 0.5 --telegram-latency 0.1
+
+Every message goes through a handler decorated with `TelegramUserApp.polish_api`, and the time
+until the handler starts is reported:
+
+- inline: the former behaviour, the polish completion, the search of the latest messages and
+  the edit all run before the handler
+- background: the polish runs as a task next to the handler, and edits the message by the id
+  the user account saw it sent with
+
+The user account is a fake client whose calls each take `--telegram-latency` seconds, and OpenAI
+the local stub of benchmark.fake_openai.
+"""
+import argparse
+import asyncio
+import time
+
+import openai
+from telethon.events import NewMessage
+
+from benchmark.bot_load import percentile
+from benchmark.fake_openai import FakeOpenAI
+from benchmark.history_bench import CONFIG
+from core.openai_helper import AsyncOpenAIHelper
+from api.telegram.telegram_user import TelegramUserApp
+
+BOT_ID = 1000
+USER_ID = 2000
+USER_CONFIG = {'token': f'{BOT_ID}:fake'}
+
+
+class FakeMessage:
+    def __init__(self, message_id: int, text: str):
+        self.id = message_id
+        self.text = text
+        self.out = True
+
+
+class FakeEvent(NewMessage.Event):
+    """
+    A NewMessage event without a client behind it, as polish_api only accepts Telethon events.
+    """
+    chat_id = property(lambda self: self._chat_id)
+    sender_id = property(lambda self: USER_ID)
+
+    def __init__(self, chat_id: int, message: FakeMessage):
+        self.__dict__.update(_init=True, _chat_id=chat_id, message=message)
+
+
+class FakeUserClient:
+    """
+    The calls of the user account polish makes, each taking `latency` seconds.
+    """
+
+    def __init__(self, latency: float):
+        self.latency = latency
+        self.calls = 0
+        self.messages = []
+        self.handlers = []
+
+    def on(self, event):
+        def register(handler):
+            self.handlers.append(handler)
+            return handler
+        return register
+
+    async def get_me(self):
+        return await self._call(type('User', (), {'id': USER_ID})())
+
+    async def get_entity(self, peer):
+        return await self._call(peer)
+
+    async def get_input_entity(self, peer):
+        return await self._call(peer)
+
+    async def iter_messages(self, entity, limit: int = 10):
+        await self._call()
+        for message in reversed(self.messages[-limit:]):
+            yield message
+
+    async def edit_message(self, entity, message, text=None):
+        return await self._call(message)
+
+    async def _call(self, result=None):
+        self.calls += 1
+        await asyncio.sleep(self.latency)
+        return result
+
+
+class Bot:
+    def __init__(self, telegram_user_app: TelegramUserApp):
+        self.telegram_user_app = telegram_user_app
+        self.waits = []
+
+    async def handler(self, event: NewMessage.Event, sent: float):
+        self.waits.append(time.perf_counter() - sent)
+
+    prompt = TelegramUserApp.polish_api(handler)
+
+
+async def run_mode(mode: str, args, helper: AsyncOpenAIHelper) -> None:
+    client = FakeUserClient(args.telegram_latency)
+    app = TelegramUserApp(USER_CONFIG, helper, client=client, owner_id=USER_ID)
+    bot = Bot(app)
+
+    for index in range(args.messages):
+        text = f'Message number {index} that i has wrote quick'
+        client.messages.append(FakeMessage(index, text))
+        if mode == 'background':
+            # The user account sees its own message go out before the bot receives it
+            await app._remember_sent(FakeEvent(BOT_ID, FakeMessage(index, text)))
+        event = FakeEvent(USER_ID, FakeMessage(10000 + index, text))
+
+        sent = time.perf_counter()
+        if mode == 'inline':
+            await app._polish_do(event)
+            await bot.handler(event, sent)
+        else:
+            await bot.prompt(event, sent)
+    await asyncio.gather(*app._tasks)
+
+    print(f"{mode:<12}{percentile(bot.waits, 0.5) * 1000:>10.1f}{percentile(bot.waits, 0.99) * 1000:>10.1f}"
+          f"{client.calls / args.messages:>16.1f}")
+
+
+async def run(args):
+    fake = FakeOpenAI(port=args.port, latency=args.latency, tokens_per_second=args.tokens_per_second)
+    await fake.start()
+    openai.api_base = fake.api_base
+    # A fresh helper per mode, so that the second mode is not answered from the response cache
+    print(f"{'mode':<12}{'p50 ms':>10}{'p99 ms':>10}{'user calls/msg':>16}")
+    try:
+        for mode in ('inline', 'background'):
+            helper = AsyncOpenAIHelper(CONFIG)
+            try:
+                await run_mode(mode, args, helper)
+            finally:
+                await helper.close()
+    finally:
+        await fake.stop()
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--messages', type=int, default=50)
+    parser.add_argument('--latency', type=float, default=0.5, help='Seconds before the polish completion starts')
+    parser.add_argument('--tokens-per-second', type=float, default=50.0)
+    parser.add_argument('--telegram-latency', type=float, default=0.1, help='Seconds a user account call takes')
+    parser.add_argument('--port', type=int, default=8772)
+    asyncio.run(run(parser.parse_args()))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,82 @@
+"""
+Drives the OpenAI rate limiter against a local fake API that enforces a quota.
+
+    python -m benchmark.rate_limit_bench --requests 120 --rpm 20 --tpm 20000 --window 2
+
+A burst of stateless queries is sent through AsyncOpenAIHelper to a fake endpoint (see
+benchmark.fake_openai) that answers requests over its quota with a 429 and a Retry-After hint.
+The same burst is sent twice: once with the limiter only retrying (no quota configured on the
+client), once with the client also pacing itself to the quota. The queries, their sizes and the
+backoff jitter are all seeded, so every run sends the same workload. A window of a few seconds
+stands in for the minute of the real quota.
+"""
+import argparse
+import asyncio
+import random
+import time
+
+import openai
+
+from benchmark.fake_openai import FakeOpenAI
+from benchmark.history_bench import CONFIG, WORDS
+from core.openai_helper import AsyncOpenAIHelper
+
+
+def queries(count: int, seed: int) -> list:
+    generator = random.Random(seed)
+    return [" ".join(generator.choice(WORDS) for _ in range(generator.randint(5, 200))) for _ in range(count)]
+
+
+async def run_case(name: str, args, rate_limit: dict) -> None:
+    fake = FakeOpenAI(port=args.port, latency=0.05, tokens_per_second=1000, answer_tokens=20,
+                      requests_per_minute=args.rpm, tokens_per_minute=args.tpm, window=args.window)
+    await fake.start()
+    openai.api_base = fake.api_base
+    helper = AsyncOpenAIHelper(dict(CONFIG, max_tokens=args.max_tokens, rate_limit=rate_limit))
+
+    async def query(text: str):
+        try:
+            await helper.get_stateless_response('assistant', text)
+            return True
+        except openai.error.OpenAIError:
+            return False
+
+    start = time.perf_counter()
+    try:
+        results = await asyncio.gather(*(query(text) for text in queries(args.requests, args.seed)))
+    finally:
+        await helper.close()
+        await fake.stop()
+    elapsed = time.perf_counter() - start
+
+    stats = helper.rate_limiter.stats()
+    accepted = fake.requests - fake.rate_limited
+    print(f"{name:<10}{sum(results):>6}/{len(results):<6}{fake.rate_limited:>8}{stats['retries']:>9}"
+          f"{stats['delayed']:>9}{elapsed:>10.2f}{accepted / elapsed * args.window:>16.1f}")
+
+
+async def run(args):
+    print(f"quota: {args.rpm} requests and {args.tpm} tokens per {args.window}s window")
+    print(f"{'client':<10}{'succeeded':>12}{'429s':>8}{'retries':>9}{'delayed':>9}{'elapsed s':>10}"
+          f"{'req per window':>16}")
+    retry_only = dict(max_retries=args.max_retries, base_delay=args.window / 10, max_delay=args.window,
+                      window=args.window, seed=args.seed)
+    await run_case('retry', args, retry_only)
+    await run_case('paced', args, dict(retry_only, requests_per_minute=args.rpm, tokens_per_minute=args.tpm))
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--requests', type=int, default=120)
+    parser.add_argument('--rpm', type=int, default=20)
+    parser.add_argument('--tpm', type=int, default=20000)
+    parser.add_argument('--window', type=float, default=2.0)
+    parser.add_argument('--max-tokens', type=int, default=500)
+    parser.add_argument('--max-retries', type=int, default=5)
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--port', type=int, default=8767)
+    asyncio.run(run(parser.parse_args()))
+
+
+if __name__ == '__main__':
+    main()
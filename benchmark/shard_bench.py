@@ -0,0 +1,122 @@
+"""
+Measures how the throughput of the bot scales with the number of worker processes of a ShardedDispatcher.
+
+    python -m benchmark.shard_bench --workers 1 2 4 --chats 64 --messages 5
+
+For every worker count, the synthetic conversations of benchmark.bot_load are handed by chat to
+the workers at once. Each worker answers them with a TelegramBotApp of its own, through a fake
+Telegram client and its own local OpenAI stub (benchmark.fake_openai), whose streamed answers it
+parses like real ones, so that the work of a worker grows with the messages it is given.
+
+Reported: messages answered per second, the time from dispatch to the answer (p50/p99), and
+the messages of a chat that finished before an earlier message of the same chat, which should
+always be 0. Scaling needs as many free cores as workers.
+"""
+import argparse
+import asyncio
+import os
+import threading
+import time
+from collections import defaultdict
+
+import openai
+
+from benchmark.bot_load import BOT_CONFIG, FakeChat, FakeTelegramClient, percentile, synthetic_requests
+from benchmark.fake_openai import FakeOpenAI
+from benchmark.history_bench import CONFIG
+from core.dispatcher import ShardedDispatcher, Update
+from core.openai_helper import AsyncOpenAIHelper
+from api.telegram.bot_worker import BotWorker
+from api.telegram.telegram_bot import TelegramBotApp
+
+
+class WorkerClient(FakeTelegramClient):
+    async def get_entity(self, chat_id: int) -> FakeChat:
+        return FakeChat(chat_id)
+
+
+def bench_worker(index: int, inbox, done, options: dict):
+    asyncio.run(_serve(index, inbox, done, options))
+
+
+async def _serve(index: int, inbox, done, options: dict):
+    fake = FakeOpenAI(port=options['port'] + index, latency=options['latency'],
+                      tokens_per_second=options['tokens_per_second'], answer_tokens=options['answer_tokens'])
+    await fake.start()
+    openai.api_base = fake.api_base
+    helper = AsyncOpenAIHelper(CONFIG)
+    # Edits are not paced, so that a worker is bound by its own work rather than by the flood limits
+    config = dict(BOT_CONFIG, scheduler={'max_in_flight': options['max_in_flight']},
+                  stream_edits={'min_interval': 0.0, 'min_chars': 200, 'max_delay': 0.0},
+                  edit_budget={'rate': 1000.0, 'burst': 1000})
+    bot = TelegramBotApp(config, helper, client=WorkerClient(options['telegram_latency']))
+    try:
+        await BotWorker(index, bot).serve(inbox, done)
+    finally:
+        await helper.close()
+        await fake.stop()
+
+
+def run(workers: int, args) -> None:
+    finished = {}
+    all_done = threading.Event()
+    expected = [workers]
+
+    def on_done(handled):
+        finished[handled[1]] = handled[2]
+        if len(finished) >= expected[0]:
+            all_done.set()
+
+    dispatcher = ShardedDispatcher(workers, bench_worker, (vars(args),), on_done=on_done)
+    dispatcher.start()
+    try:
+        # One update per worker first, so that the start of the processes is not measured
+        for index in range(workers):
+            dispatcher.dispatch(Update('get_mode', index, -1 - index, '/mode'))
+        all_done.wait()
+        finished.clear()
+        all_done.clear()
+
+        requests = synthetic_requests(args.chats, args.messages, args.seed)
+        expected[0] = len(requests)
+        updates = [Update('prompt', request.chat_id, message_id, request.text)
+                   for message_id, request in enumerate(requests)]
+        started = time.perf_counter()
+        for update in updates:
+            dispatcher.dispatch(update)
+        all_done.wait()
+        elapsed = max(finished.values()) - started
+    finally:
+        dispatcher.stop()
+
+    latencies = [(finished[update.message_id] - update.received) * 1000 for update in updates]
+    chats = defaultdict(list)
+    for update in updates:
+        chats[update.chat_id].append(finished[update.message_id])
+    out_of_order = sum(later < earlier for times in chats.values() for earlier, later in zip(times, times[1:]))
+    print(f"{workers:>8}{len(updates) / elapsed:>14.1f}{percentile(latencies, 0.5):>10.0f}"
+          f"{percentile(latencies, 0.99):>10.0f}{out_of_order:>14}")
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--workers', type=int, nargs='+', default=[1, 2, 4])
+    parser.add_argument('--chats', type=int, default=64)
+    parser.add_argument('--messages', type=int, default=5, help='Messages per chat')
+    parser.add_argument('--latency', type=float, default=0.05, help='Seconds before the first token')
+    parser.add_argument('--tokens-per-second', type=float, default=2000.0)
+    parser.add_argument('--answer-tokens', type=int, default=300)
+    parser.add_argument('--telegram-latency', type=float, default=0.01, help='Seconds a send or edit takes')
+    parser.add_argument('--max-in-flight', type=int, default=32, help='Answers generated at a time per worker')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--port', type=int, default=8780, help='The port of the stub of the first worker')
+    args = parser.parse_args()
+
+    print(f"{os.cpu_count()} cores")
+    print(f"{'workers':>8}{'messages/s':>14}{'p50 ms':>10}{'p99 ms':>10}{'out of order':>14}")
+    for workers in args.workers:
+        run(workers, args)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,163 @@
+"""
+Measures how long the bot takes to start: the import of main.py, and the time until the first
+message waiting for the bot is answered.
+
+    python -m benchmark.startup_bench --bot-connect 0.5 --user-connect 5 --timeout 2
+
+The import is timed in a fresh interpreter with `-X importtime`, reporting the heaviest packages
+and whether the optional ones (pydub, cherrypy, the web API) were loaded.
+
+Startup is replayed with fake Telegram clients that take `--bot-connect` and `--user-connect`
+seconds to log in (`--user-connect -1` never does, like an unreachable proxy), and OpenAI replaced
+by the local stub of benchmark.fake_openai:
+
+- sequential: the former order, the user account logs in, then the bot, then the handlers are registered
+- concurrent: `main.start`, both clients log in at the same time and the handlers are registered
+  first, the user account is given up on after `--timeout` seconds
+"""
+import argparse
+import asyncio
+import re
+import subprocess
+import sys
+import time
+
+import openai
+
+from benchmark.bot_load import BOT_CONFIG, FakeTelegramClient, Request
+from benchmark.fake_openai import FakeOpenAI
+from benchmark.history_bench import CONFIG
+from benchmark.polish_bench import USER_CONFIG, FakeUserClient
+from core.openai_helper import AsyncOpenAIHelper
+from api.telegram.telegram_bot import TelegramBotApp
+from api.telegram.telegram_user import TelegramUserApp
+from main import start
+
+OPTIONAL_MODULES = ('pydub', 'cherrypy', 'api.web.server')
+
+
+async def _connect(seconds: float):
+    if seconds < 0:
+        await asyncio.Event().wait()
+    await asyncio.sleep(seconds)
+
+
+class FakeBotClient(FakeTelegramClient):
+    def __init__(self, connect: float, latency: float):
+        super().__init__(latency)
+        self.connect = connect
+        self.handlers = []
+
+    def on(self, event):
+        def register(handler):
+            self.handlers.append(handler)
+            return handler
+        return register
+
+    async def start(self, **kwargs):
+        await _connect(self.connect)
+
+    async def disconnect(self):
+        pass
+
+
+class FakeLoginUserClient(FakeUserClient):
+    def __init__(self, connect: float, latency: float):
+        super().__init__(latency)
+        self.connect_seconds = connect
+
+    async def connect(self):
+        await _connect(self.connect_seconds)
+
+    async def is_user_authorized(self):
+        return True
+
+    async def disconnect(self):
+        pass
+
+
+def import_times():
+    """
+    Imports main.py in a fresh interpreter and prints its import time and the heaviest packages.
+    """
+    code = f"import sys, main; print([name for name in {OPTIONAL_MODULES!r} if name in sys.modules])"
+    result = subprocess.run([sys.executable, '-X', 'importtime', '-c', code], capture_output=True, text=True)
+    packages = {}
+    for line in result.stderr.splitlines():
+        match = re.match(r'import time:\s+\d+ \|\s+(\d+) \|( *)(\S+)', line)
+        if match and len(match.group(2)) <= 3:
+            packages[match.group(3)] = int(match.group(1)) / 1000
+    print(f"import main          {packages.get('main', 0):.0f} ms")
+    heaviest = sorted(((ms, name) for name, ms in packages.items() if name != 'main'), reverse=True)[:6]
+    print("heaviest imports     " + ", ".join(f"{name} {ms:.0f} ms" for ms, name in heaviest))
+    print(f"optional loaded      {result.stdout.strip() or result.stderr.strip()[-200:]}")
+
+
+async def run_mode(mode: str, args, helper: AsyncOpenAIHelper):
+    started = time.perf_counter()
+    bot_client = FakeBotClient(args.bot_connect, args.telegram_latency)
+    user_app = TelegramUserApp(USER_CONFIG, helper, client=FakeLoginUserClient(args.user_connect, args.telegram_latency))
+    bot = TelegramBotApp(dict(BOT_CONFIG, token='fake'), helper, client=bot_client)
+    bot.add_decorator(telegram_user_app=user_app)
+    # A given client is taken as logged in, this one logs in with `start`
+    user_app.ready = False
+    # The message was sent while the bot was down, Telegram delivers it once the bot is connected
+    request = Request(1, 'Hello there, how are you?', 0.0)
+
+    user = None
+    if mode == 'sequential':
+        await user_app.start()
+        await bot.start()
+    else:
+        user = await start(bot, user_app, None, args.timeout)
+    ready = time.perf_counter() - started
+
+    prompt = next(handler for handler in bot_client.handlers if handler == bot.prompt)
+    request.started = time.perf_counter()
+    await prompt(bot_client.event(request))
+    answered = request.first_visible - started if request.first_visible is not None else float('nan')
+    if user is not None:
+        user.cancel()
+    await asyncio.gather(*user_app._tasks, return_exceptions=True)
+    print(f"{mode:<12}{ready * 1000:>12.0f}{answered * 1000:>18.0f}   {'on' if user_app.ready else 'off'}")
+
+
+async def run(args):
+    fake = FakeOpenAI(port=args.port, latency=args.latency, tokens_per_second=args.tokens_per_second,
+                      answer_tokens=args.answer_tokens)
+    await fake.start()
+    openai.api_base = fake.api_base
+    print(f"{'startup':<12}{'handlers ms':>12}{'first answer ms':>18}   polish")
+    try:
+        for mode in ('sequential', 'concurrent'):
+            if mode == 'sequential' and args.user_connect < 0:
+                print(f"{mode:<12}{'never':>12}{'never':>18}")
+                continue
+            helper = AsyncOpenAIHelper(CONFIG)
+            try:
+                await run_mode(mode, args, helper)
+            finally:
+                await helper.close()
+    finally:
+        await fake.stop()
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--bot-connect', type=float, default=0.5, help='Seconds the bot takes to log in')
+    parser.add_argument('--user-connect', type=float, default=5.0,
+                        help='Seconds the user account takes to log in, -1 for never')
+    parser.add_argument('--timeout', type=float, default=2.0, help='Seconds a client may take to log in')
+    parser.add_argument('--latency', type=float, default=0.3, help='Seconds before the first token')
+    parser.add_argument('--tokens-per-second', type=float, default=50.0)
+    parser.add_argument('--answer-tokens', type=int, default=20)
+    parser.add_argument('--telegram-latency', type=float, default=0.05, help='Seconds a send or edit takes')
+    parser.add_argument('--port', type=int, default=8773)
+    args = parser.parse_args()
+
+    import_times()
+    asyncio.run(run(args))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,106 @@
+"""
+Per-message latency and peak RSS of the transcription pipeline for 1-minute and 30-minute voice notes.
+
+    python -m benchmark.transcription_bench
+
+Every case runs in a fresh process against a local fake Whisper endpoint (see benchmark.fake_openai),
+so that the reported peak RSS belongs to that case only. Voice notes are encoded as OGG/Opus with
+ffmpeg when it is installed, otherwise as 8 kHz WAV; the transcode cases need ffmpeg.
+"""
+import argparse
+import array
+import asyncio
+import io
+import math
+import resource
+import shutil
+import subprocess
+import sys
+import time
+import wave
+
+import openai
+
+from benchmark.fake_openai import FakeOpenAI
+from benchmark.history_bench import CONFIG
+from core.openai_helper import AsyncOpenAIHelper
+from core.transcription import TranscriptionPipeline, WHISPER_FORMATS
+
+RATE = 8000
+
+
+def voice_note(seconds: int, ogg: bool) -> bytes:
+    """
+    Returns a synthetic voice note: a tone broken by a short pause every few seconds.
+    """
+    samples = array.array('h', (
+        int(8000 * math.sin(2 * math.pi * 220 * i / RATE)) if (i // RATE) % 4 else 0
+        for i in range(seconds * RATE)))
+    output = io.BytesIO()
+    with wave.open(output, 'wb') as wav:
+        wav.setnchannels(1)
+        wav.setsampwidth(2)
+        wav.setframerate(RATE)
+        wav.writeframes(samples.tobytes())
+    if not ogg:
+        return output.getvalue()
+    return subprocess.run(['ffmpeg', '-loglevel', 'error', '-f', 'wav', '-i', '-', '-c:a', 'libopus', '-b:a', '16k',
+                           '-f', 'ogg', '-'], input=output.getvalue(), capture_output=True, check=True).stdout
+
+
+def peak_rss_mib() -> float:
+    own = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    children = resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss
+    return max(own, children) / 1024
+
+
+async def run_case(seconds: int, mode: str, port: int) -> tuple:
+    ogg = shutil.which('ffmpeg') is not None
+    data = voice_note(seconds, ogg)
+    filename = 'voice.oga' if ogg else 'voice.wav'
+
+    fake = FakeOpenAI(port=port, latency=0.1)
+    await fake.start()
+    openai.api_base = fake.api_base
+    helper = AsyncOpenAIHelper(CONFIG)
+    # Forcing the transcode path by refusing the format of the note
+    accepted = WHISPER_FORMATS if mode == 'passthrough' else WHISPER_FORMATS - {'ogg', 'wav'}
+    # Notes beyond the upload limit are split, into WAV segments when there is no ffmpeg to encode MP3
+    pipeline = TranscriptionPipeline(helper, accepted_formats=accepted, chunk_format='mp3' if ogg else 'wav')
+    try:
+        start = time.perf_counter()
+        await pipeline.transcribe(data, filename)
+        elapsed = time.perf_counter() - start
+    finally:
+        pipeline.close()
+        await helper.close()
+        await fake.stop()
+    return len(data), len(fake.uploads), max(size for _, size in fake.uploads), elapsed
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--case', nargs=2, metavar=('SECONDS', 'MODE'))
+    parser.add_argument('--port', type=int, default=8766)
+    args = parser.parse_args()
+
+    if args.case:
+        seconds, mode = int(args.case[0]), args.case[1]
+        size, uploads, largest, elapsed = asyncio.run(run_case(seconds, mode, args.port))
+        print(f"{seconds:>8}s {mode:<12}{size / 1024:>12.0f}{uploads:>9}{largest / 1024:>14.0f}"
+              f"{elapsed * 1000:>12.0f}{peak_rss_mib():>14.1f}", flush=True)
+        return
+
+    print(f"{'length':>9} {'mode':<12}{'input KiB':>12}{'uploads':>9}{'largest KiB':>14}{'latency ms':>12}"
+          f"{'peak RSS MiB':>14}")
+    for seconds in (60, 1800):
+        for mode in ('passthrough', 'transcode'):
+            if mode == 'transcode' and shutil.which('ffmpeg') is None:
+                print(f"{seconds:>8}s {mode:<12}{'skipped, ffmpeg is not installed':>50}")
+                continue
+            subprocess.run([sys.executable, '-m', 'benchmark.transcription_bench', '--case', str(seconds), mode,
+                            '--port', str(args.port)], check=True)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,158 @@
+"""
+Load test of the dictionary web API: the in-process aiohttp server against the former CherryPy setup.
+
+    python -m benchmark.web_load --requests 2000 --concurrency 100 --latency 0.2
+
+Both servers answer `/word` through a local fake OpenAI server (see benchmark.fake_openai), every
+request asks for a different word so that nothing is served from cache. CherryPy is only needed
+to run the comparison and is skipped if it is not installed.
+"""
+import argparse
+import asyncio
+import os
+import subprocess
+import sys
+import time
+
+import aiohttp
+
+from benchmark.history_bench import CONFIG
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+def serve_aiohttp(port: int, api_base: str):
+    import openai
+    from api.web.query import DictionApp
+    from api.web.server import WebServer
+    from core.openai_helper import AsyncOpenAIHelper
+
+    async def run():
+        helper = AsyncOpenAIHelper(CONFIG)
+        openai.api_base = api_base
+        server = WebServer(DictionApp(helper).routes(), host='127.0.0.1', port=port, max_concurrency=1024)
+        await server.start()
+        await asyncio.Event().wait()
+    asyncio.run(run())
+
+
+def serve_cherrypy(port: int, api_base: str):
+    import cherrypy
+    import openai
+    from core.openai_helper import OpenAIHelper
+
+    class LegacyDictionApp:
+        """
+        The web API as it was run before: synchronous OpenAI calls from CherryPy worker threads.
+        """
+
+        def __init__(self, helper: OpenAIHelper):
+            self.helper = helper
+
+        @cherrypy.expose
+        def word(self, word):
+            return self.helper.get_stateless_response(function="diction", query=word + "是什么意思?")
+
+    helper = OpenAIHelper(CONFIG)
+    openai.api_base = api_base
+    cherrypy.config.update({
+        'server.socket_host': '127.0.0.1',
+        'server.socket_port': port,
+        'log.screen': False,
+        'environment': 'production',
+    })
+    cherrypy.quickstart(LegacyDictionApp(helper))
+
+
+async def load(url: str, requests: int, concurrency: int) -> dict:
+    latencies = []
+    errors = 0
+    counter = iter(range(requests))
+
+    async def worker(session: aiohttp.ClientSession):
+        nonlocal errors
+        for i in counter:
+            start = time.perf_counter()
+            try:
+                async with session.get(url, params={'word': f'word{i}'}) as response:
+                    await response.read()
+                    if response.status != 200:
+                        errors += 1
+            except aiohttp.ClientError:
+                errors += 1
+            latencies.append(time.perf_counter() - start)
+
+    connector = aiohttp.TCPConnector(limit=concurrency)
+    async with aiohttp.ClientSession(connector=connector, timeout=aiohttp.ClientTimeout(total=300)) as session:
+        start = time.perf_counter()
+        await asyncio.gather(*(worker(session) for _ in range(concurrency)))
+        elapsed = time.perf_counter() - start
+
+    latencies.sort()
+    return {
+        'rps': requests / elapsed,
+        'p50': latencies[len(latencies) // 2] * 1000,
+        'p99': latencies[min(len(latencies) - 1, int(len(latencies) * 0.99))] * 1000,
+        'errors': errors,
+    }
+
+
+async def wait_for_port(port: int, timeout: float = 15.0):
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        try:
+            _, writer = await asyncio.open_connection('127.0.0.1', port)
+            writer.close()
+            return
+        except OSError:
+            await asyncio.sleep(0.1)
+    raise TimeoutError(f'Nothing listening on port {port}')
+
+
+def spawn(*args) -> subprocess.Popen:
+    return subprocess.Popen([sys.executable, '-m', 'benchmark.web_load', *args], cwd=ROOT)
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('mode', nargs='?', default='compare', choices=['compare', 'aiohttp', 'cherrypy'])
+    parser.add_argument('--port', type=int, default=5100)
+    parser.add_argument('--api-base', default='http://127.0.0.1:8765/v1')
+    parser.add_argument('--requests', type=int, default=1000)
+    parser.add_argument('--concurrency', type=int, default=50)
+    parser.add_argument('--latency', type=float, default=0.2)
+    args = parser.parse_args()
+
+    if args.mode == 'aiohttp':
+        return serve_aiohttp(args.port, args.api_base)
+    if args.mode == 'cherrypy':
+        return serve_cherrypy(args.port, args.api_base)
+
+    fake = subprocess.Popen([sys.executable, '-m', 'benchmark.fake_openai', '--port', '8765',
+                             '--latency', str(args.latency), '--tokens-per-second', '1000'], cwd=ROOT)
+    try:
+        asyncio.run(wait_for_port(8765))
+        print(f"{'server':<10}{'req/s':>10}{'p50 ms':>10}{'p99 ms':>10}{'errors':>8}")
+        for server in ('aiohttp', 'cherrypy'):
+            if server == 'cherrypy':
+                try:
+                    import cherrypy  # noqa: F401
+                except ImportError:
+                    print(f"{server:<10}{'skipped, cherrypy is not installed':>38}")
+                    continue
+            process = spawn(server, '--port', str(args.port), '--api-base', 'http://127.0.0.1:8765/v1')
+            try:
+                asyncio.run(wait_for_port(args.port))
+                result = asyncio.run(load(f'http://127.0.0.1:{args.port}/word', args.requests, args.concurrency))
+                print(f"{server:<10}{result['rps']:>10.1f}{result['p50']:>10.1f}{result['p99']:>10.1f}"
+                      f"{result['errors']:>8}")
+            finally:
+                process.terminate()
+                process.wait()
+    finally:
+        fake.terminate()
+        fake.wait()
+
+
+if __name__ == '__main__':
+    main()
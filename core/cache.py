@@ -0,0 +1,230 @@
+import asyncio
+import threading
+import time
+from collections import OrderedDict
+from typing import Any, Awaitable, Callable, Dict, Hashable, Optional, Tuple
+
+
+class TTLCache:
+    """
+    Thread-safe LRU cache whose entries expire after a time to live.
+
+    `get_or_compute` and `aget_or_compute` collapse concurrent misses of the same key into a
+    single computation: the first caller computes the value, the others wait for it.
+    """
+
+    def __init__(self, max_size: int = 1024, ttl: Optional[float] = None):
+        """
+        :param max_size: The maximum number of entries
+        :param ttl: The number of seconds an entry stays valid, forever if None
+        """
+        self.max_size = max_size
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.expirations = 0
+        self.coalesced = 0
+        self._entries: 'OrderedDict[Hashable, tuple]' = OrderedDict()  # {key: (value, expires at)}
+        self._inflight: Dict[Hashable, '_Call'] = {}
+        self._flights = SingleFlight()
+        self._lock = threading.Lock()
+
+    def get(self, key: Hashable, default: Any = None) -> Any:
+        """
+        Returns the cached value of a key, or `default` if it is missing or expired.
+        """
+        with self._lock:
+            return self._get(key, default)
+
+    def set(self, key: Hashable, value: Any):
+        """
+        Caches a value, evicting the least recently used entry if the cache is full.
+        """
+        with self._lock:
+            self._set(key, value)
+
+    def get_or_compute(self, key: Hashable, compute: Callable[[], Any]) -> Any:
+        """
+        Returns the cached value of a key, computing and caching it on a miss.
+        Exceptions raised by `compute` are propagated to every waiting caller and nothing is cached.
+        """
+        with self._lock:
+            value = self._get(key, _MISSING)
+            if value is not _MISSING:
+                return value
+            call = self._inflight.get(key)
+            leader = call is None
+            if leader:
+                call = self._inflight[key] = _Call()
+            else:
+                self.coalesced += 1
+
+        if not leader:
+            return call.wait()
+
+        try:
+            value = compute()
+        except BaseException as e:
+            call.fail(e)
+            raise
+        else:
+            call.resolve(value)
+            with self._lock:
+                self._set(key, value)
+            return value
+        finally:
+            with self._lock:
+                self._inflight.pop(key, None)
+
+    async def aget_or_compute(self, key: Hashable, compute: Callable[[], Awaitable[Any]]) -> Any:
+        """
+        Same as `get_or_compute`, for coroutines running on one event loop.
+        """
+        with self._lock:
+            value = self._get(key, _MISSING)
+        if value is not _MISSING:
+            return value
+
+        async def compute_and_set() -> Any:
+            result = await compute()
+            self.set(key, result)
+            return result
+
+        value, computed = await self._flights.run(key, compute_and_set)
+        if not computed:
+            self.coalesced += 1
+        return value
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+    def items(self) -> list:
+        """
+        Returns the `(key, value)` pairs that have not expired, least recently used first.
+        """
+        now = time.monotonic()
+        with self._lock:
+            return [(key, value) for key, (value, expires) in self._entries.items()
+                    if expires is None or expires > now]
+
+    def stats(self) -> dict:
+        """
+        Returns the size and hit/miss counters of the cache.
+        """
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                'size': len(self._entries),
+                'max_size': self.max_size,
+                'ttl': self.ttl,
+                'hits': self.hits,
+                'misses': self.misses,
+                'hit_rate': self.hits / lookups if lookups else 0.0,
+                'coalesced': self.coalesced,
+                'evictions': self.evictions,
+                'expirations': self.expirations,
+                'inflight': len(self._inflight) + len(self._flights),
+            }
+
+    def __len__(self):
+        return len(self._entries)
+
+    def _get(self, key: Hashable, default: Any) -> Any:
+        entry = self._entries.get(key)
+        if entry is not None and entry[1] is not None and entry[1] <= time.monotonic():
+            del self._entries[key]
+            self.expirations += 1
+            entry = None
+        if entry is None:
+            self.misses += 1
+            return default
+        self._entries.move_to_end(key)
+        self.hits += 1
+        return entry[0]
+
+    def _set(self, key: Hashable, value: Any):
+        expires = time.monotonic() + self.ttl if self.ttl is not None else None
+        self._entries[key] = (value, expires)
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.max_size:
+            self._entries.popitem(last=False)
+            self.evictions += 1
+
+
+class SingleFlight:
+    """
+    Collapses concurrent computations of the same key on one event loop into one: the first caller
+    computes the value and the others wait for it. Exceptions reach every waiting caller. If the
+    computing caller is cancelled, the callers waiting for it were not, so one of them computes the
+    value instead and the others wait for that one.
+    """
+
+    def __init__(self):
+        self._calls: Dict[Hashable, asyncio.Future] = {}
+
+    def __len__(self):
+        return len(self._calls)
+
+    async def run(self, key: Hashable, compute: Callable[[], Awaitable[Any]]) -> Tuple[Any, bool]:
+        """
+        Computes the value of a key, or waits for the computation already running.
+        :return: The value, and whether this caller computed it
+        """
+        while True:
+            waiting = self._calls.get(key)
+            if waiting is None:
+                break
+            try:
+                return await asyncio.shield(waiting), False
+            except asyncio.CancelledError:
+                if not waiting.cancelled():
+                    raise
+                # The computing caller was cancelled, not this one: take over
+
+        future = self._calls[key] = asyncio.get_running_loop().create_future()
+        try:
+            value = await compute()
+        except asyncio.CancelledError:
+            future.cancel()
+            raise
+        except BaseException as e:
+            future.set_exception(e)
+            # Retrieve the exception so it is not reported when nobody else was waiting
+            future.exception()
+            raise
+        else:
+            future.set_result(value)
+            return value, True
+        finally:
+            if self._calls.get(key) is future:
+                del self._calls[key]
+
+
+class _Call:
+    """
+    The result of a computation other threads are waiting for.
+    """
+
+    def __init__(self):
+        self._done = threading.Event()
+        self._value = None
+        self._error: Optional[BaseException] = None
+
+    def resolve(self, value: Any):
+        self._value = value
+        self._done.set()
+
+    def fail(self, error: BaseException):
+        self._error = error
+        self._done.set()
+
+    def wait(self) -> Any:
+        self._done.wait()
+        if self._error is not None:
+            raise self._error
+        return self._value
+
+
+_MISSING = object()
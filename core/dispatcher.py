@@ -0,0 +1,154 @@
+import logging
+import multiprocessing
+import queue
+import threading
+import time
+from typing import Callable, Dict, Optional, Tuple
+
+from core import metrics
+
+DISPATCHED = metrics.counter('chatgpt_dispatcher_updates_total', 'Updates handed to a worker process', ['worker'])
+DISPATCH_DROPPED = metrics.counter(
+    'chatgpt_dispatcher_dropped_total', 'Updates refused because the inbox of their worker was full or it had exited',
+    ['reason'])
+
+
+def shard(chat_id: int, shards: int) -> int:
+    """
+    Returns the worker of a chat. Python's modulo is never negative, so group chats (negative IDs) shard too.
+    """
+    return chat_id % shards
+
+
+class Update:
+    """
+    A message handed from the dispatcher to the worker of its chat, small enough to pickle cheaply.
+    Media are not copied, the worker downloads them by `message_id` if its handler needs them.
+    """
+    __slots__ = ('handler', 'chat_id', 'message_id', 'text', 'media', 'received')
+
+    def __init__(self, handler: str, chat_id: int, message_id: int, text: str, media: bool = False,
+                 received: Optional[float] = None):
+        """
+        :param handler: The name of the handler of the bot the message goes to
+        :param media: Whether the message carries a voice or audio file
+        :param received: The `time.perf_counter()` at which the dispatcher received the message
+        """
+        self.handler = handler
+        self.chat_id = chat_id
+        self.message_id = message_id
+        self.text = text
+        self.media = media
+        self.received = time.perf_counter() if received is None else received
+
+    def __getstate__(self):
+        return tuple(getattr(self, name) for name in self.__slots__)
+
+    def __setstate__(self, state):
+        for name, value in zip(self.__slots__, state):
+            setattr(self, name, value)
+
+    def __repr__(self):
+        return f"Update({self.handler!r}, chat_id={self.chat_id}, message_id={self.message_id})"
+
+
+class ShardedDispatcher:
+    """
+    Hands updates to `workers` worker processes by chat ID.
+
+    Every chat always goes to the same worker, through a FIFO inbox, so its messages are handled
+    in order and its session stays in the memory of one process, while the chats are spread over
+    every core. Each worker runs `target(index, inbox, done, *args)`, handles the updates it gets
+    from `inbox` until it gets None, and puts `(index, message_id, finished)` on `done` once it
+    handled one, which a thread of the dispatcher collects for the statistics.
+
+    A worker that exited, e.g. because it could not log in, is not restarted: the updates of its
+    chats are refused, so that they are answered as busy instead of waiting in an inbox nobody reads.
+    """
+
+    def __init__(self, workers: int, target: Callable, args: tuple = (), inbox_size: int = 10000,
+                 on_done: Optional[Callable[[Tuple[int, int, float]], None]] = None):
+        """
+        :param workers: The number of worker processes
+        :param target: The function a worker process runs, importable from the top level of its module
+        :param args: The extra arguments of `target`, which must be picklable
+        :param inbox_size: The number of updates a worker may have waiting before new ones are refused
+        :param on_done: Called from the collecting thread with every `(worker, message_id, finished)`
+        """
+        context = multiprocessing.get_context('spawn')
+        self.workers = workers
+        self.on_done = on_done
+        self.done = context.Queue()
+        self._collector = threading.Thread(target=self._collect, name='dispatcher-collector', daemon=True)
+        self._inboxes = [context.Queue(inbox_size) for _ in range(workers)]
+        self._processes = [context.Process(target=target, args=(index, inbox, self.done) + tuple(args),
+                                           name=f'bot-worker-{index}', daemon=True)
+                           for index, inbox in enumerate(self._inboxes)]
+        self._dispatched = [0] * workers
+        self._completed = [0] * workers
+        self._dropped = 0
+        self._exited = set()
+
+    def start(self):
+        for process in self._processes:
+            process.start()
+        self._collector.start()
+        logging.info(f'Started {self.workers} bot workers')
+
+    def dispatch(self, update: Update) -> bool:
+        """
+        Queues an update for the worker of its chat.
+        :return: False if the worker had exited or its inbox was full, and the update was refused
+        """
+        index = shard(update.chat_id, self.workers)
+        process = self._processes[index]
+        if not process.is_alive():
+            self._dropped += 1
+            DISPATCH_DROPPED.labels('exited').inc()
+            if index not in self._exited:
+                self._exited.add(index)
+                logging.error(f'Worker {index} exited with code {process.exitcode}, refusing the updates of its chats')
+            return False
+        try:
+            self._inboxes[index].put_nowait(update)
+        except queue.Full:
+            self._dropped += 1
+            DISPATCH_DROPPED.labels('full').inc()
+            logging.warning(f'Dropped {update}, the inbox of worker {index} is full')
+            return False
+        self._dispatched[index] += 1
+        DISPATCHED.labels(str(index)).inc()
+        return True
+
+    def stop(self, timeout: float = 30.0):
+        """
+        Lets every worker finish the updates it has, then waits up to `timeout` seconds for it to exit.
+        """
+        for inbox in self._inboxes:
+            inbox.put(None)
+        deadline = time.monotonic() + timeout
+        for process in self._processes:
+            process.join(max(0.0, deadline - time.monotonic()))
+            if process.is_alive():
+                logging.warning(f'Terminating {process.name}, it did not exit in time')
+                process.terminate()
+        self.done.put(None)
+        self._collector.join()
+
+    def stats(self) -> Dict[str, object]:
+        return {
+            'workers': self.workers,
+            'alive': sum(process.is_alive() for process in self._processes),
+            'dispatched': list(self._dispatched),
+            'completed': list(self._completed),
+            'dropped': self._dropped,
+        }
+
+    def _collect(self):
+        while True:
+            handled = self.done.get()
+            if handled is None:
+                break
+            self._completed[handled[0]] += 1
+            if self.on_done is not None:
+                self.on_done(handled)
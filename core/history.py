@@ -0,0 +1,303 @@
+import json
+import sys
+from typing import Callable, Iterator, List, Optional, Sequence
+
+try:
+    import tiktoken
+except ImportError:  # pragma: no cover - tiktoken is optional
+    tiktoken = None
+
+
+# Context window of the chat models, in tokens
+MODEL_CONTEXT_SIZES = {
+    'gpt-3.5-turbo': 4096,
+    'gpt-3.5-turbo-0301': 4096,
+    'gpt-4': 8192,
+    'gpt-4-0314': 8192,
+    'gpt-4-32k': 32768,
+    'gpt-4-32k-0314': 32768,
+}
+
+# Every message is wrapped as <|start|>{role}\n{content}<|end|>\n, and every reply is primed with <|start|>assistant
+TOKENS_PER_MESSAGE = 4
+TOKENS_PER_REPLY = 3
+
+_encodings = {}
+
+
+def count_tokens(text: str, model: str = 'gpt-3.5-turbo') -> int:
+    """
+    Counts the tokens of a piece of text.
+    Uses tiktoken when it is installed, otherwise a conservative estimate
+    (four ASCII characters or one non-ASCII character per token).
+    :param text: The text to count
+    :param model: The model whose tokenizer should be used
+    :return: The number of tokens
+    """
+    if tiktoken is not None:
+        encoding = _encodings.get(model)
+        if encoding is None:
+            try:
+                encoding = tiktoken.encoding_for_model(model)
+            except KeyError:
+                encoding = tiktoken.get_encoding('cl100k_base')
+            _encodings[model] = encoding
+        return len(encoding.encode(text))
+
+    ascii_chars = sum(1 for c in text if ord(c) < 128)
+    return (ascii_chars + 3) // 4 + (len(text) - ascii_chars)
+
+
+def prompt_budget(config: dict) -> int:
+    """
+    Returns how many prompt tokens a request may use so that `max_tokens` still fit in the context window.
+    :param config: The GPT configuration
+    """
+    if config.get('prompt_budget'):
+        return config['prompt_budget']
+    context_size = config.get('context_size') or MODEL_CONTEXT_SIZES.get(config['model'], 4096)
+    return context_size - config['max_tokens'] - TOKENS_PER_REPLY
+
+
+def encode_message(role: str, content: str) -> bytes:
+    """
+    Returns the JSON of a message as it is sent in the `messages` of a ChatCompletion request.
+    """
+    return json.dumps({"role": role, "content": content}).encode()
+
+
+class Message:
+    """
+    A single chat message. Kept as a slotted object rather than a dict to save memory.
+    Its JSON is encoded once, so that the requests sending it again only copy the bytes.
+    """
+    __slots__ = ('role', 'content', 'tokens', 'encoded')
+
+    def __init__(self, role: str, content: str, tokens: int, encoded: Optional[bytes] = None):
+        self.role = role
+        self.content = content
+        self.tokens = tokens
+        self.encoded = encode_message(role, content) if encoded is None else encoded
+
+    def to_dict(self) -> dict:
+        return {"role": self.role, "content": self.content}
+
+    def __repr__(self):
+        return f"Message(role={self.role!r}, content={self.content!r}, tokens={self.tokens})"
+
+
+# Approximate resident size of a Message without its content
+MESSAGE_OVERHEAD = sys.getsizeof(Message('', '', 0, b'')) + 8
+
+# The encoded system prompts, shared by every conversation like the prompts themselves
+_encoded_prompts = {}
+
+
+class EncodedMessages(Sequence):
+    """
+    The `messages` of a ChatCompletion request taken from a history: a snapshot of its messages,
+    whose JSON is joined into the request body without encoding them again (see core.wire).
+    Reading it still gives the messages as dicts.
+    """
+    __slots__ = ('_messages', 'tokens', '_prefix', '_prefix_count')
+
+    def __init__(self, messages: List[Message], tokens: Optional[int] = None, prefix: Optional[bytes] = None,
+                 prefix_count: int = 0):
+        """
+        :param tokens: The prompt tokens of the messages, summed if None
+        :param prefix: The JSON of the first `prefix_count` messages, already joined
+        """
+        self._messages = messages
+        # The prompt tokens of the messages, without the priming of the reply
+        self.tokens = sum(message.tokens for message in messages) if tokens is None else tokens
+        self._prefix = prefix
+        self._prefix_count = prefix_count
+
+    def encode(self) -> bytes:
+        if self._prefix is None:
+            return b'[' + b', '.join([message.encoded for message in self._messages]) + b']'
+        return b'[' + b', '.join([self._prefix] + [message.encoded for message in self._messages[self._prefix_count:]]) + b']'
+
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            return [message.to_dict() for message in self._messages[index]]
+        return self._messages[index].to_dict()
+
+    def __len__(self):
+        return len(self._messages)
+
+    def __iter__(self) -> Iterator[dict]:
+        return (message.to_dict() for message in self._messages)
+
+
+class ConversationHistory:
+    """
+    The messages of one conversation, with the token count of every message
+    computed once when it is appended.
+    """
+
+    def __init__(self, system_prompt: str, model: str = 'gpt-3.5-turbo', on_resize: Optional[Callable[[int], None]] = None,
+                 on_append: Optional[Callable[[Message], None]] = None,
+                 on_rewrite: Optional[Callable[[List[Message]], None]] = None):
+        """
+        :param system_prompt: The system message the conversation starts with
+        :param model: The model whose tokenizer counts the tokens
+        :param on_resize: Called with the change in bytes whenever messages are added or removed
+        :param on_append: Called with every message appended to the conversation
+        :param on_rewrite: Called with the messages after the system prompt whenever older ones are replaced,
+                           e.g. by a summary
+        """
+        self.model = model
+        self.on_resize = on_resize
+        self.on_append = on_append
+        self.on_rewrite = on_rewrite
+        self._messages: List[Message] = []
+        self.tokens = TOKENS_PER_REPLY
+        self.size = 0
+        # The prompt budget of the latest request sent with the history, None until one is sent
+        self.budget: Optional[int] = None
+        # The JSON of the first `_prefix_count` messages joined by `prepare`, until one of them changes
+        self._prefix: Optional[bytes] = None
+        self._prefix_count = 0
+        # System prompts are shared by every conversation, keep a single copy of them
+        self._insert(0, "system", sys.intern(system_prompt), shared=True)
+
+    @property
+    def messages(self) -> List[dict]:
+        """
+        The messages in the format expected by the ChatCompletion API.
+        """
+        return [message.to_dict() for message in self._messages]
+
+    def encoded_messages(self) -> EncodedMessages:
+        """
+        The messages of the conversation for a request body, encoded when they were appended.
+        """
+        return EncodedMessages(list(self._messages), self.tokens - TOKENS_PER_REPLY, self._prefix, self._prefix_count)
+
+    def prepare(self):
+        """
+        Joins the JSON of the messages once, so that the next requests only join the turns appended since.
+        """
+        self._drop_prefix()
+        if len(self._messages) > 1:
+            self._prefix = b', '.join([message.encoded for message in self._messages])
+            self._prefix_count = len(self._messages)
+            self._resize(sys.getsizeof(self._prefix))
+
+    def append(self, role: str, content: str, tokens: Optional[int] = None):
+        """
+        Appends a message and accounts for its tokens.
+        :param tokens: The token count of the message if it is already known
+        """
+        message = self._insert(len(self._messages), role, content, tokens=tokens)
+        if self.on_append is not None:
+            self.on_append(message)
+
+    def trim(self, budget: int) -> int:
+        """
+        Drops the oldest turns after the system prompt until the history fits in the budget.
+        The system prompt and the latest message are always kept.
+        :param budget: The maximum number of prompt tokens
+        :return: The number of dropped messages
+        """
+        dropped = 0
+        tokens = self.tokens
+        while tokens > budget and dropped < len(self._messages) - 2:
+            dropped += 1
+            tokens -= self._messages[dropped].tokens
+        self._remove(1, dropped + 1)
+        return dropped
+
+    def summary_candidates(self, budget: int, keep_ratio: float = 0.5) -> List[Message]:
+        """
+        Returns the oldest turns that have to be summarised so that the remaining
+        history takes at most `keep_ratio` of the budget.
+        :param budget: The maximum number of prompt tokens
+        :param keep_ratio: The share of the budget left to verbatim turns after compaction
+        """
+        if self.tokens <= budget:
+            return []
+        target = budget * keep_ratio
+        tokens = self.tokens
+        end = 1
+        while tokens > target and end < len(self._messages) - 1:
+            tokens -= self._messages[end].tokens
+            end += 1
+        return self._messages[1:end]
+
+    def replace_with_summary(self, count: int, summary: str):
+        """
+        Replaces the `count` oldest turns after the system prompt with a summary of them.
+        """
+        self._remove(1, count + 1)
+        self._insert(1, "system", f"Summary of the earlier conversation: {summary}")
+        if self.on_rewrite is not None:
+            self.on_rewrite(self._messages[1:])
+
+    def _insert(self, index: int, role: str, content: str, shared: bool = False, tokens: Optional[int] = None) -> Message:
+        if tokens is None:
+            tokens = TOKENS_PER_MESSAGE + count_tokens(content, self.model)
+        encoded = None
+        if shared:
+            encoded = _encoded_prompts.get(content)
+            if encoded is None:
+                encoded = _encoded_prompts[content] = encode_message(role, content)
+        message = Message(sys.intern(role), content, tokens, encoded)
+        if index < self._prefix_count:
+            self._drop_prefix()
+        self._messages.insert(index, message)
+        self.tokens += message.tokens
+        self._resize(MESSAGE_OVERHEAD + (0 if shared else sys.getsizeof(content) + sys.getsizeof(message.encoded)))
+        return message
+
+    def _remove(self, start: int, end: int):
+        removed = self._messages[start:end]
+        if not removed:
+            return
+        if start < self._prefix_count:
+            self._drop_prefix()
+        del self._messages[start:end]
+        self.tokens -= sum(message.tokens for message in removed)
+        self._resize(-sum(MESSAGE_OVERHEAD + sys.getsizeof(message.content) + sys.getsizeof(message.encoded)
+                          for message in removed))
+
+    def _drop_prefix(self):
+        if self._prefix is not None:
+            self._resize(-sys.getsizeof(self._prefix))
+        self._prefix = None
+        self._prefix_count = 0
+
+    def _resize(self, delta: int):
+        self.size += delta
+        if self.on_resize is not None:
+            self.on_resize(delta)
+
+    def __len__(self):
+        return len(self._messages)
+
+    def __iter__(self):
+        return iter(self._messages)
+
+    def __getitem__(self, item):
+        return self._messages[item]
+
+
+def summary_request(messages: List[Message], config: dict) -> dict:
+    """
+    Builds the ChatCompletion arguments that summarise the given turns.
+    :param messages: The turns to summarise
+    :param config: The GPT configuration
+    """
+    transcript = "\n".join(f"{message.role}: {message.content}" for message in messages)
+    return dict(
+        model=config['model'],
+        messages=[
+            {"role": "system", "content": "Summarise the following conversation in a few sentences, "
+                                          "keeping every fact the assistant may need later."},
+            {"role": "user", "content": transcript},
+        ],
+        temperature=0,
+        max_tokens=config.get('summary_max_tokens', 256),
+    )
+
@@ -0,0 +1,166 @@
+import asyncio
+import logging
+import time
+from typing import Callable, Dict, Optional, Set
+
+from core import metrics
+from core.history import ConversationHistory, summary_request
+from core.session_store import ChatSession
+
+IDLE_PREPARED = metrics.counter(
+    'chatgpt_idle_prepared_total', 'Histories prepared while their chat was idle, by action (summarised, trimmed, '
+    'prepared, skipped)', ['action'])
+IDLE_SECONDS = metrics.counter('chatgpt_idle_cpu_seconds_total', 'CPU time the idle worker spent preparing histories')
+
+
+class IdleWorker:
+    """
+    Prepares the conversations of the chats that went quiet, so that their next message starts
+    from a ready-to-send context: every `interval` seconds, each history of a chat idle for
+    `quiet_period` seconds that outgrew the prompt budget of its latest request is compacted the way
+    that request would be (summarised if `summarise_history` is on, trimmed otherwise), and its
+    messages are joined into the prefix of the next request. Histories within their budget are
+    never compacted.
+
+    It keeps out of the way of the answers: at most `max_concurrent` chats are prepared at a time,
+    it spends at most `cpu_share` of the CPU time of the event loop, a pass stops as soon as `busy()`
+    is true, and a summary is thrown away if its chat was used while it was being written.
+    """
+
+    def __init__(self, helper, quiet_period: float = 60.0, interval: float = 15.0, max_concurrent: int = 1,
+                 cpu_share: float = 0.1, busy: Optional[Callable[[], bool]] = None):
+        """
+        :param helper: The AsyncOpenAIHelper whose sessions are prepared
+        :param quiet_period: Seconds without a message after which a chat is prepared
+        :param interval: Seconds between two looks for quiet chats
+        :param max_concurrent: The number of chats prepared at the same time
+        :param cpu_share: The share of the CPU time the worker may use, between 0 and 1
+        :param busy: Returns True while the answers should have the process to themselves
+        """
+        self.helper = helper
+        self.quiet_period = quiet_period
+        self.interval = interval
+        self.cpu_share = cpu_share
+        self.busy = busy
+        self.passes = 0
+        self.prepared = 0
+        self.cpu_seconds = 0.0
+        self._slots = asyncio.Semaphore(max_concurrent)
+        self._prepared: Dict[int, float] = {}  # {chat_id: `last_used` of the session when it was prepared}
+        self._tasks: Set[asyncio.Task] = set()
+        self._task: Optional[asyncio.Task] = None
+
+    @classmethod
+    def from_config(cls, helper, config: dict) -> Optional['IdleWorker']:
+        """
+        Creates the worker from the `idle_worker` section of the GPT configuration, None if it is missing.
+        """
+        options = config.get('idle_worker')
+        if not options:
+            return None
+        return cls(helper, **options)
+
+    def start(self):
+        """
+        Starts looking for quiet chats, from within the event loop. Does nothing if already started.
+        """
+        if self._task is None:
+            self._task = asyncio.ensure_future(self._run())
+
+    async def stop(self):
+        """
+        Stops the worker, cancelling the chats being prepared.
+        """
+        tasks = list(self._tasks) + ([self._task] if self._task is not None else [])
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+        self._task = None
+
+    def stats(self) -> dict:
+        return {
+            'passes': self.passes,
+            'prepared': self.prepared,
+            'preparing': len(self._tasks),
+            'cpu_seconds': self.cpu_seconds,
+        }
+
+    async def _run(self):
+        while True:
+            await asyncio.sleep(self.interval)
+            try:
+                await self._pass()
+            except Exception as e:
+                logging.exception(e)
+
+    async def _pass(self):
+        """
+        Starts preparing every quiet chat that changed since it was last prepared.
+        """
+        self.passes += 1
+        sessions = self.helper.sessions
+        self._prepared = {chat_id: used for chat_id, used in self._prepared.items() if chat_id in sessions}
+        for session in sessions.idle_sessions(self.quiet_period):
+            if self._prepared.get(session.chat_id) == session.last_used or not session.attached:
+                continue
+            if self.busy is not None and self.busy():
+                IDLE_PREPARED.labels('skipped').inc()
+                return
+            await self._slots.acquire()
+            task = asyncio.ensure_future(self._prepare(session))
+            self._tasks.add(task)
+            task.add_done_callback(self._done)
+
+    def _done(self, task: asyncio.Task):
+        self._tasks.discard(task)
+        self._slots.release()
+        if not task.cancelled() and task.exception() is not None:
+            logging.error(f'Preparing an idle chat failed: {task.exception()!r}')
+
+    async def _prepare(self, session: ChatSession):
+        last_used = session.last_used
+        for function, history in list(session.histories.items()):
+            budget = history.budget
+            if budget is not None and history.tokens > budget:
+                if self.helper.config.get('summarise_history'):
+                    await self._summarise(session, function, history, budget, last_used)
+                else:
+                    dropped = await self._work(history.trim, budget)
+                    if dropped:
+                        IDLE_PREPARED.labels('trimmed').inc()
+            await self._work(history.prepare)
+            IDLE_PREPARED.labels('prepared').inc()
+            if session.last_used != last_used:
+                # The chat is talking again, the rest is left to its requests
+                return
+        self._prepared[session.chat_id] = last_used
+        self.prepared += 1
+
+    async def _summarise(self, session: ChatSession, function: str, history: ConversationHistory, budget: int,
+                         last_used: float):
+        candidates = history.summary_candidates(budget)
+        if not candidates:
+            return
+        try:
+            response = await self.helper._create_chat_completion('summary', summary_request(candidates, self.helper.config))
+        except Exception as e:
+            logging.warning(f'Could not summarise the {function} history of idle chat {session.chat_id}: {e!r}')
+            return
+        if session.last_used != last_used or history[1:len(candidates) + 1] != candidates:
+            # A request of the chat used or compacted the history meanwhile
+            return
+        history.replace_with_summary(len(candidates), response.choices[0]['message']['content'])
+        IDLE_PREPARED.labels('summarised').inc()
+        logging.info(f'Summarised {len(candidates)} turns of the {function} history of idle chat {session.chat_id}')
+
+    async def _work(self, function: Callable, *args):
+        """
+        Runs some CPU-bound preparation, then sleeps long enough to keep the worker within its CPU share.
+        """
+        started = time.thread_time()
+        result = function(*args)
+        spent = time.thread_time() - started
+        self.cpu_seconds += spent
+        IDLE_SECONDS.inc(spent)
+        await asyncio.sleep(spent * (1 - self.cpu_share) / self.cpu_share)
+        return result
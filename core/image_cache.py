@@ -0,0 +1,156 @@
+import asyncio
+import hashlib
+import logging
+import os
+from collections import OrderedDict
+from typing import Awaitable, Callable, Optional
+
+from core import metrics
+from core.cache import SingleFlight
+
+IMAGE_CACHE = metrics.counter(
+    'chatgpt_image_cache_total', 'Image lookups by result (hit, miss, coalesced)', ['result'])
+IMAGE_CACHE_BYTES = metrics.gauge('chatgpt_image_cache_bytes', 'Bytes of images cached on disk')
+
+
+class ImageCache:
+    """
+    Caches generated images on disk, keyed on a hash of their prompt and size.
+
+    Concurrent requests for the same image share a single generation. The files are kept in
+    least-recently-used order and the oldest ones are deleted once the cache holds more than
+    `max_bytes`. Files are read and written in the default executor, so the event loop never
+    waits for the disk. Without a `path`, images are only shared between concurrent requests.
+    """
+
+    def __init__(self, path: Optional[str] = None, max_bytes: int = 256 * 1024 * 1024):
+        """
+        :param path: The directory the images are saved to, nothing is kept if None
+        :param max_bytes: The maximum size of the cached images
+        """
+        self.path = path
+        self.max_bytes = max_bytes
+        self.bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.coalesced = 0
+        self.evictions = 0
+        self._files: 'OrderedDict[str, int]' = OrderedDict()  # {key: size}, least recently used first
+        self._flights = SingleFlight()
+        if path is not None:
+            self.load()
+        IMAGE_CACHE_BYTES.set_function(lambda: self.bytes)
+
+    @classmethod
+    def from_config(cls, config: dict) -> 'ImageCache':
+        return cls(**config.get('image_cache', {}))
+
+    @staticmethod
+    def key(prompt: str, size: str) -> str:
+        return hashlib.sha256(f'{size}\n{prompt}'.encode()).hexdigest()
+
+    async def aget_or_compute(self, prompt: str, size: str, compute: Callable[[], Awaitable[bytes]]) -> bytes:
+        """
+        Returns the cached image of a prompt and size, or generates and caches it.
+        Concurrent misses of the same image share a single generation, see SingleFlight.
+        """
+        key = self.key(prompt, size)
+        image = await self._read(key)
+        if image is not None:
+            self.hits += 1
+            IMAGE_CACHE.labels('hit').inc()
+            return image
+
+        async def generate() -> bytes:
+            self.misses += 1
+            IMAGE_CACHE.labels('miss').inc()
+            generated = await compute()
+            await self._write(key, generated)
+            return generated
+
+        image, generated = await self._flights.run(key, generate)
+        if not generated:
+            self.coalesced += 1
+            IMAGE_CACHE.labels('coalesced').inc()
+        return image
+
+    def load(self):
+        """
+        Indexes the images already in `path`, oldest first, creating the directory if needed.
+        """
+        os.makedirs(self.path, exist_ok=True)
+        entries = []
+        for entry in os.scandir(self.path):
+            if entry.is_file() and entry.name.endswith('.png'):
+                stat = entry.stat()
+                entries.append((stat.st_mtime, entry.name[:-4], stat.st_size))
+        for _, key, size in sorted(entries):
+            self._files[key] = size
+            self.bytes += size
+        if entries:
+            logging.info(f'Found {len(entries)} cached images ({self.bytes} bytes) in {self.path}')
+        self._evict()
+
+    def stats(self) -> dict:
+        lookups = self.hits + self.misses
+        return {
+            'images': len(self._files),
+            'bytes': self.bytes,
+            'max_bytes': self.max_bytes,
+            'hits': self.hits,
+            'misses': self.misses,
+            'hit_rate': self.hits / lookups if lookups else 0.0,
+            'coalesced': self.coalesced,
+            'evictions': self.evictions,
+        }
+
+    def _file(self, key: str) -> str:
+        return os.path.join(self.path, f'{key}.png')
+
+    async def _read(self, key: str) -> Optional[bytes]:
+        if self.path is None or key not in self._files:
+            return None
+        self._files.move_to_end(key)
+        try:
+            return await asyncio.get_running_loop().run_in_executor(None, self._read_file, self._file(key))
+        except OSError as e:
+            logging.warning(f'Dropping unreadable cached image {key}: {e}')
+            self.bytes -= self._files.pop(key, 0)
+            return None
+
+    @staticmethod
+    def _read_file(file: str) -> bytes:
+        with open(file, 'rb') as image:
+            data = image.read()
+        # The modification time orders the files when the cache is loaded again
+        os.utime(file)
+        return data
+
+    async def _write(self, key: str, image: bytes):
+        if self.path is None:
+            return
+        try:
+            await asyncio.get_running_loop().run_in_executor(None, self._write_file, self._file(key), image)
+        except OSError as e:
+            logging.warning(f'Could not cache image {key}: {e}')
+            return
+        self.bytes += len(image) - self._files.pop(key, 0)
+        self._files[key] = len(image)
+        self._evict()
+
+    @staticmethod
+    def _write_file(file: str, image: bytes):
+        temporary = f'{file}.tmp'
+        with open(temporary, 'wb') as output:
+            output.write(image)
+        os.replace(temporary, file)
+
+    def _evict(self):
+        while self.bytes > self.max_bytes and self._files:
+            key, size = self._files.popitem(last=False)
+            self.bytes -= size
+            self.evictions += 1
+            try:
+                os.remove(self._file(key))
+            except FileNotFoundError:
+                pass
@@ -0,0 +1,258 @@
+import math
+import time
+from bisect import bisect_left
+from typing import Callable, Dict, List, Optional, Sequence, Tuple
+
+# Latency buckets in seconds, from a cache hit to a long completion
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0, 120.0)
+
+
+class Metric:
+    """
+    A named family of values, one per combination of label values.
+
+    Values are plain Python numbers updated without a lock: an update is a couple of attribute
+    operations, and a scrape racing with it only ever sees a count off by one.
+    """
+    kind = ''
+
+    def __init__(self, name: str, documentation: str, labels: Sequence[str] = ()):
+        """
+        :param name: The metric name, in Prometheus conventions (snake case, unit suffix)
+        :param documentation: The help text of the metric
+        :param labels: The names of the labels of the metric
+        """
+        self.name = name
+        self.documentation = documentation
+        self.label_names = tuple(labels)
+        self._children: Dict[Tuple[str, ...], object] = {}
+        if not self.label_names:
+            self._children[()] = self._new_child()
+
+    def labels(self, *values) -> object:
+        """
+        Returns the value of a label combination. Hot paths should keep the returned child.
+        """
+        child = self._children.get(values)
+        if child is None:
+            if len(values) != len(self.label_names):
+                raise ValueError(f'{self.name} takes the labels {self.label_names}, got {values}')
+            child = self._children[values] = self._new_child()
+        return child
+
+    def render(self) -> List[str]:
+        lines = [f'# HELP {self.name} {self.documentation}', f'# TYPE {self.name} {self.kind}']
+        for values, child in sorted(self._children.items()):
+            lines.extend(self._render_child(self._label_text(values), child))
+        return lines
+
+    def _label_text(self, values: Tuple[str, ...], extra: str = '') -> str:
+        pairs = [f'{name}="{_escape(str(value))}"' for name, value in zip(self.label_names, values)]
+        if extra:
+            pairs.append(extra)
+        return '{' + ','.join(pairs) + '}' if pairs else ''
+
+    def _new_child(self):
+        raise NotImplementedError
+
+    def _render_child(self, labels: str, child) -> List[str]:
+        raise NotImplementedError
+
+
+class _CounterValue:
+    __slots__ = ('value',)
+
+    def __init__(self):
+        self.value = 0.0
+
+    def inc(self, amount: float = 1.0):
+        self.value += amount
+
+
+class Counter(Metric):
+    """
+    A total that only goes up, e.g. tokens used or errors.
+    """
+    kind = 'counter'
+
+    def inc(self, amount: float = 1.0):
+        self._children[()].value += amount
+
+    def _new_child(self):
+        return _CounterValue()
+
+    def _render_child(self, labels: str, child) -> List[str]:
+        return [f'{self.name}{labels} {_number(child.value)}']
+
+
+class _GaugeValue:
+    __slots__ = ('value', 'function')
+
+    def __init__(self):
+        self.value = 0.0
+        self.function: Optional[Callable[[], float]] = None
+
+    def set(self, value: float):
+        self.value = value
+
+    def inc(self, amount: float = 1.0):
+        self.value += amount
+
+    def dec(self, amount: float = 1.0):
+        self.value -= amount
+
+    def set_function(self, function: Callable[[], float]):
+        """
+        Reads the value from a function at every scrape instead, e.g. the size of a store.
+        """
+        self.function = function
+
+
+class Gauge(Metric):
+    """
+    A value that goes up and down, e.g. the number of active sessions.
+    """
+    kind = 'gauge'
+
+    def set(self, value: float):
+        self._children[()].value = value
+
+    def inc(self, amount: float = 1.0):
+        self._children[()].value += amount
+
+    def dec(self, amount: float = 1.0):
+        self._children[()].value -= amount
+
+    def set_function(self, function: Callable[[], float]):
+        self._children[()].set_function(function)
+
+    def _new_child(self):
+        return _GaugeValue()
+
+    def _render_child(self, labels: str, child) -> List[str]:
+        value = child.value
+        if child.function is not None:
+            try:
+                value = child.function()
+            except Exception:
+                value = math.nan
+        return [f'{self.name}{labels} {_number(value)}']
+
+
+class _HistogramValue:
+    __slots__ = ('bounds', 'counts', 'sum', 'count')
+
+    def __init__(self, bounds: Tuple[float, ...]):
+        self.bounds = bounds
+        self.counts = [0] * (len(bounds) + 1)
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value: float):
+        self.counts[bisect_left(self.bounds, value)] += 1
+        self.sum += value
+        self.count += 1
+
+    def time(self) -> '_Timer':
+        """
+        Returns a context manager observing the seconds spent in its block.
+        """
+        return _Timer(self)
+
+
+class Histogram(Metric):
+    """
+    A distribution of observed values, e.g. latencies, counted in cumulative buckets.
+    """
+    kind = 'histogram'
+
+    def __init__(self, name: str, documentation: str, labels: Sequence[str] = (),
+                 buckets: Sequence[float] = LATENCY_BUCKETS):
+        """
+        :param buckets: The upper bounds of the buckets, in increasing order
+        """
+        self.buckets = tuple(buckets)
+        super().__init__(name, documentation, labels)
+
+    def observe(self, value: float):
+        self._children[()].observe(value)
+
+    def time(self) -> '_Timer':
+        return _Timer(self._children[()])
+
+    def _new_child(self):
+        return _HistogramValue(self.buckets)
+
+    def _render_child(self, labels: str, child) -> List[str]:
+        values = labels[1:-1] if labels else ''
+        lines, cumulative = [], 0
+        for bound, count in zip(self.buckets + (math.inf,), child.counts):
+            cumulative += count
+            le = f'le="{_number(bound)}"'
+            lines.append(f'{self.name}_bucket{{{values + "," if values else ""}{le}}} {cumulative}')
+        lines.append(f'{self.name}_sum{labels} {_number(child.sum)}')
+        lines.append(f'{self.name}_count{labels} {child.count}')
+        return lines
+
+
+class _Timer:
+    __slots__ = ('histogram', 'start')
+
+    def __init__(self, histogram: _HistogramValue):
+        self.histogram = histogram
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc_info):
+        self.histogram.observe(time.perf_counter() - self.start)
+
+
+class Registry:
+    """
+    The metrics of the process, rendered together in the Prometheus text exposition format.
+    """
+
+    def __init__(self):
+        self._metrics: Dict[str, Metric] = {}
+
+    def register(self, metric: Metric) -> Metric:
+        """
+        Adds a metric, or returns the one already registered under its name.
+        """
+        return self._metrics.setdefault(metric.name, metric)
+
+    def render(self) -> str:
+        lines = []
+        for metric in self._metrics.values():
+            lines.extend(metric.render())
+        return '\n'.join(lines) + '\n'
+
+
+REGISTRY = Registry()
+
+
+def counter(name: str, documentation: str, labels: Sequence[str] = ()) -> Counter:
+    return REGISTRY.register(Counter(name, documentation, labels))
+
+
+def gauge(name: str, documentation: str, labels: Sequence[str] = ()) -> Gauge:
+    return REGISTRY.register(Gauge(name, documentation, labels))
+
+
+def histogram(name: str, documentation: str, labels: Sequence[str] = (),
+              buckets: Sequence[float] = LATENCY_BUCKETS) -> Histogram:
+    return REGISTRY.register(Histogram(name, documentation, labels, buckets))
+
+
+def _escape(value: str) -> str:
+    return value.replace('\\', '\\\\').replace('\n', '\\n').replace('"', '\\"')
+
+
+def _number(value: float) -> str:
+    if math.isnan(value):
+        return 'NaN'
+    if math.isinf(value):
+        return '+Inf' if value > 0 else '-Inf'
+    return repr(float(value)) if value != int(value) else str(int(value))
@@ -1,24 +1,157 @@
+import asyncio
+import base64
 import logging
-from typing import Iterator, Union
+import time
+from contextlib import contextmanager
+from typing import AsyncIterator, BinaryIO, Iterator, List, Optional, Tuple, Union
 
+import aiohttp
 import openai
 
+from core import metrics, wire
+from core.history import ConversationHistory, Message, count_tokens, prompt_budget, summary_request
+from core.idle_worker import IdleWorker
+from core.image_cache import ImageCache
+from core.rate_limiter import RETRIABLE_ERRORS, RateLimiter, request_tokens
+from core.response_cache import ResponseCache
+from core.router import Route, RouteCall, Router
+from core.session_store import SessionStore
+
+
+OPENAI_SECONDS = metrics.histogram(
+    'chatgpt_openai_request_seconds', 'Time until an OpenAI call returned, or until the last token of a streamed answer',
+    ['endpoint', 'function'])
+OPENAI_FIRST_TOKEN_SECONDS = metrics.histogram(
+    'chatgpt_openai_first_token_seconds', 'Time until the first token of a streamed answer', ['function'])
+OPENAI_TOKENS = metrics.counter(
+    'chatgpt_openai_tokens_total', 'Tokens sent to and received from the OpenAI API', ['function', 'type'])
+OPENAI_PROMPT_TOKENS = metrics.histogram(
+    'chatgpt_openai_prompt_tokens', 'Estimated prompt tokens of the ChatCompletion requests', ['function'],
+    buckets=(64, 128, 256, 512, 1024, 2048, 4096, 8192, 16384, 32768))
+OPENAI_ERRORS = metrics.counter(
+    'chatgpt_openai_errors_total', 'OpenAI calls that failed after their retries', ['endpoint', 'error'])
+OPENAI_TOKENS_SAVED = metrics.counter(
+    'chatgpt_openai_tokens_saved_total', 'Completion tokens of streamed answers not generated because they were cancelled',
+    ['function'])
+HEDGE_WINS = metrics.counter(
+    'chatgpt_openai_hedge_wins_total', 'Hedged requests that produced the first token, by position and model',
+    ['attempt', 'model'])
+# Errors after which a routed request is sent to the next model of its route, e.g. a context too long for the model
+FALLBACK_ERRORS = RETRIABLE_ERRORS + (openai.error.APIError, openai.error.InvalidRequestError)
+
+SESSIONS = metrics.gauge('chatgpt_sessions', 'Chats whose conversations are held in memory')
+SESSION_BYTES = metrics.gauge('chatgpt_session_bytes', 'Bytes of conversation history held in memory')
+
+
+@contextmanager
+def _observed(endpoint: str, function: str, stream: bool = False):
+    """
+    Records the latency and the errors of an OpenAI call. Streamed answers record their latency once the stream ends.
+    """
+    start = time.perf_counter()
+    try:
+        yield
+    except Exception as e:
+        OPENAI_ERRORS.labels(endpoint, type(e).__name__).inc()
+        raise
+    if not stream:
+        OPENAI_SECONDS.labels(endpoint, function).observe(time.perf_counter() - start)
+
+
+def _rewound(file: BinaryIO) -> BinaryIO:
+    """
+    Seeks a file back to its start, so that a retried upload sends it whole.
+    """
+    file.seek(0)
+    return file
+
+
+def _summary_candidates(config: dict, history: ConversationHistory, budget: int) -> List[Message]:
+    """
+    Returns the oldest turns to fold into a summary when the history outgrows the prompt budget.
+    Nothing is summarised unless `summarise_history` is enabled; old turns are simply dropped instead.
+    """
+    if not config.get('summarise_history'):
+        return []
+    return history.summary_candidates(budget)
+
+
+def _apply_summary(history: ConversationHistory, candidates: List[Message], response, chat_id: int, function: str):
+    """
+    Replaces the summarised turns of a history with the summary of a ChatCompletion response.
+    """
+    history.replace_with_summary(len(candidates), response.choices[0]['message']['content'])
+    logging.info(f'Summarised {len(candidates)} turns of the {function} history of chat {chat_id}')
+
+
+def _attempts(request: dict, tokens: int, call: Optional[RouteCall]) -> Iterator[Tuple[str, dict, Optional[int]]]:
+    """
+    Yields the model, the request and the retries of every attempt of a ChatCompletion request.
+    The retries of the models that have a fallback are limited to the `fallback_retries` of the route.
+    """
+    if call is None:
+        yield request['model'], request, None
+        return
+    call.prompt_tokens = tokens - (request.get('max_tokens') or 0) * (request.get('n') or 1)
+    models = call.route.models
+    for attempt, model in enumerate(models):
+        last = attempt == len(models) - 1
+        yield model, dict(request, model=model), None if last else call.route.fallback_retries
+
+
+def _fall_back(call: Optional[RouteCall], model: str, has_fallback: bool, error: Exception):
+    """
+    Records a failed attempt, and raises its error unless the next model of the route can be tried.
+    """
+    if call is None:
+        raise error
+    if has_fallback and isinstance(error, FALLBACK_ERRORS):
+        call.fallback(model, error)
+        return
+    call.fail(model)
+    raise error
+
+
+def _record_completion(function: str, request: dict, tokens: int, response, call: Optional[RouteCall]):
+    """
+    Records the tokens of a ChatCompletion: the usage the API reported, or the estimated prompt of a stream,
+    whose completion tokens are counted once it ends. Also records the latency and the cost of a routed answer.
+    """
+    prompt = tokens - (request.get('max_tokens') or 0) * (request.get('n') or 1)
+    OPENAI_PROMPT_TOKENS.labels(function).observe(prompt)
+    if request.get('stream'):
+        OPENAI_TOKENS.labels(function, 'prompt').inc(prompt)
+        return
+    OPENAI_TOKENS.labels(function, 'prompt').inc(response.usage['prompt_tokens'])
+    OPENAI_TOKENS.labels(function, 'completion').inc(response.usage['completion_tokens'])
+    if call is not None:
+        call.finish(response.get('model', request['model']), response.usage['completion_tokens'],
+                    response.usage['prompt_tokens'])
+
 
 class OpenAIHelper:
     """
     ChatGPT helper class.
     """
 
-    def __init__(self, config: dict):
+    def __init__(self, config: dict, sessions: SessionStore = None):
         """
         Initializes the OpenAI helper class with the given configuration.
         :param config: A dictionary containing the GPT configuration
+        :param sessions: The store of the conversation histories, an in-memory store built from `config` by default
         """
         openai.api_key = config['api_key']
         openai.proxy = config['proxy']
+        # Conversations are sent with the JSON their histories keep, only the new turn is encoded
+        self.encoded_requests = wire.install()
         self.config = config
-        self.sessions: dict[int: dict[str: list]] = dict() # {chat_id: history}
+        self.sessions = sessions if sessions is not None else SessionStore.from_config(config) # {chat_id: {function: history}}
         self.functions = {"assistant", "polish", "translate", "diction"}
+        self.rate_limiter = RateLimiter.from_config(config)
+        self.response_cache = ResponseCache.from_config(config)
+        self.router = Router.from_config(config)
+        SESSIONS.set_function(lambda: self.sessions.stats()['sessions'])
+        SESSION_BYTES.set_function(lambda: self.sessions.stats()['bytes'])
 
     def get_function(self) -> str:
         # TODO
@@ -33,50 +166,17 @@ class OpenAIHelper:
         :return: The answer from the model
         """
         try:
-            if chat_id not in self.sessions:
-                self.reset_chat_history(chat_id)
-
-            self.__add_to_history(chat_id, "user", function, content=query)
-
-            response = openai.ChatCompletion.create(
-                model=self.config['model'],
-                messages=self.sessions[chat_id][function],
-                temperature=self.config['temperature'],
-                n=self.config['n_choices'],
-                max_tokens=self.config['max_tokens'],
-                presence_penalty=self.config['presence_penalty'],
-                frequency_penalty=self.config['frequency_penalty'],
-                stream=stream
-            )
+            self._append_query(chat_id, function, query)
+            route = self._route_chat(chat_id, function)
+            self._summarise_history(chat_id, function, route)
+            response = self._create_chat_completion(
+                function, self._build_chat_request(chat_id, function, stream, route), self.router.start(route))
 
             if stream:
                 #TODO
                 return response
 
-            if len(response.choices) > 0:
-                answer = ''
-
-                if len(response.choices) > 1 and self.config['n_choices'] > 1:
-                    for index, choice in enumerate(response.choices):
-                        if index == 0:
-                            self.__add_to_history(chat_id, "assistant", function, content=choice['message']['content'])
-                        answer += f'{index+1}\u20e3\n'
-                        answer += choice['message']['content']
-                        answer += '\n\n'
-                else:
-                    answer = response.choices[0]['message']['content']
-                    self.__add_to_history(chat_id, "assistant", function, content=answer)
-
-                if self.config['show_usage']:
-                    answer += "\n\n---\n" \
-                              f"💰 Tokens used: {str(response.usage['total_tokens'])}" \
-                              f" ({str(response.usage['prompt_tokens'])} prompt," \
-                              f" {str(response.usage['completion_tokens'])} completion)"
-
-                return answer
-            else:
-                logging.error('No response from GPT-3')
-                return "⚠️ _An error has occurred_ ⚠️\nPlease try again in a while."
+            return self._parse_chat_response(chat_id, function, response)
 
         except openai.error.RateLimitError as e:
             logging.exception(e)
@@ -90,6 +190,21 @@ class OpenAIHelper:
             logging.exception(e)
             return f"⚠️ _An error has occurred_ ⚠️\n{str(e)}"
 
+    def get_stateless_response(self, function: str, query: str, **overrides) -> str:
+        """
+        Gets a response to a single query, without reading or recording any conversation history.
+        Unlike `get_chat_response`, errors are raised instead of being returned as the answer.
+        Deterministic answers of the functions configured in `response_cache` are cached.
+        :param function: The function the query is for
+        :param query: The query to send to the model
+        :param overrides: ChatCompletion arguments that replace the configured ones, e.g. `max_tokens`
+        :return: The answer from the model
+        """
+        route = self._route_stateless(function, query)
+        request = self._build_stateless_request(function, query, route, **overrides)
+        return self.response_cache.get_or_compute(
+            function, request,
+            lambda: self._create_chat_completion(function, request, self.router.start(route)).choices[0]['message']['content'])
 
     def generate_image(self, prompt: str) -> str:
         """
@@ -98,25 +213,30 @@ class OpenAIHelper:
         :return: The image URL
         """
         try:
-            response = openai.Image.create(
-                prompt=prompt,
-                n=1,
-                size=self.config['image_size']
-            )
+            with _observed('image', 'image'):
+                response = self.rate_limiter.call_blocking(lambda: openai.Image.create(
+                    prompt=prompt,
+                    n=1,
+                    size=self.config['image_size']
+                ))
             return response['data'][0]['url']
 
         except Exception as e:
             logging.exception(e)
             raise e
 
-    def transcribe(self, filename):
+    def transcribe(self, audio: Union[str, BinaryIO]):
         """
         Transcribes the audio file using the Whisper model.
+        :param audio: The path of the file, or a file object whose `name` gives the audio format
         """
         try:
-            with open(filename, "rb") as audio:
-                result = openai.Audio.transcribe("whisper-1", audio)
-                return result.text
+            with _observed('transcription', 'transcribe'):
+                if isinstance(audio, str):
+                    with open(audio, "rb") as file:
+                        return self.rate_limiter.call_blocking(
+                            lambda: openai.Audio.transcribe("whisper-1", _rewound(file))).text
+                return self.rate_limiter.call_blocking(lambda: openai.Audio.transcribe("whisper-1", _rewound(audio))).text
         except Exception as e:
             logging.exception(e)
             raise e
@@ -125,15 +245,516 @@ class OpenAIHelper:
         """
         Resets the conversation history.
         """
-        self.sessions[chat_id] = {function: [{"role": "system", "content": self.config['assistant_prompt']}]
-                                  for function in self.functions}
+        self.sessions.reset(chat_id)
+
+    def _append_query(self, chat_id: int, function: str, query: str):
+        """
+        Appends the query to the conversation history, creating the history on first use.
+        """
+        self._add_to_history(chat_id, "user", function, content=query)
+
+    def _route_chat(self, chat_id: int, function: str, model: Optional[str] = None,
+                    max_tokens: Optional[int] = None) -> Route:
+        """
+        Chooses the route of a conversation by the size of its latest query and of the whole history.
+        :param model: The model the chat chose, which replaces the model of the route
+        :param max_tokens: The answer budget the chat chose, which caps the `max_tokens` of the route
+        """
+        history = self.sessions[chat_id][function]
+        route = self.router.route(function, history[-1].tokens if len(history) else 0, history.tokens)
+        changes = {}
+        if model and model != route.model:
+            changes['model'] = model
+        if max_tokens and max_tokens < route.max_tokens:
+            changes['max_tokens'] = max_tokens
+        return route.replace(**changes) if changes else route
+
+    def _route_stateless(self, function: str, query: str) -> Route:
+        return self.router.route(function, count_tokens(query, self.config['model']))
+
+    def _prompt_budget(self, route: Route) -> int:
+        """
+        Returns the prompt budget left by the model and the `max_tokens` of a route.
+        """
+        return prompt_budget(dict(self.config, model=route.model, max_tokens=route.max_tokens))
+
+    def _summarise_history(self, chat_id: int, function: str, route: Route):
+        """
+        Folds the oldest turns into a summary when the history outgrows the prompt budget.
+        """
+        history = self.sessions[chat_id][function]
+        candidates = _summary_candidates(self.config, history, self._prompt_budget(route))
+        if not candidates:
+            return
+        try:
+            response = self._create_chat_completion('summary', summary_request(candidates, self.config))
+            _apply_summary(history, candidates, response, chat_id, function)
+        except Exception as e:
+            logging.exception(e)
+
+    def _create_chat_completion(self, function: str, request: dict, call: RouteCall = None):
+        """
+        Sends a ChatCompletion request within the rate limits, retrying it if it is rate limited.
+        A routed request falls back to the next model of its route when its model fails.
+        """
+        tokens = request_tokens(request)
+        for model, routed, max_retries in _attempts(request, tokens, call):
+            try:
+                with _observed('chat', function, request.get('stream', False)):
+                    response = self.rate_limiter.call_blocking(
+                        lambda: openai.ChatCompletion.create(**routed), tokens, max_retries)
+                break
+            except Exception as e:
+                _fall_back(call, model, max_retries is not None, e)
+        _record_completion(function, request, tokens, response, call)
+        return response
+
+    def _build_chat_request(self, chat_id: int, function: str, stream: bool, route: Route = None) -> dict:
+        """
+        Builds the ChatCompletion arguments, dropping the oldest turns if the history still exceeds the prompt budget.
+        :param chat_id: The chat ID
+        :param function: The function whose history is used
+        :param stream: Whether the response should be streamed
+        :param route: The route giving the model, `max_tokens` and temperature, the default route if None
+        :return: The keyword arguments for `ChatCompletion.create`
+        """
+        route = route or self.router.default
+        history = self.sessions[chat_id][function]
+        history.budget = self._prompt_budget(route)
+        dropped = history.trim(history.budget)
+        if dropped:
+            logging.info(f'Dropped {dropped} turns of the {function} history of chat {chat_id}')
+
+        return dict(
+            model=route.model,
+            messages=history.encoded_messages() if self.encoded_requests else history.messages,
+            temperature=route.temperature,
+            n=self.config['n_choices'],
+            max_tokens=route.max_tokens,
+            presence_penalty=self.config['presence_penalty'],
+            frequency_penalty=self.config['frequency_penalty'],
+            stream=stream
+        )
+
+    def _build_stateless_request(self, function: str, query: str, route: Route = None, **overrides) -> dict:
+        """
+        Builds the ChatCompletion arguments of a query sent with the system prompt only.
+        The `overrides` win over the model, `max_tokens` and temperature of the route.
+        """
+        route = route or self.router.default
+        return dict(dict(
+            model=route.model,
+            messages=[
+                {"role": "system", "content": self.config['assistant_prompt']},
+                {"role": "user", "content": query},
+            ],
+            temperature=route.temperature,
+            max_tokens=route.max_tokens,
+            presence_penalty=self.config['presence_penalty'],
+            frequency_penalty=self.config['frequency_penalty'],
+        ), **overrides)
+
+    def _parse_chat_response(self, chat_id: int, function: str, response) -> str:
+        """
+        Renders a non-streamed ChatCompletion response and records the answer in the history.
+        :param chat_id: The chat ID
+        :param function: The function whose history is used
+        :param response: The ChatCompletion response
+        :return: The answer from the model
+        """
+        if len(response.choices) > 0:
+            answer = ''
+
+            if len(response.choices) > 1 and self.config['n_choices'] > 1:
+                for index, choice in enumerate(response.choices):
+                    if index == 0:
+                        self._add_to_history(chat_id, "assistant", function, content=choice['message']['content'])
+                    answer += f'{index+1}\u20e3\n'
+                    answer += choice['message']['content']
+                    answer += '\n\n'
+            else:
+                answer = response.choices[0]['message']['content']
+                self._add_to_history(chat_id, "assistant", function, content=answer)
+
+            if self.config['show_usage']:
+                answer += "\n\n---\n" \
+                          f"💰 Tokens used: {str(response.usage['total_tokens'])}" \
+                          f" ({str(response.usage['prompt_tokens'])} prompt," \
+                          f" {str(response.usage['completion_tokens'])} completion)"
 
+            return answer
+        else:
+            logging.error('No response from GPT-3')
+            return "⚠️ _An error has occurred_ ⚠️\nPlease try again in a while."
 
-    def __add_to_history(self, chat_id, role, function: str, content):
+    def _add_to_history(self, chat_id, role, function: str, content):
         """
         Adds a message to the conversation history.
         :param chat_id: The chat ID
         :param role: The role of the message sender
         :param content: The message content
         """
-        self.sessions[chat_id][function].append({"role": role, "content": content})
+        self.sessions[chat_id][function].append(role, content)
+
+
+class AsyncOpenAIHelper(OpenAIHelper):
+    """
+    ChatGPT helper class for asyncio callers.
+
+    Requests go through `ChatCompletion.acreate` and friends on a shared aiohttp session, so a slow
+    completion only suspends the handler awaiting it instead of the whole event loop.
+    """
+
+    def __init__(self, config: dict, sessions: SessionStore = None):
+        """
+        Initializes the async OpenAI helper class with the given configuration.
+        :param config: A dictionary containing the GPT configuration
+        :param sessions: The store of the conversation histories
+        """
+        super().__init__(config, sessions)
+        self._session = None
+        self.idle_worker = IdleWorker.from_config(self, config)
+        self.image_cache = ImageCache.from_config(config)
+
+    async def get_chat_response(self, chat_id: int, function: str, query: str, stream: bool = False,
+                                model: Optional[str] = None, max_tokens: Optional[int] = None) -> Union[str, AsyncIterator[str]]:
+        """
+        Gets a response from the GPT-3 model without blocking the event loop.
+        :param chat_id: The chat ID
+        :param function: The function whose history is used
+        :param query: The query to send to the model
+        :param stream: Whether to return an async iterator over the answer deltas
+        :param model: The model to use instead of the routed one
+        :param max_tokens: The maximum number of tokens of the answer, if lower than the routed one
+        :return: The answer from the model, or an async iterator of text deltas if `stream` is set
+        """
+        try:
+            response, call, streams = await self._send_chat_request(chat_id, function, query, stream, model, max_tokens)
+
+            if stream:
+                return self._iter_stream(chat_id, function, response, call, streams)
+
+            return self._parse_chat_response(chat_id, function, response)
+
+        except Exception as e:
+            logging.exception(e)
+            return self._error_response(self._error_message(e), stream)
+
+    async def get_chat_choices(self, chat_id: int, function: str, query: str, model: Optional[str] = None,
+                               max_tokens: Optional[int] = None) -> AsyncIterator[Tuple[int, str]]:
+        """
+        Streams all `n_choices` choices of an answer at the same time. The first choice is recorded in the history.
+        :param chat_id: The chat ID
+        :param function: The function whose history is used
+        :param query: The query to send to the model
+        :param model: The model to use instead of the routed one
+        :param max_tokens: The maximum number of tokens of the answer, if lower than the routed one
+        :return: An async iterator of `(choice index, text delta)` pairs
+        """
+        try:
+            response, call, streams = await self._send_chat_request(chat_id, function, query, True, model, max_tokens)
+            return self._iter_choices(chat_id, function, response, call, streams)
+
+        except Exception as e:
+            logging.exception(e)
+
+            async def single():
+                yield 0, self._error_message(e)
+            return single()
+
+    async def get_stateless_response(self, function: str, query: str, **overrides) -> str:
+        """
+        Gets a response to a single query, without reading or recording any conversation history.
+        Unlike `get_chat_response`, errors are raised instead of being returned as the answer.
+        Deterministic answers of the functions configured in `response_cache` are cached.
+        """
+        route = self._route_stateless(function, query)
+        request = self._build_stateless_request(function, query, route, **overrides)
+
+        async def complete() -> str:
+            await self._use_session()
+            response = await self._create_chat_completion(function, request, self.router.start(route))
+            return response.choices[0]['message']['content']
+        return await self.response_cache.aget_or_compute(function, request, complete)
+
+    async def generate_image(self, prompt: str) -> str:
+        """
+        Generates an image from the given prompt using DALL·E model.
+        :param prompt: The prompt to send to the model
+        :return: The image URL
+        """
+        try:
+            await self._use_session()
+            with _observed('image', 'image'):
+                response = await self.rate_limiter.call(lambda: openai.Image.acreate(
+                    prompt=prompt,
+                    n=1,
+                    size=self.config['image_size']
+                ))
+            return response['data'][0]['url']
+
+        except Exception as e:
+            logging.exception(e)
+            raise e
+
+    async def generate_image_bytes(self, prompt: str, size: Optional[str] = None) -> bytes:
+        """
+        Generates an image from the given prompt and returns it as PNG bytes, sent by the API in its response
+        rather than as a URL to download it from. Images are cached by prompt and size.
+        :param prompt: The prompt to send to the model
+        :param size: The size of the image, `image_size` by default
+        :return: The PNG image
+        """
+        size = size or self.config['image_size']
+
+        async def generate() -> bytes:
+            await self._use_session()
+            with _observed('image', 'image'):
+                response = await self.rate_limiter.call(lambda: openai.Image.acreate(
+                    prompt=prompt,
+                    n=1,
+                    size=size,
+                    response_format='b64_json'
+                ))
+            return base64.b64decode(response['data'][0]['b64_json'])
+        return await self.image_cache.aget_or_compute(prompt, size, generate)
+
+    async def transcribe(self, audio: Union[str, BinaryIO]):
+        """
+        Transcribes the audio file using the Whisper model.
+        :param audio: The path of the file, or a file object whose `name` gives the audio format
+        """
+        try:
+            await self._use_session()
+            with _observed('transcription', 'transcribe'):
+                if isinstance(audio, str):
+                    with open(audio, "rb") as file:
+                        return (await self.rate_limiter.call(
+                            lambda: openai.Audio.atranscribe("whisper-1", _rewound(file)))).text
+                return (await self.rate_limiter.call(
+                    lambda: openai.Audio.atranscribe("whisper-1", _rewound(audio)))).text
+        except Exception as e:
+            logging.exception(e)
+            raise e
+
+    async def _summarise_history(self, chat_id: int, function: str, route: Route):
+        """
+        Folds the oldest turns into a summary when the history outgrows the prompt budget.
+        """
+        history = self.sessions[chat_id][function]
+        candidates = _summary_candidates(self.config, history, self._prompt_budget(route))
+        if not candidates:
+            return
+        try:
+            response = await self._create_chat_completion('summary', summary_request(candidates, self.config))
+            _apply_summary(history, candidates, response, chat_id, function)
+        except Exception as e:
+            logging.exception(e)
+
+    async def _send_chat_request(self, chat_id: int, function: str, query: str, stream: bool,
+                                 model: Optional[str] = None, max_tokens: Optional[int] = None) -> tuple:
+        """
+        Records the query and sends the conversation, hedged if streamed and `hedge` is configured.
+        :return: The response, the route call recording its latency and cost, and the HTTP responses of its streams
+        """
+        await self._use_session()
+        await self.sessions.aload(chat_id, function)
+        self._append_query(chat_id, function, query)
+        route = self._route_chat(chat_id, function, model, max_tokens)
+        await self._summarise_history(chat_id, function, route)
+        request = self._build_chat_request(chat_id, function, stream, route)
+        call = self.router.start(route)
+        with wire.streams() as streams:
+            if stream and self.config.get('hedge', {}).get('models'):
+                return await self._hedged_completion(function, request, call), call, streams
+            return await self._create_chat_completion(function, request, call), call, streams
+
+    async def _create_chat_completion(self, function: str, request: dict, call: RouteCall = None):
+        """
+        Sends a ChatCompletion request within the rate limits, retrying it if it is rate limited.
+        A routed request falls back to the next model of its route when its model fails.
+        """
+        tokens = request_tokens(request)
+        for model, routed, max_retries in _attempts(request, tokens, call):
+            try:
+                with _observed('chat', function, request.get('stream', False)):
+                    response = await self.rate_limiter.call(
+                        lambda: openai.ChatCompletion.acreate(**routed), tokens, max_retries)
+                break
+            except Exception as e:
+                _fall_back(call, model, max_retries is not None, e)
+        _record_completion(function, request, tokens, response, call)
+        return response
+
+    async def _hedged_completion(self, function: str, request: dict, call: RouteCall = None) -> AsyncIterator[dict]:
+        """
+        Sends a streamed request, then a copy of it to each model of `hedge.models` every `hedge.delay` seconds
+        until one of them streams its first token. That one is kept and the others are cancelled.
+        Only the first request falls back along the route of `call`.
+        :return: The chunks of the first request to answer
+        """
+        hedge = self.config['hedge']
+        requests = [request] + [dict(request, model=model) for model in hedge['models']]
+        delay = hedge.get('delay', 0)
+
+        async def first_chunk(hedged: dict) -> tuple:
+            stream = await self._create_chat_completion(function, hedged, call if hedged is request else None)
+            try:
+                async for chunk in stream:
+                    if chunk['choices'] and chunk['choices'][0]['delta'].get('content'):
+                        return chunk, stream
+            except asyncio.CancelledError:
+                await stream.aclose()
+                raise
+            return None, stream
+
+        tasks: List[asyncio.Task] = []
+        pending = set()
+        error = None
+        winner = None
+        try:
+            while winner is None:
+                if len(tasks) < len(requests):
+                    task = asyncio.ensure_future(first_chunk(requests[len(tasks)]))
+                    tasks.append(task)
+                    pending.add(task)
+                if not pending:
+                    raise error
+                # Once every copy is out, only the first token is waited for
+                timeout = delay if len(tasks) < len(requests) else None
+                done, pending = await asyncio.wait(pending, timeout=timeout, return_when=asyncio.FIRST_COMPLETED)
+                for task in done:
+                    if task.exception() is not None:
+                        error = error or task.exception()
+                    elif task.result()[0] is not None or not (pending or len(tasks) < len(requests)):
+                        # An empty answer only wins if nothing else can answer
+                        winner = task
+                        break
+
+            chunk, stream = winner.result()
+            attempt = tasks.index(winner)
+            HEDGE_WINS.labels(str(attempt), requests[attempt]['model']).inc()
+            return self._chain(chunk, stream)
+        finally:
+            for task in tasks:
+                if task is winner:
+                    continue
+                if not task.done():
+                    task.cancel()
+                elif not task.cancelled() and task.exception() is None:
+                    await task.result()[1].aclose()
+
+    @staticmethod
+    async def _chain(first: dict, stream: AsyncIterator[dict]) -> AsyncIterator[dict]:
+        try:
+            if first is not None:
+                yield first
+            async for chunk in stream:
+                yield chunk
+        finally:
+            await stream.aclose()
+
+    async def close(self):
+        """
+        Closes the pooled HTTP session.
+        """
+        if self.idle_worker is not None:
+            await self.idle_worker.stop()
+        if self._session is not None and not self._session.closed:
+            await self._session.close()
+        self._session = None
+
+    async def _iter_stream(self, chat_id: int, function: str, response, call: RouteCall,
+                           streams: List[aiohttp.ClientResponse]) -> AsyncIterator[str]:
+        """
+        Yields the text deltas of the first choice of a streamed response.
+        """
+        choices = self._iter_choices(chat_id, function, response, call, streams)
+        try:
+            async for index, delta in choices:
+                if index == 0:
+                    yield delta
+        finally:
+            await choices.aclose()
+
+    async def _iter_choices(self, chat_id: int, function: str, response, call: RouteCall,
+                            streams: List[aiohttp.ClientResponse]) -> AsyncIterator[Tuple[int, str]]:
+        """
+        Yields the `(choice index, text delta)` pairs of a streamed response and records the first choice
+        once the answer is complete.
+
+        If the answer is cancelled or closed before it ends, its streams are closed so that the API stops
+        generating it, and the partial first choice is recorded only if `cancelled_answers` is 'partial'.
+        :param call: The route call of the request, which holds the `time.perf_counter()` it was sent at
+        :param streams: The HTTP responses of the request and of its hedged copies
+        """
+        started = call.started
+        answers = {}
+        model = call.route.model
+        try:
+            async for chunk in response:
+                model = chunk.get('model', model)
+                for choice in chunk['choices']:
+                    delta = choice['delta'].get('content')
+                    if delta:
+                        if not answers:
+                            OPENAI_FIRST_TOKEN_SECONDS.labels(function).observe(time.perf_counter() - started)
+                        answers[choice['index']] = answers.get(choice['index'], '') + delta
+                        yield choice['index'], delta
+        except (asyncio.CancelledError, GeneratorExit):
+            wire.close_streams(streams)
+            await response.aclose()
+            self._cancel_answer(chat_id, function, call, model, answers)
+            raise
+        OPENAI_SECONDS.labels('chat', function).observe(time.perf_counter() - started)
+        completion = sum(count_tokens(answer, model) for answer in answers.values())
+        if answers:
+            OPENAI_TOKENS.labels(function, 'completion').inc(completion)
+        call.finish(model, completion)
+        if answers.get(0):
+            self._add_to_history(chat_id, "assistant", function, content=answers[0])
+
+    def _cancel_answer(self, chat_id: int, function: str, call: RouteCall, model: str, answers: dict):
+        """
+        Records a streamed answer given up on: the tokens it used, the tokens it no longer uses, and its
+        partial first choice if the history keeps partial answers.
+        """
+        completion = sum(count_tokens(answer, model) for answer in answers.values())
+        saved = max(0, call.route.max_tokens * (self.config.get('n_choices') or 1) - completion)
+        OPENAI_TOKENS.labels(function, 'completion').inc(completion)
+        OPENAI_TOKENS_SAVED.labels(function).inc(saved)
+        call.cancel(model, completion)
+        logging.info(f'Cancelled the {function} answer of chat {chat_id} after {completion} tokens, saving up to {saved}')
+        if answers.get(0) and self.config.get('cancelled_answers', 'partial') == 'partial':
+            self._add_to_history(chat_id, "assistant", function, content=answers[0])
+
+    @staticmethod
+    def _error_message(error: Exception) -> str:
+        if isinstance(error, openai.error.RateLimitError):
+            return f"⚠️ _OpenAI Rate Limit exceeded_ ⚠️\n{str(error)}"
+        if isinstance(error, openai.error.InvalidRequestError):
+            return f"⚠️ _OpenAI Invalid request_ ⚠️\n{str(error)}"
+        return f"⚠️ _An error has occurred_ ⚠️\n{str(error)}"
+
+    @staticmethod
+    def _error_response(message: str, stream: bool) -> Union[str, AsyncIterator[str]]:
+        if not stream:
+            return message
+
+        async def single():
+            yield message
+        return single()
+
+    async def _use_session(self):
+        """
+        Binds the pooled aiohttp session to the current task.
+
+        `openai.aiosession` is a ContextVar, so it is set per task rather than once globally;
+        without it the library opens a fresh connection for every request.
+        """
+        if self._session is None or self._session.closed:
+            connector = aiohttp.TCPConnector(limit=self.config.get('max_connections', 100))
+            self._session = aiohttp.ClientSession(connector=connector)
+        openai.aiosession.set(self._session)
+        if self.idle_worker is not None:
+            self.idle_worker.start()
@@ -0,0 +1,236 @@
+import asyncio
+import logging
+import random
+import threading
+import time
+from collections import deque
+from typing import Awaitable, Callable, Deque, Optional, Tuple, TypeVar
+
+import openai
+
+from core.history import TOKENS_PER_MESSAGE, TOKENS_PER_REPLY, EncodedMessages, count_tokens
+
+T = TypeVar('T')
+
+# Errors worth trying again: the quota, an overloaded server or a dropped connection
+RETRIABLE_ERRORS = (
+    openai.error.RateLimitError,
+    openai.error.ServiceUnavailableError,
+    openai.error.APIConnectionError,
+    openai.error.Timeout,
+    openai.error.TryAgain,
+)
+
+
+def request_tokens(request: dict) -> int:
+    """
+    Estimates the tokens a ChatCompletion request counts against the quota: its prompt plus
+    `max_tokens` for every choice, which is how the API accounts for it before answering.
+    :param request: The keyword arguments of `ChatCompletion.create`
+    """
+    model = request.get('model', 'gpt-3.5-turbo')
+    messages = request['messages']
+    if isinstance(messages, EncodedMessages):
+        # Counted by the history when the messages were appended
+        prompt = messages.tokens
+    else:
+        prompt = sum(TOKENS_PER_MESSAGE + count_tokens(message['content'], model) for message in messages)
+    return prompt + TOKENS_PER_REPLY + (request.get('max_tokens') or 0) * (request.get('n') or 1)
+
+
+def retry_after(error: Exception) -> Optional[float]:
+    """
+    Returns the number of seconds the API asked to wait before retrying, if it said so.
+    """
+    headers = getattr(error, 'headers', None) or {}
+    try:
+        if headers.get('retry-after-ms'):
+            return float(headers['retry-after-ms']) / 1000
+        if headers.get('retry-after'):
+            return float(headers['retry-after'])
+    except ValueError:
+        pass
+    return None
+
+
+class RateLimiter:
+    """
+    Keeps the calls to the OpenAI API under a requests-per-minute and a tokens-per-minute quota,
+    shared by every caller of the helper.
+
+    Calls that would exceed a quota wait, in the order they arrived, until enough of the last
+    `window` seconds has slid by. Calls that fail anyway with a retriable error are retried up to
+    `max_retries` times after an exponential, jittered backoff, or after the retry-after time the
+    API asked for. A rate limit error pauses every call, since the quota is shared.
+    """
+
+    def __init__(self, requests_per_minute: Optional[int] = None, tokens_per_minute: Optional[int] = None,
+                 max_retries: int = 5, base_delay: float = 1.0, max_delay: float = 60.0, window: float = 60.0,
+                 margin: float = 0.1, seed: Optional[int] = None):
+        """
+        :param requests_per_minute: The number of requests allowed per window, None means unlimited
+        :param tokens_per_minute: The number of estimated tokens allowed per window, None means unlimited
+        :param max_retries: The number of times a failed call is retried
+        :param base_delay: The backoff before the first retry, doubled on every further retry
+        :param max_delay: The longest backoff
+        :param window: The length of the quota window in seconds
+        :param margin: The extra seconds a call stays in the window, for the time it takes to reach the API
+        :param seed: Seeds the backoff jitter, for reproducible runs
+        """
+        self.requests_per_minute = requests_per_minute
+        self.tokens_per_minute = tokens_per_minute
+        self.max_retries = max_retries
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self.window = window
+        self.margin = margin
+        self.requests = 0
+        self.delayed = 0
+        self.delayed_seconds = 0.0
+        self.retries = 0
+        self.rate_limited = 0
+        self.failures = 0
+        self._sent: Deque[Tuple[float, int]] = deque()  # (time, tokens) of the calls in the window
+        self._tokens = 0
+        self._paused_until = 0.0
+        self._random = random.Random(seed)
+        self._lock: Optional[asyncio.Lock] = None
+        self._thread_lock = threading.Lock()
+
+    @classmethod
+    def from_config(cls, config: dict) -> 'RateLimiter':
+        return cls(**config.get('rate_limit', {}))
+
+    def delay(self, tokens: int = 0) -> float:
+        """
+        Returns how long a call of the given size has to wait before it fits in the quotas.
+        """
+        now = time.monotonic()
+        self._expire(now)
+        wait = self._paused_until - now
+        if self.requests_per_minute and len(self._sent) >= self.requests_per_minute:
+            wait = max(wait, self._sent[len(self._sent) - self.requests_per_minute][0] + self.window + self.margin - now)
+        if self.tokens_per_minute and self._sent and self._tokens + tokens > self.tokens_per_minute:
+            # A call larger than the whole quota goes alone once the window is empty
+            excess = self._tokens + tokens - self.tokens_per_minute
+            for sent, sent_tokens in self._sent:
+                excess -= sent_tokens
+                if excess <= 0:
+                    break
+            wait = max(wait, sent + self.window + self.margin - now)
+        return max(wait, 0.0)
+
+    async def acquire(self, tokens: int = 0):
+        """
+        Waits until a call of the given size fits in the quotas and counts it.
+        """
+        if self._lock is None:
+            self._lock = asyncio.Lock()
+        async with self._lock:
+            wait = self.delay(tokens)
+            if wait > 0:
+                self._count_delay(wait)
+            while wait > 0:
+                await asyncio.sleep(wait)
+                wait = self.delay(tokens)
+            self._record(tokens)
+
+    def acquire_blocking(self, tokens: int = 0):
+        """
+        Like `acquire`, for threads.
+        """
+        with self._thread_lock:
+            wait = self.delay(tokens)
+            if wait > 0:
+                self._count_delay(wait)
+            while wait > 0:
+                time.sleep(wait)
+                wait = self.delay(tokens)
+            self._record(tokens)
+
+    def pause(self, seconds: float):
+        """
+        Holds back every call for the given time, after the API answered with a rate limit error.
+        """
+        self._paused_until = max(self._paused_until, time.monotonic() + seconds)
+
+    def backoff(self, attempt: int, error: Exception) -> float:
+        """
+        Returns how long to wait before retrying a call that failed for the `attempt`-th time.
+        """
+        hint = retry_after(error)
+        delay = min(self.max_delay, self.base_delay * 2 ** (attempt - 1))
+        delay = delay / 2 + self._random.uniform(0, delay / 2)
+        return max(delay, hint + self._random.uniform(0, self.base_delay / 4)) if hint is not None else delay
+
+    async def call(self, function: Callable[[], Awaitable[T]], tokens: int = 0, max_retries: Optional[int] = None) -> T:
+        """
+        Runs an API call within the quotas, retrying it if it fails with a retriable error.
+        :param function: Makes the call, called again for every retry
+        :param tokens: The estimated tokens of the call
+        :param max_retries: Replaces the configured number of retries for this call
+        :return: The result of the call
+        """
+        attempt = 0
+        while True:
+            await self.acquire(tokens)
+            try:
+                return await function()
+            except RETRIABLE_ERRORS as e:
+                attempt += 1
+                await asyncio.sleep(self._retry(attempt, e, max_retries))
+
+    def call_blocking(self, function: Callable[[], T], tokens: int = 0, max_retries: Optional[int] = None) -> T:
+        """
+        Like `call`, for threads.
+        """
+        attempt = 0
+        while True:
+            self.acquire_blocking(tokens)
+            try:
+                return function()
+            except RETRIABLE_ERRORS as e:
+                attempt += 1
+                time.sleep(self._retry(attempt, e, max_retries))
+
+    def stats(self) -> dict:
+        self._expire(time.monotonic())
+        return {
+            'requests': self.requests,
+            'window_requests': len(self._sent),
+            'window_tokens': self._tokens,
+            'delayed': self.delayed,
+            'delayed_seconds': self.delayed_seconds,
+            'retries': self.retries,
+            'rate_limited': self.rate_limited,
+            'failures': self.failures,
+        }
+
+    def _retry(self, attempt: int, error: Exception, max_retries: Optional[int] = None) -> float:
+        """
+        Returns the backoff before the next attempt, or raises the error once the retries are used up.
+        """
+        if isinstance(error, openai.error.RateLimitError):
+            self.rate_limited += 1
+        if attempt > (self.max_retries if max_retries is None else max_retries):
+            self.failures += 1
+            raise error
+        self.retries += 1
+        delay = self.backoff(attempt, error)
+        if isinstance(error, openai.error.RateLimitError):
+            self.pause(delay)
+        logging.warning(f'OpenAI call failed ({type(error).__name__}), retry {attempt} in {delay:.2f}s')
+        return delay
+
+    def _count_delay(self, wait: float):
+        self.delayed += 1
+        self.delayed_seconds += wait
+
+    def _record(self, tokens: int):
+        self.requests += 1
+        self._sent.append((time.monotonic(), tokens))
+        self._tokens += tokens
+
+    def _expire(self, now: float):
+        while self._sent and self._sent[0][0] <= now - self.window - self.margin:
+            self._tokens -= self._sent.popleft()[1]
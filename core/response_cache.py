@@ -0,0 +1,265 @@
+import atexit
+import hashlib
+import json
+import logging
+import math
+import os
+import re
+import unicodedata
+from collections import Counter, defaultdict
+from typing import Awaitable, Callable, Dict, Iterable, Optional, Set, Tuple
+
+from core.cache import TTLCache
+
+# The request fields that change the answer, besides the messages
+SAMPLING_PARAMS = ('model', 'temperature', 'top_p', 'n', 'max_tokens', 'presence_penalty', 'frequency_penalty',
+                   'stop', 'logit_bias')
+
+_SPACES = re.compile(r'\s+')
+
+
+def normalize(text: str) -> str:
+    """
+    Normalizes the text of a query for caching: Unicode compatibility forms are folded and runs
+    of whitespace collapse to a single space. Case and punctuation are kept, they matter to a polish.
+    """
+    return _SPACES.sub(' ', unicodedata.normalize('NFKC', text)).strip()
+
+
+def trigrams(text: str) -> Counter:
+    """
+    Returns the character trigrams of a text, the local embedding used to match near-duplicate queries.
+    """
+    text = f' {text.lower()} '
+    return Counter(text[i:i + 3] for i in range(len(text) - 2))
+
+
+class NearDuplicateIndex:
+    """
+    Inverted index of character trigram vectors, finding the cached query most similar to a new one.
+
+    Only queries of the same scope (function, model, prompt and sampling parameters) are compared.
+    A lookup only scores the queries sharing at least one trigram with the new one.
+    """
+
+    def __init__(self):
+        self._vectors: Dict[str, Tuple[str, Dict[str, float]]] = {}  # {key: (scope, unit vector)}
+        self._postings: Dict[Tuple[str, str], Set[str]] = defaultdict(set)  # {(scope, trigram): keys}
+
+    def add(self, key: str, scope: str, text: str):
+        if key in self._vectors:
+            return
+        vector = self._unit(trigrams(text))
+        self._vectors[key] = (scope, vector)
+        for gram in vector:
+            self._postings[(scope, gram)].add(key)
+
+    def remove(self, key: str):
+        scope, vector = self._vectors.pop(key, (None, {}))
+        for gram in vector:
+            keys = self._postings.get((scope, gram))
+            if keys is not None:
+                keys.discard(key)
+                if not keys:
+                    del self._postings[(scope, gram)]
+
+    def nearest(self, scope: str, text: str, threshold: float) -> Optional[str]:
+        """
+        Returns the key of the most similar query of the scope if its cosine similarity reaches `threshold`.
+        """
+        scores: Dict[str, float] = defaultdict(float)
+        for gram, weight in self._unit(trigrams(text)).items():
+            for key in self._postings.get((scope, gram), ()):
+                scores[key] += weight * self._vectors[key][1][gram]
+        if not scores:
+            return None
+        key, score = max(scores.items(), key=lambda item: item[1])
+        return key if score >= threshold else None
+
+    def keys(self) -> Iterable[str]:
+        return list(self._vectors)
+
+    def __len__(self):
+        return len(self._vectors)
+
+    @staticmethod
+    def _unit(counts: Counter) -> Dict[str, float]:
+        norm = math.sqrt(sum(count * count for count in counts.values())) or 1.0
+        return {gram: count / norm for gram, count in counts.items()}
+
+
+class ResponseCache:
+    """
+    Caches the answers of stateless requests, keyed on a hash of the function, the normalized
+    messages and the sampling parameters.
+
+    Only deterministic requests (temperature 0, a single choice) are cached, unless `cache_sampled`
+    is set. With a `similarity` threshold, a query that misses is also matched against the cached
+    queries of the same scope by trigram cosine similarity, so near-duplicates (a missing comma,
+    a typo) are answered from the cache too.
+
+    The cache holds at most `max_size` answers, least recently used first out, and is saved to
+    `path` on exit and loaded back on start.
+    """
+
+    def __init__(self, max_size: int = 10000, ttl: Optional[float] = None, path: Optional[str] = None,
+                 cache_sampled: bool = False, similarity: Optional[float] = None, functions: Iterable[str] = ()):
+        """
+        :param max_size: The maximum number of cached answers
+        :param ttl: The number of seconds an answer stays valid, forever if None
+        :param path: The JSON file the cache is persisted to, kept in memory only if None
+        :param cache_sampled: Whether answers sampled with a temperature above 0 are cached too
+        :param similarity: The trigram cosine similarity from which a cached query counts as the same,
+                           None to match exact queries only
+        :param functions: The functions whose answers are cached
+        """
+        self.ttl = ttl
+        self.path = path
+        self.cache_sampled = cache_sampled
+        self.similarity = similarity
+        self.functions = set(functions)
+        self.hits = 0
+        self.near_hits = 0
+        self.misses = 0
+        self.uncacheable = 0
+        self._cache = TTLCache(max_size, ttl)  # {key: (scope, text, answer)}
+        self._index = NearDuplicateIndex() if similarity is not None else None
+        if path is not None:
+            self.load()
+            atexit.register(self.save)
+
+    @classmethod
+    def from_config(cls, config: dict) -> 'ResponseCache':
+        return cls(**config.get('response_cache', {}))
+
+    def cacheable(self, function: str, request: dict) -> bool:
+        """
+        Returns whether the answer of a request may be served from and stored in the cache.
+        """
+        if function not in self.functions or request.get('stream') or (request.get('n') or 1) > 1:
+            return False
+        return self.cache_sampled or not request.get('temperature')
+
+    def scope(self, function: str, request: dict) -> str:
+        """
+        Returns the hash of everything but the last message that decides the answer of a request.
+        """
+        params = {name: request.get(name) for name in SAMPLING_PARAMS}
+        context = [(message['role'], normalize(message['content'])) for message in request['messages'][:-1]]
+        return self._hash([function, params, context])
+
+    async def aget_or_compute(self, function: str, request: dict, compute: Callable[[], Awaitable[str]]) -> str:
+        """
+        Returns the cached answer of a request, or computes and caches it.
+        Concurrent misses of the same request share a single computation.
+        """
+        if not self.cacheable(function, request):
+            self.uncacheable += 1
+            return await compute()
+        key, scope, text = self._key(function, request)
+        answer = self._lookup(key, scope, text)
+        if answer is not None:
+            return answer
+
+        async def compute_entry():
+            return scope, text, await compute()
+        entry = await self._cache.aget_or_compute(key, compute_entry)
+        self._remember(key, scope, text)
+        return entry[2]
+
+    def get_or_compute(self, function: str, request: dict, compute: Callable[[], str]) -> str:
+        """
+        Like `aget_or_compute`, for threads.
+        """
+        if not self.cacheable(function, request):
+            self.uncacheable += 1
+            return compute()
+        key, scope, text = self._key(function, request)
+        answer = self._lookup(key, scope, text)
+        if answer is not None:
+            return answer
+        entry = self._cache.get_or_compute(key, lambda: (scope, text, compute()))
+        self._remember(key, scope, text)
+        return entry[2]
+
+    def load(self):
+        """
+        Reads back the answers saved by `save`. A missing or unreadable file leaves the cache empty.
+        """
+        try:
+            with open(self.path, encoding='utf-8') as file:
+                entries = json.load(file)['entries']
+        except FileNotFoundError:
+            return
+        except (ValueError, KeyError) as e:
+            logging.warning(f'Ignoring unreadable response cache {self.path}: {e}')
+            return
+        for key, scope, text, answer in entries:
+            self._cache.set(key, (scope, text, answer))
+            self._remember(key, scope, text)
+        logging.info(f'Loaded {len(entries)} cached responses from {self.path}')
+
+    def save(self):
+        """
+        Writes the cached answers to `path`, replacing the previous file atomically.
+        """
+        if self.path is None:
+            return
+        entries = [[key, *entry] for key, entry in self._cache.items()]
+        temporary = f'{self.path}.tmp'
+        with open(temporary, 'w', encoding='utf-8') as file:
+            json.dump({'entries': entries}, file, ensure_ascii=False)
+        os.replace(temporary, self.path)
+
+    def stats(self) -> dict:
+        """
+        Returns the size and the hit counters of the cache; `hit_rate` counts near-duplicate hits as hits.
+        """
+        cache = self._cache.stats()
+        hits = self.hits + self.near_hits
+        lookups = hits + self.misses
+        return {
+            'size': cache['size'],
+            'max_size': cache['max_size'],
+            'hits': hits,
+            'exact_hits': self.hits,
+            'near_hits': self.near_hits,
+            'misses': self.misses,
+            'hit_rate': hits / lookups if lookups else 0.0,
+            'coalesced': cache['coalesced'],
+            'evictions': cache['evictions'],
+            'uncacheable': self.uncacheable,
+        }
+
+    def _key(self, function: str, request: dict) -> Tuple[str, str, str]:
+        scope = self.scope(function, request)
+        text = normalize(request['messages'][-1]['content'])
+        return self._hash([scope, text]), scope, text
+
+    def _lookup(self, key: str, scope: str, text: str) -> Optional[str]:
+        entry = self._cache.get(key)
+        if entry is not None:
+            self.hits += 1
+            return entry[2]
+        if self._index is not None:
+            near = self._index.nearest(scope, text, self.similarity)
+            entry = self._cache.get(near) if near is not None else None
+            if entry is not None:
+                self.near_hits += 1
+                return entry[2]
+        self.misses += 1
+        return None
+
+    def _remember(self, key: str, scope: str, text: str):
+        if self._index is None:
+            return
+        self._index.add(key, scope, text)
+        if len(self._index) > 2 * self._cache.max_size:
+            # Forget the queries the cache evicted since the last sweep
+            live = {key for key, _ in self._cache.items()}
+            for stale in [key for key in self._index.keys() if key not in live]:
+                self._index.remove(stale)
+
+    @staticmethod
+    def _hash(value) -> str:
+        return hashlib.sha256(json.dumps(value, ensure_ascii=False, sort_keys=True).encode()).hexdigest()
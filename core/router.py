@@ -0,0 +1,202 @@
+import copy
+import logging
+import time
+from typing import Dict, Iterable, List, Optional, Tuple
+
+from core import metrics
+
+# USD per 1000 prompt and completion tokens
+MODEL_PRICES = {
+    'gpt-3.5-turbo': (0.002, 0.002),
+    'gpt-4': (0.03, 0.06),
+    'gpt-4-32k': (0.06, 0.12),
+}
+
+ROUTE_SECONDS = metrics.histogram(
+    'chatgpt_route_seconds', 'Time until a routed request was answered, by route and model', ['route', 'model'])
+ROUTE_REQUESTS = metrics.counter(
+    'chatgpt_route_requests_total', 'Routed requests by route, model and outcome (ok, fallback, error, cancelled)',
+    ['route', 'model', 'outcome'])
+ROUTE_COST = metrics.counter(
+    'chatgpt_route_cost_usd_total', 'Estimated cost of the routed requests in USD', ['route', 'model'])
+
+
+class Route:
+    """
+    The model, `max_tokens` and temperature used for the requests it matches.
+
+    A route matches the requests of its functions (any function if None) whose input and
+    history token counts fall in its bounds. When its model fails, the request is retried with
+    each model of `fallbacks` in turn.
+    """
+
+    def __init__(self, name: str, model: str, max_tokens: int, temperature: float,
+                 functions: Optional[Iterable[str]] = None, min_input_tokens: int = 0,
+                 max_input_tokens: Optional[int] = None, min_history_tokens: int = 0,
+                 max_history_tokens: Optional[int] = None, fallbacks: Iterable[str] = (), fallback_retries: int = 0):
+        """
+        :param name: The name the route is reported under
+        :param model: The model requests are sent to
+        :param max_tokens: The maximum number of tokens of an answer
+        :param temperature: The sampling temperature
+        :param functions: The functions whose requests the route takes, all if None
+        :param min_input_tokens: The smallest query, in tokens, the route takes
+        :param max_input_tokens: The largest query, in tokens, the route takes, unbounded if None
+        :param min_history_tokens: The shortest conversation, in tokens, the route takes
+        :param max_history_tokens: The longest conversation, in tokens, the route takes, unbounded if None
+        :param fallbacks: The models tried in turn when the previous one failed
+        :param fallback_retries: How often a model that has a fallback is retried before falling back
+        """
+        self.name = name
+        self.model = model
+        self.max_tokens = max_tokens
+        self.temperature = temperature
+        self.functions = set(functions) if functions is not None else None
+        self.min_input_tokens = min_input_tokens
+        self.max_input_tokens = max_input_tokens
+        self.min_history_tokens = min_history_tokens
+        self.max_history_tokens = max_history_tokens
+        self.fallbacks = list(fallbacks)
+        self.fallback_retries = fallback_retries
+
+    def matches(self, function: str, input_tokens: int, history_tokens: int) -> bool:
+        return ((self.functions is None or function in self.functions) and
+                self.min_input_tokens <= input_tokens and
+                (self.max_input_tokens is None or input_tokens <= self.max_input_tokens) and
+                self.min_history_tokens <= history_tokens and
+                (self.max_history_tokens is None or history_tokens <= self.max_history_tokens))
+
+    @property
+    def models(self) -> List[str]:
+        return [self.model] + self.fallbacks
+
+    def replace(self, **changes) -> 'Route':
+        """
+        Returns a copy of the route with some of its settings changed, e.g. the model a chat chose.
+        """
+        route = copy.copy(self)
+        for name, value in changes.items():
+            setattr(route, name, value)
+        return route
+
+    def __repr__(self):
+        return f"Route({self.name!r}, model={self.model!r}, max_tokens={self.max_tokens}, temperature={self.temperature})"
+
+
+class RouteCall:
+    """
+    One request sent along a route, from the first attempt to its answer.
+    """
+    __slots__ = ('router', 'route', 'started', 'prompt_tokens')
+
+    def __init__(self, router: 'Router', route: Route):
+        self.router = router
+        self.route = route
+        self.started = time.perf_counter()
+        self.prompt_tokens = 0
+
+    def fallback(self, model: str, error: Exception):
+        """
+        Records that `model` failed and the next model of the route is tried.
+        """
+        ROUTE_REQUESTS.labels(self.route.name, model, 'fallback').inc()
+        self.router.count(self.route, 'fallbacks')
+        logging.warning(f'Route {self.route.name}: {model} failed ({type(error).__name__}), falling back')
+
+    def finish(self, model: str, completion_tokens: int, prompt_tokens: Optional[int] = None):
+        """
+        Records the latency and the cost of the answer.
+        """
+        seconds = time.perf_counter() - self.started
+        prompt_tokens = self.prompt_tokens if prompt_tokens is None else prompt_tokens
+        cost = self.router.cost(model, prompt_tokens, completion_tokens)
+        ROUTE_SECONDS.labels(self.route.name, model).observe(seconds)
+        ROUTE_REQUESTS.labels(self.route.name, model, 'ok').inc()
+        ROUTE_COST.labels(self.route.name, model).inc(cost)
+        self.router.count(self.route, 'requests', seconds=seconds, cost=cost)
+
+    def cancel(self, model: str, completion_tokens: int):
+        """
+        Records the cost of a streamed answer cancelled before it ended.
+        """
+        cost = self.router.cost(model, self.prompt_tokens, completion_tokens)
+        ROUTE_REQUESTS.labels(self.route.name, model, 'cancelled').inc()
+        ROUTE_COST.labels(self.route.name, model).inc(cost)
+        self.router.count(self.route, 'cancelled', cost=cost)
+
+    def fail(self, model: str):
+        ROUTE_REQUESTS.labels(self.route.name, model, 'error').inc()
+        self.router.count(self.route, 'errors')
+
+
+class Router:
+    """
+    Chooses the route of every request: the first configured route that matches it, or the default
+    route built from the top-level `model`, `max_tokens` and `temperature`.
+    """
+
+    def __init__(self, routes: List[Route], default: Route, prices: Optional[Dict[str, Tuple[float, float]]] = None):
+        """
+        :param routes: The routes, in the order they are tried
+        :param default: The route of the requests no route matches
+        :param prices: USD per 1000 prompt and completion tokens by model, added to MODEL_PRICES
+        """
+        self.routes = routes
+        self.default = default
+        self.prices = dict(MODEL_PRICES, **(prices or {}))
+        self._stats: Dict[str, dict] = {}
+
+    @classmethod
+    def from_config(cls, config: dict) -> 'Router':
+        default = Route('default', config['model'], config['max_tokens'], config['temperature'],
+                        fallbacks=config.get('fallback_models', ()), fallback_retries=config.get('fallback_retries', 0))
+        routes = []
+        for route in config.get('routes', ()):
+            route = dict(route)
+            routes.append(Route(route.pop('name'), route.pop('model', default.model),
+                                route.pop('max_tokens', default.max_tokens),
+                                route.pop('temperature', default.temperature), **route))
+        return cls(routes, default, config.get('model_prices'))
+
+    def route(self, function: str, input_tokens: int, history_tokens: int = 0) -> Route:
+        """
+        Returns the route of a request.
+        :param function: The function the request is for
+        :param input_tokens: The tokens of the query
+        :param history_tokens: The tokens of the whole conversation sent with it
+        """
+        route = next((route for route in self.routes if route.matches(function, input_tokens, history_tokens)),
+                     self.default)
+        logging.debug(f'Routed {function} request ({input_tokens} input, {history_tokens} history tokens) '
+                     f'to {route.name}: {route.model}, max_tokens={route.max_tokens}, temperature={route.temperature}')
+        return route
+
+    def start(self, route: Route) -> RouteCall:
+        return RouteCall(self, route)
+
+    def cost(self, model: str, prompt_tokens: int, completion_tokens: int) -> float:
+        """
+        Returns the price in USD of a request, matching versioned models (e.g. gpt-4-0314) by prefix.
+        """
+        prices = self.prices.get(model)
+        if prices is None:
+            known = [name for name in self.prices if model.startswith(name)]
+            prices = self.prices[max(known, key=len)] if known else (0.0, 0.0)
+        return (prompt_tokens * prices[0] + completion_tokens * prices[1]) / 1000
+
+    def count(self, route: Route, counter: str, seconds: float = 0.0, cost: float = 0.0):
+        stats = self._stats.setdefault(route.name, {'requests': 0, 'errors': 0, 'fallbacks': 0, 'cancelled': 0,
+                                                    'seconds': 0.0, 'cost': 0.0})
+        stats[counter] += 1
+        stats['seconds'] += seconds
+        stats['cost'] += cost
+
+    def stats(self) -> dict:
+        """
+        Returns the requests, errors, fallbacks, cancelled answers, average latency and cost of every route used so far.
+        """
+        return {name: dict(requests=stats['requests'], errors=stats['errors'], fallbacks=stats['fallbacks'],
+                           cancelled=stats['cancelled'],
+                           latency_avg=stats['seconds'] / stats['requests'] if stats['requests'] else 0.0,
+                           cost_usd=stats['cost'])
+                for name, stats in self._stats.items()}
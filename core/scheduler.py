@@ -0,0 +1,166 @@
+import asyncio
+import logging
+import time
+from collections import deque
+from typing import Any, Awaitable, Callable, Deque, Dict, List, Optional
+
+from core import metrics
+
+QUEUE_WAIT_SECONDS = metrics.histogram(
+    'chatgpt_scheduler_wait_seconds', 'Time a message waited for its chat\'s turn before being answered')
+QUEUED = metrics.gauge('chatgpt_scheduler_queued', 'Messages waiting to be answered')
+IN_FLIGHT = metrics.gauge('chatgpt_scheduler_in_flight', 'Answers being generated')
+
+
+class _Job:
+    __slots__ = ('run', 'items', 'futures', 'enqueued', 'mergeable', 'task', 'cancelled')
+
+    def __init__(self, run: Callable[[List[Any]], Awaitable[Any]], item: Any, mergeable: bool):
+        self.run = run
+        self.items = [item]
+        self.futures: List[asyncio.Future] = []
+        self.enqueued = time.monotonic()
+        self.mergeable = mergeable
+        self.task: Optional[asyncio.Task] = None
+        self.cancelled = False
+
+
+class ChatScheduler:
+    """
+    Runs the jobs of every chat one at a time and in order, with at most `max_in_flight` jobs
+    running across all chats. Chats with queued jobs take turns, so one busy chat cannot starve
+    the others.
+
+    A mergeable job submitted while another mergeable job of the same chat is still queued is
+    folded into it: the queued job then runs once with both items.
+
+    The running job of a chat can be cancelled, e.g. when the user asks to stop its answer.
+    """
+
+    def __init__(self, max_in_flight: int = 8, wait_samples: int = 1000):
+        """
+        :param max_in_flight: The maximum number of jobs running at the same time
+        :param wait_samples: The number of recent queue wait times kept for the statistics
+        """
+        self.max_in_flight = max_in_flight
+        self.in_flight = 0
+        self.completed = 0
+        self.merged = 0
+        self.cancelled = 0
+        self._queues: Dict[int, Deque[_Job]] = {}
+        self._running: Dict[int, _Job] = {}
+        self._ready: Deque[int] = deque()
+        self._waits: Deque[float] = deque(maxlen=wait_samples)
+        QUEUED.set_function(self.queue_depth)
+        IN_FLIGHT.set_function(lambda: self.in_flight)
+
+    async def submit(self, chat_id: int, run: Callable[[List[Any]], Awaitable[Any]], item: Any,
+                     mergeable: bool = False) -> Any:
+        """
+        Queues a job of a chat and waits for its result.
+        :param chat_id: The chat the job belongs to
+        :param run: The coroutine function of the job, called with the list of its items
+        :param item: The item of the job, e.g. the message it answers
+        :param mergeable: Whether the job may be merged with a queued job of the same chat
+        :return: The result of the job, shared by every merged submission
+        """
+        future = asyncio.get_running_loop().create_future()
+        queue = self._queues.setdefault(chat_id, deque())
+        last = queue[-1] if queue else None
+        if mergeable and last is not None and last.mergeable and last.run == run:
+            last.items.append(item)
+            last.futures.append(future)
+            self.merged += 1
+        else:
+            job = _Job(run, item, mergeable)
+            job.futures.append(future)
+            queue.append(job)
+            if len(queue) == 1 and chat_id not in self._running:
+                self._ready.append(chat_id)
+        self._dispatch()
+        return await future
+
+    async def cancel(self, chat_id: int) -> bool:
+        """
+        Cancels the running job of a chat and waits until it stopped. Its submissions return None,
+        the queued jobs of the chat still run.
+        :return: False if the chat had no running job
+        """
+        job = self._running.get(chat_id)
+        if job is None or job.task.done():
+            return False
+        job.cancelled = True
+        job.task.cancel()
+        self.cancelled += 1
+        await asyncio.wait([job.task])
+        return True
+
+    def queue_depth(self, chat_id: Optional[int] = None) -> int:
+        """
+        Returns the number of queued jobs of a chat, or of all chats.
+        """
+        if chat_id is not None:
+            return len(self._queues.get(chat_id, ()))
+        return sum(len(queue) for queue in self._queues.values())
+
+    def stats(self) -> dict:
+        """
+        Returns the queue depth, the number of running jobs and the recent queue wait times.
+        """
+        waits = sorted(self._waits)
+        return {
+            'queued': self.queue_depth(),
+            'queued_chats': sum(1 for queue in self._queues.values() if queue),
+            'in_flight': self.in_flight,
+            'completed': self.completed,
+            'merged': self.merged,
+            'cancelled': self.cancelled,
+            'wait_avg': sum(waits) / len(waits) if waits else 0.0,
+            'wait_p50': waits[len(waits) // 2] if waits else 0.0,
+            'wait_p99': waits[min(len(waits) - 1, int(len(waits) * 0.99))] if waits else 0.0,
+            'wait_max': waits[-1] if waits else 0.0,
+        }
+
+    def _dispatch(self):
+        while self.in_flight < self.max_in_flight and self._ready:
+            chat_id = self._ready.popleft()
+            job = self._queues[chat_id].popleft()
+            wait = time.monotonic() - job.enqueued
+            self._waits.append(wait)
+            QUEUE_WAIT_SECONDS.observe(wait)
+            self._running[chat_id] = job
+            self.in_flight += 1
+            job.task = asyncio.ensure_future(job.run(job.items))
+            asyncio.ensure_future(self._run(chat_id, job))
+
+    async def _run(self, chat_id: int, job: _Job):
+        try:
+            result = await job.task
+        except asyncio.CancelledError:
+            if job.cancelled:
+                logging.info(f'Cancelled the job of chat {chat_id}')
+            else:
+                logging.warning(f'Job of chat {chat_id} was cancelled')
+            for future in job.futures:
+                if job.cancelled and not future.done():
+                    future.set_result(None)
+                else:
+                    future.cancel()
+        except Exception as e:
+            for future in job.futures:
+                if not future.done():
+                    future.set_exception(e)
+        else:
+            for future in job.futures:
+                if not future.done():
+                    future.set_result(result)
+        finally:
+            self.in_flight -= 1
+            self.completed += 1
+            del self._running[chat_id]
+            if self._queues[chat_id]:
+                # Back of the line, so that every chat with queued jobs gets its turn
+                self._ready.append(chat_id)
+            else:
+                del self._queues[chat_id]
+            self._dispatch()
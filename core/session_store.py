@@ -0,0 +1,181 @@
+import itertools
+import logging
+import time
+from collections import OrderedDict
+from typing import Dict, Iterator, List, Optional
+
+from core.history import ConversationHistory
+
+
+class ChatSession:
+    """
+    The per-function conversation histories of one chat, created on first use.
+    """
+    __slots__ = ('store', 'chat_id', 'histories', 'last_used', 'size', 'attached')
+
+    def __init__(self, store: 'SessionStore', chat_id: int):
+        self.store = store
+        self.chat_id = chat_id
+        self.histories: Dict[str, ConversationHistory] = {}
+        self.last_used = time.monotonic()
+        self.size = 0
+        # Whether the session is still counted by the store; in-flight requests may outlive an eviction
+        self.attached = True
+
+    def __getitem__(self, function: str) -> ConversationHistory:
+        history = self.histories.get(function)
+        if history is None:
+            history = self.store.new_history(self.chat_id, function)
+            history.on_resize = self.on_resize
+            self.on_resize(history.size)
+            self.histories[function] = history
+        return history
+
+    def __contains__(self, function: str) -> bool:
+        return function in self.histories
+
+    def on_resize(self, delta: int):
+        self.size += delta
+        if self.attached:
+            self.store.bytes += delta
+
+
+class SessionStore:
+    """
+    In-memory store of the chat sessions used by OpenAIHelper.
+
+    Sessions are kept in least-recently-used order and evicted once they have been idle for
+    `idle_timeout` seconds, or when the store holds more than `max_sessions` chats or more than
+    `max_bytes` of messages.
+    """
+
+    def __init__(self, system_prompt: str, model: str = 'gpt-3.5-turbo', max_sessions: Optional[int] = None,
+                 max_bytes: Optional[int] = None, idle_timeout: Optional[float] = None):
+        """
+        :param system_prompt: The system message every conversation starts with
+        :param model: The model whose tokenizer counts the tokens
+        :param max_sessions: The maximum number of chats kept in memory, unbounded if None
+        :param max_bytes: The maximum approximate size of all messages in memory, unbounded if None
+        :param idle_timeout: Seconds after which an untouched chat is evicted, never if None
+        """
+        self.system_prompt = system_prompt
+        self.model = model
+        self.max_sessions = max_sessions
+        self.max_bytes = max_bytes
+        self.idle_timeout = idle_timeout
+        self.bytes = 0
+        self.evictions = 0
+        self._sessions: 'OrderedDict[int, ChatSession]' = OrderedDict()
+
+    @classmethod
+    def from_config(cls, config: dict) -> 'SessionStore':
+        """
+        Creates a store from the GPT configuration.
+        """
+        return cls(config['assistant_prompt'], config['model'],
+                   max_sessions=config.get('max_sessions'),
+                   max_bytes=config.get('max_session_bytes'),
+                   idle_timeout=config.get('session_idle_timeout'))
+
+    def __getitem__(self, chat_id: int) -> ChatSession:
+        """
+        Returns the session of a chat, creating it if needed, and marks it as recently used.
+        """
+        session = self._sessions.get(chat_id)
+        if session is None:
+            session = self.load_session(chat_id)
+            self._sessions[chat_id] = session
+        else:
+            self._sessions.move_to_end(chat_id)
+        session.last_used = time.monotonic()
+        self.evict()
+        return session
+
+    def __contains__(self, chat_id: int) -> bool:
+        return chat_id in self._sessions
+
+    def __len__(self) -> int:
+        return len(self._sessions)
+
+    def __iter__(self) -> Iterator[int]:
+        return iter(list(self._sessions))
+
+    def idle_sessions(self, quiet_period: float) -> List[ChatSession]:
+        """
+        Returns the sessions untouched for `quiet_period` seconds, least recently used first,
+        without marking them as used.
+        """
+        cutoff = time.monotonic() - quiet_period
+        return list(itertools.takewhile(lambda session: session.last_used <= cutoff, self._sessions.values()))
+
+    def reset(self, chat_id: int):
+        """
+        Forgets every history of a chat.
+        """
+        self._forget(chat_id)
+
+    def _forget(self, chat_id: int):
+        """
+        Drops a chat from memory.
+        """
+        session = self._sessions.pop(chat_id, None)
+        if session is not None:
+            session.attached = False
+            self.bytes -= session.size
+
+    async def aload(self, chat_id: int, function: str):
+        """
+        Reads ahead what `new_history` needs for a function of a chat, without blocking the event loop.
+        This store has nothing to read.
+        """
+
+    def new_history(self, chat_id: int, function: str) -> ConversationHistory:
+        """
+        Creates an empty history for a function of a chat.
+        """
+        return ConversationHistory(self.system_prompt, self.model)
+
+    def load_settings(self) -> Dict[int, dict]:
+        """
+        Returns the saved settings of the chats that changed them. This store keeps none across restarts.
+        """
+        return {}
+
+    def save_settings(self, chat_id: int, settings: Optional[dict]):
+        """
+        Saves the settings a chat changed from the defaults, or forgets them if None.
+        """
+
+    def load_session(self, chat_id: int) -> ChatSession:
+        """
+        Creates the session of a chat that is not in memory.
+        """
+        return ChatSession(self, chat_id)
+
+    def evict(self):
+        """
+        Evicts idle sessions, then the least recently used ones while the store is over its limits.
+        The most recently used session is never evicted.
+        """
+        now = time.monotonic()
+        while len(self._sessions) > 1:
+            chat_id, session = next(iter(self._sessions.items()))
+            idle = self.idle_timeout is not None and now - session.last_used > self.idle_timeout
+            over_count = self.max_sessions is not None and len(self._sessions) > self.max_sessions
+            over_bytes = self.max_bytes is not None and self.bytes > self.max_bytes
+            if not (idle or over_count or over_bytes):
+                break
+            self._forget(chat_id)
+            self.evictions += 1
+            logging.debug(f'Evicted session of chat {chat_id}')
+
+    def stats(self) -> dict:
+        """
+        Returns live counts of the sessions and their memory usage.
+        """
+        return {
+            'sessions': len(self._sessions),
+            'histories': sum(len(session.histories) for session in self._sessions.values()),
+            'bytes': self.bytes,
+            'evictions': self.evictions,
+        }
@@ -0,0 +1,252 @@
+import asyncio
+import atexit
+import json
+import logging
+import queue
+import sqlite3
+import threading
+import time
+from typing import Dict, List, Optional, Tuple
+
+from core.history import ConversationHistory, Message, prompt_budget
+from core.session_store import SessionStore
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS messages (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    chat_id INTEGER NOT NULL,
+    function TEXT NOT NULL,
+    role TEXT NOT NULL,
+    content TEXT NOT NULL,
+    tokens INTEGER NOT NULL,
+    created REAL NOT NULL
+);
+CREATE INDEX IF NOT EXISTS messages_chat_function ON messages (chat_id, function, id);
+CREATE TABLE IF NOT EXISTS settings (
+    chat_id INTEGER PRIMARY KEY,
+    settings TEXT NOT NULL
+);
+"""
+
+
+class SqliteSessionStore(SessionStore):
+    """
+    Session store that persists every message to a SQLite database in WAL mode,
+    so that the bot and the web API share their conversations and survive restarts.
+
+    Messages are appended; a summary rewrites the rows of its history and a reset deletes the rows
+    of a chat. The settings a chat changed are kept in their own table, one JSON row per chat.
+    Writes are queued and committed in batches by a
+    background thread, so the event loop never waits on the disk. A chat's history is
+    read back lazily the first time it is used, newest messages first and only as many
+    as fit in the prompt budget, so startup does not depend on how much history is stored.
+    `aload` reads it in the default executor beforehand, so that the event loop does not wait for it either.
+    """
+
+    def __init__(self, path: str, system_prompt: str, model: str = 'gpt-3.5-turbo', budget: Optional[int] = None,
+                 batch_size: int = 100, flush_interval: float = 0.5, **kwargs):
+        """
+        :param path: The path of the SQLite database
+        :param system_prompt: The system message every conversation starts with
+        :param model: The model whose tokenizer counts the tokens
+        :param budget: The number of prompt tokens loaded back per history, everything stored if None
+        :param batch_size: The maximum number of writes committed in one transaction
+        :param flush_interval: The maximum number of seconds a write waits before it is committed
+        :param kwargs: The limits of the in-memory cache, see SessionStore
+        """
+        super().__init__(system_prompt, model, **kwargs)
+        self.path = path
+        self.budget = budget
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+
+        self._reader = self._connect()
+        self._reader.executescript(SCHEMA)
+        self._reader_lock = threading.Lock()
+
+        self._writes: 'queue.Queue' = queue.Queue()
+        # Number of queued writes per chat, guarded by the reader lock
+        self._pending: Dict[int, int] = {}
+        # The rows read by `aload` for `new_history`, by chat and function
+        self._loaded: Dict[Tuple[int, str], List[tuple]] = {}
+        self._writer = threading.Thread(target=self._write_loop, name='session-writer', daemon=True)
+        self._writer.start()
+        atexit.register(self.close)
+
+    @classmethod
+    def from_config(cls, config: dict) -> 'SessionStore':
+        """
+        Creates a store from the GPT configuration. Falls back to an in-memory store if `session_db` is not set.
+        """
+        if not config.get('session_db'):
+            return SessionStore.from_config(config)
+        return cls(config['session_db'], config['assistant_prompt'], config['model'],
+                   budget=prompt_budget(config),
+                   max_sessions=config.get('max_sessions'),
+                   max_bytes=config.get('max_session_bytes'),
+                   idle_timeout=config.get('session_idle_timeout'))
+
+    async def aload(self, chat_id: int, function: str):
+        """
+        Reads the stored history of a function of a chat in the default executor, unless it is in memory,
+        so that creating it does not block the event loop.
+        """
+        session = self._sessions.get(chat_id)
+        if (session is not None and function in session) or (chat_id, function) in self._loaded:
+            return
+        rows = await asyncio.get_running_loop().run_in_executor(None, self._load, chat_id, function)
+        session = self._sessions.get(chat_id)
+        if session is None or function not in session:
+            self._loaded[(chat_id, function)] = rows
+
+    def new_history(self, chat_id: int, function: str) -> ConversationHistory:
+        """
+        Loads the stored history of a function of a chat, read by `aload` if it was called.
+        """
+        rows = self._loaded.pop((chat_id, function), None)
+        if rows is None:
+            rows = self._load(chat_id, function)
+        history = ConversationHistory(self.system_prompt, self.model)
+        for role, content, count in rows:
+            history.append(role, content, tokens=count)
+        history.on_append = lambda message: self._enqueue(('append', chat_id, function, message, time.time()))
+        history.on_rewrite = lambda messages: self._enqueue(('rewrite', chat_id, function, list(messages), time.time()))
+        return history
+
+    def _load(self, chat_id: int, function: str) -> List[tuple]:
+        """
+        Reads the newest messages of a history that fit in the budget, oldest first.
+        """
+        # Queued writes of an evicted or reset chat must be visible before it is read back
+        if self._pending.get(chat_id):
+            self.flush()
+
+        with self._reader_lock:
+            rows = self._reader.execute(
+                'SELECT role, content, tokens FROM messages WHERE chat_id = ? AND function = ? ORDER BY id DESC',
+                (chat_id, function))
+            loaded = []
+            tokens = 0
+            for role, content, count in rows:
+                tokens += count
+                if self.budget is not None and tokens > self.budget:
+                    break
+                loaded.append((role, content, count))
+            rows.close()
+        loaded.reverse()
+        return loaded
+
+    def load_settings(self) -> Dict[int, dict]:
+        """
+        Reads the settings of every chat that changed them.
+        """
+        with self._reader_lock:
+            return {chat_id: json.loads(settings)
+                    for chat_id, settings in self._reader.execute('SELECT chat_id, settings FROM settings')}
+
+    def save_settings(self, chat_id: int, settings: Optional[dict]):
+        """
+        Queues the settings of a chat to be saved, or deleted if None.
+        """
+        self._enqueue(('settings', chat_id, json.dumps(settings) if settings is not None else None))
+
+    def reset(self, chat_id: int):
+        """
+        Forgets every history of a chat, in memory and on disk.
+        """
+        super().reset(chat_id)
+        for key in [key for key in self._loaded if key[0] == chat_id]:
+            del self._loaded[key]
+        self._enqueue(('reset', chat_id))
+
+    def flush(self):
+        """
+        Blocks until every queued write is committed.
+        """
+        done = threading.Event()
+        self._writes.put(('flush', done))
+        done.wait()
+
+    def close(self):
+        """
+        Commits the queued writes and stops the writer thread.
+        """
+        if self._writer.is_alive():
+            self._writes.put(None)
+            self._writer.join()
+
+    def stats(self) -> dict:
+        stats = super().stats()
+        stats['pending_writes'] = self._writes.qsize()
+        return stats
+
+    def _enqueue(self, write: tuple):
+        with self._reader_lock:
+            self._pending[write[1]] = self._pending.get(write[1], 0) + 1
+        self._writes.put(write)
+
+    def _connect(self) -> sqlite3.Connection:
+        connection = sqlite3.connect(self.path, check_same_thread=False, isolation_level=None)
+        connection.execute('PRAGMA journal_mode=WAL')
+        connection.execute('PRAGMA synchronous=NORMAL')
+        connection.execute('PRAGMA busy_timeout=5000')
+        return connection
+
+    def _write_loop(self):
+        connection = self._connect()
+        running = True
+        while running:
+            batch = [self._writes.get()]
+            deadline = time.monotonic() + self.flush_interval
+            while len(batch) < self.batch_size and batch[-1] is not None and batch[-1][0] != 'flush':
+                try:
+                    batch.append(self._writes.get(timeout=max(0.0, deadline - time.monotonic())))
+                except queue.Empty:
+                    break
+
+            try:
+                connection.execute('BEGIN')
+                for write in batch:
+                    if write is None:
+                        running = False
+                    elif write[0] == 'append':
+                        _, chat_id, function, message, created = write
+                        self._append(connection, chat_id, function, message, created)
+                    elif write[0] == 'rewrite':
+                        _, chat_id, function, messages, created = write
+                        connection.execute('DELETE FROM messages WHERE chat_id = ? AND function = ?', (chat_id, function))
+                        for message in messages:
+                            self._append(connection, chat_id, function, message, created)
+                    elif write[0] == 'reset':
+                        connection.execute('DELETE FROM messages WHERE chat_id = ?', (write[1],))
+                    elif write[0] == 'settings':
+                        self._save_settings(connection, write[1], write[2])
+                connection.execute('COMMIT')
+            except Exception as e:
+                logging.exception(e)
+                if connection.in_transaction:
+                    connection.execute('ROLLBACK')
+
+            with self._reader_lock:
+                for write in batch:
+                    if write is not None and write[0] != 'flush':
+                        self._pending[write[1]] -= 1
+                        if not self._pending[write[1]]:
+                            del self._pending[write[1]]
+            for write in batch:
+                if write is not None and write[0] == 'flush':
+                    write[1].set()
+        connection.close()
+
+    @staticmethod
+    def _save_settings(connection: sqlite3.Connection, chat_id: int, settings: Optional[str]):
+        if settings is None:
+            connection.execute('DELETE FROM settings WHERE chat_id = ?', (chat_id,))
+        else:
+            connection.execute('INSERT OR REPLACE INTO settings (chat_id, settings) VALUES (?, ?)', (chat_id, settings))
+
+    @staticmethod
+    def _append(connection: sqlite3.Connection, chat_id: int, function: str, message: Message, created: float):
+        connection.execute(
+            'INSERT INTO messages (chat_id, function, role, content, tokens, created) VALUES (?, ?, ?, ?, ?, ?)',
+            (chat_id, function, message.role, message.content, message.tokens, created))
@@ -0,0 +1,190 @@
+import asyncio
+import io
+import logging
+import multiprocessing
+import os
+from concurrent.futures import ProcessPoolExecutor
+from typing import AsyncIterator, List, Optional
+
+from core.openai_helper import AsyncOpenAIHelper
+
+# Formats the Whisper API accepts as they are
+WHISPER_FORMATS = {'flac', 'm4a', 'mp3', 'mp4', 'mpeg', 'mpga', 'ogg', 'wav', 'webm'}
+
+# Extensions that name one of the formats above, as found on Telegram files
+FORMAT_ALIASES = {'oga': 'ogg', 'opus': 'ogg', 'mpga': 'mp3', 'm4v': 'mp4'}
+
+# The largest file the Whisper API accepts
+MAX_UPLOAD_BYTES = 25 * 1024 * 1024
+
+
+def audio_format(filename: str) -> str:
+    """
+    Returns the audio format named by the extension of a file, e.g. 'ogg' for 'voice.oga'.
+    """
+    extension = os.path.splitext(filename)[-1].lstrip('.').lower()
+    return FORMAT_ALIASES.get(extension, extension)
+
+
+def transcode(data: bytes, source_format: str, target_format: str = 'mp3') -> bytes:
+    """
+    Converts audio between formats with pydub (and ffmpeg). Runs in a worker process.
+    """
+    from pydub import AudioSegment
+
+    audio = AudioSegment.from_file(io.BytesIO(data), format=source_format)
+    output = io.BytesIO()
+    audio.export(output, format=target_format)
+    return output.getvalue()
+
+
+def split_at_silence(data: bytes, source_format: Optional[str], max_seconds: float, min_seconds: float,
+                     target_format: str = 'mp3', min_silence_ms: int = 400) -> List[bytes]:
+    """
+    Splits audio into segments of at most `max_seconds`, cutting in the middle of the last pause
+    after `min_seconds` so that words are not cut in half. Runs in a worker process.
+    :return: The encoded segments, in order
+    """
+    from pydub import AudioSegment
+    from pydub.silence import detect_silence
+
+    audio = AudioSegment.from_file(io.BytesIO(data), format=source_format)
+    max_ms, min_ms = int(max_seconds * 1000), int(min_seconds * 1000)
+    threshold = audio.dBFS - 16 if audio.dBFS != float('-inf') else -50
+    pauses = [(start + end) // 2 for start, end in
+              detect_silence(audio, min_silence_len=min_silence_ms, silence_thresh=threshold, seek_step=10)]
+
+    cuts = [0]
+    while len(audio) - cuts[-1] > max_ms:
+        start = cuts[-1]
+        candidates = [pause for pause in pauses if start + min_ms <= pause <= start + max_ms]
+        cuts.append(candidates[-1] if candidates else start + max_ms)
+    cuts.append(len(audio))
+
+    segments = []
+    for start, end in zip(cuts, cuts[1:]):
+        output = io.BytesIO()
+        audio[start:end].export(output, format=target_format)
+        segments.append(output.getvalue())
+    return segments
+
+
+class TranscriptionPipeline:
+    """
+    Transcribes audio kept in memory.
+
+    Audio in a format Whisper accepts is uploaded as it is. Other formats are transcoded to MP3
+    in a process pool, so the CPU-bound conversion never runs on the event loop. The pool's
+    processes are spawned rather than forked from a process running threads, and stopped by `close`.
+
+    Files larger than `chunk_threshold` bytes are split at pauses into segments of at most
+    `chunk_seconds`, which are transcribed concurrently and stitched back together in order.
+    Files larger than `max_upload_bytes` are always split, Whisper would refuse them.
+    """
+
+    def __init__(self, openai: AsyncOpenAIHelper, accepted_formats=WHISPER_FORMATS, max_workers: int = 2,
+                 chunk_threshold: int = 1024 * 1024, chunk_seconds: float = 120, max_concurrent_chunks: int = 4,
+                 chunk_format: str = 'mp3', max_upload_bytes: int = MAX_UPLOAD_BYTES):
+        """
+        :param openai: The AsyncOpenAIHelper the audio is transcribed with
+        :param accepted_formats: The formats sent to Whisper without transcoding
+        :param max_workers: The number of transcoding processes
+        :param chunk_threshold: The size in bytes above which a file is split into segments
+        :param chunk_seconds: The maximum length of a segment
+        :param max_concurrent_chunks: The number of segments of one file transcribed at the same time
+        :param chunk_format: The format segments are encoded to
+        :param max_upload_bytes: The size in bytes above which `transcribe` splits a file too
+        """
+        self.openai = openai
+        self.accepted_formats = set(accepted_formats)
+        self.max_workers = max_workers
+        self.chunk_threshold = chunk_threshold
+        self.chunk_seconds = chunk_seconds
+        self.max_concurrent_chunks = max_concurrent_chunks
+        self.chunk_format = chunk_format
+        self.max_upload_bytes = max_upload_bytes
+        self.transcoded = 0
+        self.passed_through = 0
+        self._executor: Optional[ProcessPoolExecutor] = None
+
+    async def transcribe(self, data: bytes, filename: str) -> str:
+        """
+        Transcribes the audio of a file.
+        :param data: The content of the file
+        :param filename: The name of the file, its extension gives the audio format
+        :return: The transcript
+        """
+        if len(data) > self.max_upload_bytes:
+            transcript = ''
+            async for transcript in self.transcribe_progressive(data, filename):
+                pass
+            return transcript
+
+        data, filename = await self.prepare(data, filename)
+        audio = io.BytesIO(data)
+        audio.name = filename
+        return await self.openai.transcribe(audio)
+
+    async def transcribe_progressive(self, data: bytes, filename: str) -> AsyncIterator[str]:
+        """
+        Transcribes the audio of a file, yielding the transcript so far every time the next segment is done.
+        Short files are transcribed in one piece and yield a single, complete transcript.
+        :param data: The content of the file
+        :param filename: The name of the file, its extension gives the audio format
+        """
+        if len(data) <= min(self.chunk_threshold, self.max_upload_bytes):
+            yield await self.transcribe(data, filename)
+            return
+
+        source_format = audio_format(filename) or None
+        loop = asyncio.get_running_loop()
+        segments = await loop.run_in_executor(self._pool(), split_at_silence, data, source_format,
+                                              self.chunk_seconds, self.chunk_seconds / 2, self.chunk_format)
+        logging.info(f'Split {len(data)} bytes of audio into {len(segments)} segments')
+
+        semaphore = asyncio.Semaphore(self.max_concurrent_chunks)
+
+        async def transcribe_segment(index: int, segment: bytes) -> str:
+            async with semaphore:
+                audio = io.BytesIO(segment)
+                audio.name = f'segment{index}.{self.chunk_format}'
+                return await self.openai.transcribe(audio)
+
+        tasks = [asyncio.ensure_future(transcribe_segment(index, segment)) for index, segment in enumerate(segments)]
+        try:
+            transcript = []
+            for task in tasks:
+                transcript.append((await task).strip())
+                yield " ".join(transcript)
+        finally:
+            for task in tasks:
+                task.cancel()
+
+    async def prepare(self, data: bytes, filename: str) -> tuple:
+        """
+        Returns the audio and file name to upload, transcoding the audio if Whisper does not accept its format.
+        """
+        source_format = audio_format(filename)
+        if source_format in self.accepted_formats:
+            self.passed_through += 1
+            return data, f'audio.{source_format}'
+
+        logging.info(f'Transcoding {len(data)} bytes of {source_format or "unknown"} audio to mp3')
+        self.transcoded += 1
+        loop = asyncio.get_running_loop()
+        data = await loop.run_in_executor(self._pool(), transcode, data, source_format or None, 'mp3')
+        return data, 'audio.mp3'
+
+    def close(self):
+        """
+        Stops the transcoding processes once they finish the work they have.
+        """
+        if self._executor is not None:
+            self._executor.shutdown(wait=False)
+            self._executor = None
+
+    def _pool(self) -> ProcessPoolExecutor:
+        if self._executor is None:
+            self._executor = ProcessPoolExecutor(max_workers=self.max_workers,
+                                                 mp_context=multiprocessing.get_context('spawn'))
+        return self._executor
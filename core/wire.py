@@ -0,0 +1,88 @@
+import json
+import logging
+from contextlib import contextmanager
+from contextvars import ContextVar
+from typing import Dict, Iterator, List, Optional, Tuple
+
+import aiohttp
+from openai import api_requestor, version
+
+from core.history import EncodedMessages
+
+# The version of the openai library whose private requestor methods EncodedRequestor overrides
+OPENAI_VERSION = '0.27.4'
+
+# The responses of the streamed requests sent in the current context, see `streams`
+_streams: ContextVar[Optional[List[aiohttp.ClientResponse]]] = ContextVar('streams', default=None)
+
+
+def encode_request(params: dict) -> bytes:
+    """
+    Returns the JSON body of a ChatCompletion request whose `messages` were encoded by their history.
+    Only the other arguments are serialised, the messages are joined into the body as they are.
+    """
+    rest = json.dumps({name: value for name, value in params.items() if name != 'messages'}).encode()
+    return b''.join((b'{"messages": ', params['messages'].encode(), b', ' if len(rest) > 2 else b'', rest[1:]))
+
+
+class EncodedRequestor(api_requestor.APIRequestor):
+    """
+    The requestor of the openai library, sending the requests whose `messages` are EncodedMessages
+    with a body assembled from their pre-encoded JSON instead of serialising the whole conversation.
+    It also records the responses of streamed requests for `streams`.
+    """
+
+    def _prepare_request_raw(self, url, supplied_headers, method, params, files,
+                             request_id: Optional[str]) -> Tuple[str, Dict[str, str], Optional[bytes]]:
+        if method != 'post' or files or not isinstance((params or {}).get('messages'), EncodedMessages):
+            return super()._prepare_request_raw(url, supplied_headers, method, params, files, request_id)
+        abs_url, headers, _ = super()._prepare_request_raw(url, supplied_headers, method, None, None, request_id)
+        headers['Content-Type'] = 'application/json'
+        return abs_url, headers, encode_request(params)
+
+    async def arequest_raw(self, method, url, session, *, params=None, **kwargs) -> aiohttp.ClientResponse:
+        result = await super().arequest_raw(method, url, session, params=params, **kwargs)
+        responses = _streams.get()
+        if responses is not None and params and params.get('stream'):
+            responses.append(result)
+        return result
+
+
+@contextmanager
+def streams() -> Iterator[List[aiohttp.ClientResponse]]:
+    """
+    Collects the HTTP responses of the streamed requests sent in the block, including the ones sent
+    later by the tasks it starts, so that a stream given up on can be closed with `close_streams`.
+    """
+    responses = []
+    token = _streams.set(responses)
+    try:
+        yield responses
+    finally:
+        _streams.reset(token)
+
+
+def close_streams(responses: List[aiohttp.ClientResponse]):
+    """
+    Closes the connections of the streams still being received, which stops their generation upstream.
+    The ones that ended were already released to the pool and are left alone.
+    """
+    for response in responses:
+        response.close()
+
+
+def install() -> bool:
+    """
+    Makes the openai library send its requests through EncodedRequestor. Safe to call more than once.
+    Other versions of the library than OPENAI_VERSION keep their own requestor, since EncodedRequestor
+    overrides private methods of it; their requests are serialised whole and their streams cannot be closed.
+    :return: Whether the requests go through EncodedRequestor, and may carry EncodedMessages
+    """
+    if issubclass(api_requestor.APIRequestor, EncodedRequestor):
+        return True
+    if version.VERSION != OPENAI_VERSION:
+        logging.warning(f'Sending requests with the requestor of openai {version.VERSION}, '
+                        f'the encoded requests only support openai {OPENAI_VERSION}')
+        return False
+    api_requestor.APIRequestor = EncodedRequestor
+    return True
@@ -1,16 +1,32 @@
+import asyncio
 import logging
 import os
+import signal
+from typing import Optional
 
-import cherrypy
-import multiprocess as multiprocess
 from dotenv import load_dotenv
 
-from api.web.query import DictionApp
-from core.openai_helper import OpenAIHelper
+from core.dispatcher import ShardedDispatcher
+from core.openai_helper import AsyncOpenAIHelper
+from core.sqlite_session_store import SqliteSessionStore
+from api.telegram.bot_worker import run_worker
 from api.telegram.telegram_bot import TelegramBotApp
 from api.telegram.telegram_user import TelegramUserApp
 
 
+async def start(telegram_bot: TelegramBotApp, telegram_user_app: TelegramUserApp, web_server,
+                timeout: Optional[float]) -> asyncio.Task:
+    """
+    Connects the bot and the user account at the same time and starts the web server.
+    Returns once the bot handles messages, without waiting for the user account, which only
+    polishes messages and is given up on after `timeout` seconds, e.g. when its proxy is down.
+    :return: The task logging the user account in
+    """
+    user = asyncio.ensure_future(telegram_user_app.start(timeout))
+    await asyncio.gather(telegram_bot.start(timeout), *([web_server.start()] if web_server is not None else []))
+    return user
+
+
 def main():
     # Read .env file
     load_dotenv()
@@ -45,11 +61,92 @@ def main():
         'temperature': 1,
 
         # How many chat completion choices to generate for each input message.
+        # With more than one, every choice is streamed into its own message at the same time
         'n_choices': 1,
 
+        # Hedged requests: a streamed answer is also requested from each of 'models' (the same model
+        # may be repeated), one more every 'delay' seconds until a first token arrives. The first
+        # request to stream a token is kept and the others are cancelled. Costs up to one extra
+        # completion per model, so it is off unless models are listed
+        'hedge': {'models': [], 'delay': 1.0},
+
+        # What the history keeps of a streamed answer stopped before it ended (/stop, /reset or a new
+        # message): 'partial' keeps the text generated so far, 'none' keeps nothing
+        'cancelled_answers': os.environ.get('CANCELLED_ANSWERS', 'partial'),
+
         # The maximum number of tokens allowed for the generated answer
         'max_tokens': 1200,
 
+        # Models tried in turn when 'model' fails with a rate limit, server or invalid request error
+        # (e.g. a context too long for it), each after 'fallback_retries' retries of the previous one
+        'fallback_models': [],
+        'fallback_retries': 0,
+
+        # Routes choosing the model, max_tokens and temperature of a request by its function, the
+        # tokens of its query ('min_input_tokens', 'max_input_tokens') and of the whole conversation
+        # ('min_history_tokens', 'max_history_tokens'). The first matching route wins; requests no route
+        # matches use the settings above. A route falls back to each of its 'fallbacks' in turn, e.g.
+        #   {'name': 'lookup', 'functions': ['diction', 'translate'], 'max_input_tokens': 200,
+        #    'max_tokens': 400, 'temperature': 0},
+        #   {'name': 'long', 'model': 'gpt-4', 'min_history_tokens': 3000, 'fallbacks': ['gpt-3.5-turbo']},
+        # The latency and estimated cost of every route are exported in /stats and /metrics
+        'routes': [],
+
+        # USD per 1000 prompt and completion tokens of the models missing from core.router.MODEL_PRICES
+        'model_prices': {},
+
+        # The context window of the model. Older turns are compacted so that the prompt
+        # plus 'max_tokens' always fits in it. Defaults to the known size of 'model'
+        'context_size': None,
+
+        # Whether older turns are summarised by the model instead of being dropped
+        # once the history outgrows the prompt budget
+        'summarise_history': os.environ.get('SUMMARISE_HISTORY', 'false').lower() == 'true',
+
+        # The maximum number of tokens of a history summary
+        'summary_max_tokens': 256,
+
+        # Chats quiet for 'quiet_period' seconds are prepared in the background, looked for every
+        # 'interval' seconds: the histories that outgrew the prompt budget of their latest request are
+        # compacted as that request would be (summarised if 'summarise_history' is on), and all are
+        # pre-joined for the next request. At most 'max_concurrent' chats at a time, within 'cpu_share'
+        # of the CPU, and only while no message is waiting to be answered. Off unless IDLE_QUIET_PERIOD is set
+        'idle_worker': {'quiet_period': float(os.environ['IDLE_QUIET_PERIOD']), 'interval': 15.0,
+                        'max_concurrent': 1, 'cpu_share': 0.1}
+        if os.environ.get('IDLE_QUIET_PERIOD') else None,
+
+        # Limits of the in-memory conversation store. The least recently used chats are evicted once
+        # more than 'max_sessions' chats or 'max_session_bytes' bytes of messages are held, and chats
+        # untouched for 'session_idle_timeout' seconds are dropped. None means unbounded
+        'max_sessions': int(os.environ.get('MAX_SESSIONS', 10000)),
+        'max_session_bytes': int(os.environ.get('MAX_SESSION_BYTES', 256 * 1024 * 1024)),
+        'session_idle_timeout': 7 * 24 * 3600,
+
+        # The SQLite database the conversations are persisted to and shared through by the bot
+        # and the web API. Conversations only live in memory if empty
+        'session_db': os.environ.get('SESSION_DB', '.chatgpt-telegram-bot.sqlite3'),
+
+        # The account's OpenAI quota. Calls are held back so that no more than 'requests_per_minute'
+        # requests and 'tokens_per_minute' tokens (prompt plus 'max_tokens') are sent per minute, and
+        # calls failing with a rate limit or server error are retried up to 'max_retries' times.
+        # None means no quota is enforced on this side
+        'rate_limit': {
+            'requests_per_minute': int(os.environ['OPENAI_RPM']) if os.environ.get('OPENAI_RPM') else None,
+            'tokens_per_minute': int(os.environ['OPENAI_TPM']) if os.environ.get('OPENAI_TPM') else None,
+            'max_retries': 5,
+        },
+
+        # Cache of the answers of the stateless functions. Only answers sampled at temperature 0 are
+        # cached unless 'cache_sampled' is set; with 'similarity' (e.g. 0.9) near-duplicate queries
+        # are answered from the cache too. Saved to 'path' on exit, kept in memory only if empty
+        'response_cache': {
+            'functions': ['polish', 'translate', 'diction'],
+            'max_size': 10000,
+            'path': os.environ.get('RESPONSE_CACHE', '.chatgpt-telegram-bot.responses.json') or None,
+            'cache_sampled': False,
+            'similarity': None,
+        },
+
         # Number between -2.0 and 2.0. Positive values penalize new tokens based on whether
         # they appear in the text so far, increasing the model's likelihood to talk about new topics.
         'presence_penalty': 0,
@@ -59,7 +156,14 @@ def main():
         'frequency_penalty': 0,
 
         # The DALL·E generated image size
-        'image_size': '512x512'
+        'image_size': '512x512',
+
+        # Generated images are saved to the directory 'path' by prompt and size, and the least recently
+        # used ones deleted beyond 'max_bytes'. Kept only while being generated if 'path' is empty
+        'image_cache': {
+            'path': os.environ.get('IMAGE_CACHE', '.chatgpt-telegram-bot.images') or None,
+            'max_bytes': int(os.environ.get('IMAGE_CACHE_BYTES', 256 * 1024 * 1024)),
+        },
     }
 
     telegram_bot_config = {
@@ -68,30 +172,117 @@ def main():
         'proxy': os.environ.get('PROXY', None),
         "telegram_app_id": int(os.environ['TELEGRAM_APP_ID']),
         "telegram_app_hash": os.environ['TELEGRAM_APP_HASH'],
+
+        # The proxy the bot connects to Telegram through, e.g. 'socks5://127.0.0.1:1080'
+        'telegram_proxy': os.environ.get('TELEGRAM_PROXY') or None,
+
+        # Seconds the bot and the user account may take to connect to Telegram
+        'connect_timeout': float(os.environ.get('TELEGRAM_CONNECT_TIMEOUT', 30)),
+
+        # The allowed user IDs are read again when this file changes, or from the variable on SIGHUP
+        'allowed_user_ids_file': os.environ.get('ALLOWED_TELEGRAM_USER_IDS_FILE') or None,
+        'allowed_user_ids_variable': 'ALLOWED_TELEGRAM_USER_IDS',
+
+        # The models a chat may switch to with /set model
+        'chat_models': [openai_config['model']],
+
+        # How streamed answers are edited into place: at most one edit every 'min_interval' seconds,
+        # and only once 'min_chars' new characters arrived or 'max_delay' seconds passed
+        'stream_edits': {'min_interval': 1.0, 'min_chars': 40, 'max_delay': 3.0},
+
+        # At most 'max_in_flight' answers are generated at a time, chats with waiting messages take turns
+        'scheduler': {'max_in_flight': int(os.environ.get('MAX_IN_FLIGHT', 8))},
+
+        # Worker processes the messages are handed to by chat, so that every core answers messages.
+        # With 0, this process answers them. Each worker logs the bot in with a session of its own
+        'workers': int(os.environ.get('BOT_WORKERS', 0)),
+
+        # Whether a new message stops the answer still being generated in its chat
+        'cancel_on_new_message': os.environ.get('CANCEL_ON_NEW_MESSAGE', 'true').lower() == 'true',
+
+        # Whether messages sent while an answer is being generated are answered together in one turn
+        'merge_queued_messages': os.environ.get('MERGE_QUEUED_MESSAGES', 'false').lower() == 'true',
+
+        # Images a chat may have generated at the same time with /image
+        'image_max_in_flight': int(os.environ.get('IMAGE_MAX_IN_FLIGHT', 1)),
+
+        # Edits per second, and back-to-back edits, allowed per chat across all its answers
+        'edit_budget': {'rate': 1.0, 'burst': 3},
+
+        # Audio Whisper does not accept is transcoded to mp3 by 'max_workers' processes. Files larger than
+        # 'chunk_threshold' bytes are split at pauses into segments of at most 'chunk_seconds', transcribed
+        # 'max_concurrent_chunks' at a time, and the transcript is edited in place as segments complete
+        'transcription': {'max_workers': 2, 'chunk_threshold': 1024 * 1024, 'chunk_seconds': 120,
+                          'max_concurrent_chunks': 4},
     }
 
     telegram_user_config = {
         "telegram_app_id": int(os.environ['TELEGRAM_APP_ID']),
         "telegram_app_hash": os.environ['TELEGRAM_APP_HASH'],
         'token': os.environ['TELEGRAM_BOT_TOKEN'],
+
+        # The proxy the user account connects to Telegram through, the bot's by default
+        'proxy': os.environ.get('TELEGRAM_USER_PROXY', os.environ.get('TELEGRAM_PROXY')) or None,
+    }
+
+    web_config = {
+        # Whether the dictionary web API, /stats and /metrics are served
+        'enabled': os.environ.get('WEB_ENABLED', 'true').lower() == 'true',
+        'host': os.environ.get('WEB_HOST', '0.0.0.0'),
+        'port': int(os.environ.get('WEB_PORT', 5000)),
+
+        # The maximum number of requests handled at the same time, the others wait for a free slot
+        'max_concurrency': int(os.environ.get('WEB_MAX_CONCURRENCY', 64)),
     }
 
     # Setup and run ChatGPT and Telegram bot
-    openai_helper = OpenAIHelper(config=openai_config)
+    openai_helper = AsyncOpenAIHelper(config=openai_config, sessions=SqliteSessionStore.from_config(openai_config))
 
-    def web_api():
-        cherrypy.config.update({
-                'server.socket_host': '0.0.0.0',
-                'server.socket_port': 5000,
-        })
-        cherrypy.quickstart(DictionApp(openai_helper))
-    multiprocess.Process(target=web_api).start()
+    dispatcher = None
+    if telegram_bot_config['workers']:
+        dispatcher = ShardedDispatcher(telegram_bot_config['workers'], run_worker, (telegram_bot_config, openai_config))
+        dispatcher.start()
 
     telegram_user_app = TelegramUserApp(telegram_user_config, openai_helper)
-    telegram_bot = TelegramBotApp(config=telegram_bot_config, openai=openai_helper)
+    telegram_bot = TelegramBotApp(config=telegram_bot_config, openai=openai_helper, dispatcher=dispatcher)
     telegram_bot.add_decorator(telegram_user_app=telegram_user_app)
 
-    telegram_bot.run()
+    # The web API shares the bot's event loop and OpenAI client
+    web_server = None
+    if web_config.pop('enabled'):
+        from api.web.query import DictionApp
+        from api.web.server import WebServer, metrics_route, stats_route
+
+        diction_app = DictionApp(openai_helper)
+        web_server = WebServer(diction_app.routes(), **web_config)
+        web_server.app.add_routes([stats_route({
+            'word_cache': diction_app.cache.stats,
+            'sessions': openai_helper.sessions.stats,
+            'openai': openai_helper.rate_limiter.stats,
+            'response_cache': openai_helper.response_cache.stats,
+            'image_cache': openai_helper.image_cache.stats,
+            'router': openai_helper.router.stats,
+            **({'idle_worker': openai_helper.idle_worker.stats} if openai_helper.idle_worker is not None else {}),
+            'scheduler': telegram_bot.scheduler.stats,
+            'web': web_server.stats,
+            **({'dispatcher': dispatcher.stats} if dispatcher is not None else {}),
+        }), metrics_route()])
+    loop = telegram_bot.client.loop
+    if hasattr(signal, 'SIGHUP'):
+        # Edit the allowed users in .env, then `kill -HUP` the bot
+        loop.add_signal_handler(signal.SIGHUP, lambda: (load_dotenv(override=True), telegram_bot.allowed.reload()))
+    user_login = loop.run_until_complete(
+        start(telegram_bot, telegram_user_app, web_server, telegram_bot_config['connect_timeout']))
+    try:
+        telegram_bot.run()
+    finally:
+        user_login.cancel()
+        telegram_bot.transcription.close()
+        if dispatcher is not None:
+            dispatcher.stop()
+        if web_server is not None:
+            loop.run_until_complete(web_server.stop())
+        loop.run_until_complete(openai_helper.close())
 
 
 if __name__ == '__main__':
@@ -0,0 +1,11 @@
+CONFIG = {
+    'api_key': 'sk-test',
+    'proxy': None,
+    'model': 'gpt-3.5-turbo',
+    'assistant_prompt': 'You are a helpful assistant.',
+    'temperature': 1,
+    'n_choices': 1,
+    'max_tokens': 1200,
+    'presence_penalty': 0,
+    'frequency_penalty': 0,
+}
@@ -0,0 +1,67 @@
+import os
+import tempfile
+import unittest
+from unittest import mock
+
+from api.telegram.allow_list import AllowList
+
+
+class AllowListTest(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        self.path = os.path.join(self.directory.name, 'allowed_users.txt')
+
+    def tearDown(self):
+        self.directory.cleanup()
+
+    def write(self, text: str, mtime: float):
+        with open(self.path, 'w', encoding='utf-8') as file:
+            file.write(text)
+        os.utime(self.path, (mtime, mtime))
+
+    def test_parses_ids_and_everyone(self):
+        allowed = AllowList('1, 2,,x')
+        self.assertIn(1, allowed)
+        self.assertIn(2, allowed)
+        self.assertNotIn(3, allowed)
+        self.assertIn(3, AllowList('*'))
+
+    def test_reads_the_file_again_when_it_changes(self):
+        self.write('1 # alice\n2\n', 1000)
+        allowed = AllowList('*', path=self.path, check_interval=0)
+        self.assertEqual(allowed.ids, {1, 2})
+        self.assertNotIn(3, allowed)
+
+        self.write('3\n', 2000)
+        self.assertIn(3, allowed)
+        self.assertNotIn(1, allowed)
+
+    def test_checks_the_file_at_most_every_interval(self):
+        self.write('1\n', 1000)
+        allowed = AllowList(path=self.path, check_interval=3600)
+        self.write('2\n', 2000)
+        self.assertNotIn(2, allowed)
+        allowed.reload()
+        self.assertIn(2, allowed)
+
+    def test_keeps_the_ids_if_the_file_is_gone(self):
+        self.write('1\n', 1000)
+        allowed = AllowList(path=self.path, check_interval=0)
+        os.remove(self.path)
+        allowed.reload()
+        self.assertIn(1, allowed)
+
+    def test_reloads_the_variable(self):
+        allowed = AllowList('1', variable='ALLOWED_TEST_IDS')
+        with mock.patch.dict(os.environ, {'ALLOWED_TEST_IDS': '2,3'}):
+            self.assertIn(1, allowed)
+            allowed.reload()
+        self.assertNotIn(1, allowed)
+        self.assertIn(3, allowed)
+
+        allowed.reload()
+        self.assertIn(3, allowed)
+
+
+if __name__ == '__main__':
+    unittest.main()
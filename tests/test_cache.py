@@ -0,0 +1,98 @@
+import asyncio
+import time
+import unittest
+
+from core.cache import SingleFlight, TTLCache
+
+
+class Computation:
+    """
+    A computation that counts its calls and waits to be released.
+    """
+
+    def __init__(self, value='value'):
+        self.value = value
+        self.calls = 0
+        self.release = asyncio.Event()
+
+    async def __call__(self):
+        self.calls += 1
+        await self.release.wait()
+        if isinstance(self.value, BaseException):
+            raise self.value
+        return self.value
+
+
+class TTLCacheTest(unittest.IsolatedAsyncioTestCase):
+    def test_expires_entries(self):
+        cache = TTLCache(ttl=0.01)
+        cache.set('key', 1)
+        self.assertEqual(cache.get('key'), 1)
+        time.sleep(0.02)
+        self.assertIsNone(cache.get('key'))
+        self.assertEqual(cache.stats()['expirations'], 1)
+
+    def test_evicts_the_least_recently_used(self):
+        cache = TTLCache(max_size=2)
+        cache.set('a', 1)
+        cache.set('b', 2)
+        cache.get('a')
+        cache.set('c', 3)
+        self.assertEqual([key for key, _ in cache.items()], ['a', 'c'])
+
+    async def test_coalesces_concurrent_misses(self):
+        cache = TTLCache()
+        compute = Computation()
+        tasks = [asyncio.ensure_future(cache.aget_or_compute('key', compute)) for _ in range(3)]
+        await asyncio.sleep(0)
+        compute.release.set()
+        self.assertEqual(await asyncio.gather(*tasks), ['value'] * 3)
+        self.assertEqual(compute.calls, 1)
+        self.assertEqual(cache.stats()['coalesced'], 2)
+        self.assertEqual(cache.get('key'), 'value')
+
+    async def test_errors_reach_every_caller(self):
+        cache = TTLCache()
+        compute = Computation(ValueError('failed'))
+        tasks = [asyncio.ensure_future(cache.aget_or_compute('key', compute)) for _ in range(2)]
+        await asyncio.sleep(0)
+        compute.release.set()
+        results = await asyncio.gather(*tasks, return_exceptions=True)
+        self.assertTrue(all(isinstance(result, ValueError) for result in results))
+        self.assertEqual(len(cache), 0)
+
+    async def test_a_waiter_takes_over_from_a_cancelled_leader(self):
+        cache = TTLCache()
+        compute = Computation()
+        leader = asyncio.ensure_future(cache.aget_or_compute('key', compute))
+        await asyncio.sleep(0)
+        waiters = [asyncio.ensure_future(cache.aget_or_compute('key', compute)) for _ in range(2)]
+        await asyncio.sleep(0)
+
+        leader.cancel()
+        await asyncio.sleep(0.01)
+        compute.release.set()
+        self.assertEqual(await asyncio.gather(*waiters), ['value'] * 2)
+        self.assertTrue(leader.cancelled())
+        self.assertEqual(compute.calls, 2)
+        self.assertEqual(cache.get('key'), 'value')
+        self.assertEqual(cache.stats()['inflight'], 0)
+
+    async def test_a_cancelled_waiter_leaves_the_computation_running(self):
+        flights = SingleFlight()
+        compute = Computation()
+        leader = asyncio.ensure_future(flights.run('key', compute))
+        await asyncio.sleep(0)
+        waiter = asyncio.ensure_future(flights.run('key', compute))
+        await asyncio.sleep(0)
+
+        waiter.cancel()
+        await asyncio.sleep(0.01)
+        compute.release.set()
+        self.assertEqual(await leader, ('value', True))
+        self.assertTrue(waiter.cancelled())
+        self.assertEqual(len(flights), 0)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,55 @@
+import asyncio
+import unittest
+
+from api.telegram.client import resume_client, start_client
+
+
+class FakeClient:
+    def __init__(self, authorized: bool = True, connect_seconds: float = 0):
+        self.authorized = authorized
+        self.connect_seconds = connect_seconds
+        self.connected = False
+
+    async def connect(self):
+        await asyncio.sleep(self.connect_seconds)
+        self.connected = True
+
+    async def is_user_authorized(self) -> bool:
+        return self.authorized
+
+    async def start(self, **kwargs):
+        await self.connect()
+        if not self.authorized:
+            input('Please enter your phone (or bot token): ')
+
+    async def disconnect(self):
+        self.connected = False
+
+
+class ResumeClientTest(unittest.IsolatedAsyncioTestCase):
+    async def test_logs_in_from_the_saved_session(self):
+        client = FakeClient()
+        self.assertTrue(await resume_client(client, 'user account', 1))
+        self.assertTrue(client.connected)
+
+    async def test_gives_up_without_a_saved_session_instead_of_prompting(self):
+        client = FakeClient(authorized=False)
+        with self.assertLogs(level='WARNING'):
+            self.assertFalse(await resume_client(client, 'user account', 1))
+        self.assertFalse(client.connected)
+
+    async def test_gives_up_after_the_timeout(self):
+        client = FakeClient(connect_seconds=10)
+        with self.assertLogs(level='WARNING'):
+            self.assertFalse(await resume_client(client, 'user account', 0.01))
+
+
+class StartClientTest(unittest.IsolatedAsyncioTestCase):
+    async def test_starts_the_client(self):
+        client = FakeClient()
+        self.assertTrue(await start_client(client, 'bot', 1, bot_token='1:token'))
+        self.assertTrue(client.connected)
+
+
+if __name__ == '__main__':
+    unittest.main()
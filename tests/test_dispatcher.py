@@ -0,0 +1,56 @@
+import time
+import unittest
+
+from core.dispatcher import ShardedDispatcher, Update, shard
+
+
+def echo_worker(index, inbox, done):
+    while True:
+        update = inbox.get()
+        if update is None:
+            return
+        done.put((index, update.message_id, time.perf_counter()))
+
+
+def failed_login_worker(index, inbox, done):
+    if index == 1:
+        return
+    echo_worker(index, inbox, done)
+
+
+class ShardedDispatcherTest(unittest.TestCase):
+    def run_dispatcher(self, target) -> ShardedDispatcher:
+        handled = []
+        dispatcher = ShardedDispatcher(2, target, on_done=handled.append)
+        dispatcher.handled = handled
+        dispatcher.start()
+        self.addCleanup(dispatcher.stop, 10)
+        return dispatcher
+
+    def test_shards_chats_by_id(self):
+        self.assertEqual(shard(4, 2), 0)
+        self.assertEqual(shard(-3, 2), 1)
+
+    def test_hands_updates_to_the_worker_of_their_chat(self):
+        dispatcher = self.run_dispatcher(echo_worker)
+        self.assertTrue(dispatcher.dispatch(Update('message', 2, 10, 'hi')))
+        self.assertTrue(dispatcher.dispatch(Update('message', 3, 11, 'hi')))
+        deadline = time.monotonic() + 30
+        while len(dispatcher.handled) < 2 and time.monotonic() < deadline:
+            time.sleep(0.05)
+        self.assertEqual(sorted(handled[:2] for handled in dispatcher.handled), [(0, 10), (1, 11)])
+
+    def test_refuses_the_updates_of_an_exited_worker(self):
+        dispatcher = self.run_dispatcher(failed_login_worker)
+        dispatcher._processes[1].join(30)
+
+        with self.assertLogs(level='ERROR'):
+            self.assertFalse(dispatcher.dispatch(Update('message', 3, 11, 'hi')))
+        self.assertFalse(dispatcher.dispatch(Update('message', 5, 12, 'hi')))
+        self.assertTrue(dispatcher.dispatch(Update('message', 2, 10, 'hi')))
+        self.assertEqual(dispatcher.stats()['dropped'], 2)
+        self.assertEqual(dispatcher.stats()['alive'], 1)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,124 @@
+import asyncio
+import unittest
+from unittest import mock
+
+from telethon.errors import MessageNotModifiedError, MessageTooLongError
+
+from api.telegram.edit_scheduler import EditBudget, StreamEditor
+
+CHAT_ID = 1
+
+
+class FakeClient:
+    def __init__(self, latency: float = 0.0, max_length: int = 4096):
+        self.latency = latency
+        self.max_length = max_length
+        self.sent = []
+        self.edits = []
+
+    async def send_message(self, chat_id, text, reply_to=None):
+        await asyncio.sleep(self.latency)
+        self.check(text)
+        self.sent.append(text)
+        return len(self.sent)
+
+    async def edit_message(self, entity, message):
+        await asyncio.sleep(self.latency)
+        self.check(message)
+        if message == ([text for number, text in self.edits if number == entity] or [self.sent[entity - 1]])[-1]:
+            raise MessageNotModifiedError(None)
+        self.edits.append((entity, message))
+
+    def check(self, text: str):
+        if len(text) > self.max_length:
+            raise MessageTooLongError(None)
+
+
+class EditBudgetTest(unittest.TestCase):
+    def test_forgets_chats_whose_bucket_refilled(self):
+        budget = EditBudget(rate=1, burst=2)
+        with mock.patch('time.monotonic', return_value=100.0):
+            budget.try_acquire(1)
+            budget.try_acquire(2)
+        with mock.patch('time.monotonic', return_value=100.5):
+            budget.try_acquire(3)
+        self.assertEqual(list(budget._buckets), [1, 2, 3])
+
+        with mock.patch('time.monotonic', return_value=101.2):
+            budget.try_acquire(4)
+        self.assertEqual(list(budget._buckets), [3, 4])
+
+    def test_keeps_blocked_chats(self):
+        budget = EditBudget(rate=1, burst=2)
+        with mock.patch('time.monotonic', return_value=100.0):
+            budget.block(1, 30)
+        with mock.patch('time.monotonic', return_value=110.0):
+            budget.try_acquire(2)
+            self.assertFalse(budget.try_acquire(1))
+        self.assertEqual(list(budget._buckets), [2, 1])
+
+
+class StreamEditorTest(unittest.IsolatedAsyncioTestCase):
+    async def test_sends_then_edits(self):
+        client = FakeClient()
+        editor = StreamEditor(client, CHAT_ID, EditBudget(rate=100, burst=10), min_interval=0, min_chars=1)
+        await editor.update('Hello')
+        await editor.update('Hello there')
+        self.assertEqual(await editor.finish('Hello there!'), 3)
+        self.assertEqual(client.sent, ['Hello'])
+        self.assertEqual(client.edits, [(1, 'Hello there'), (1, 'Hello there!')])
+
+    async def test_finish_waits_for_the_send_of_the_timer(self):
+        client = FakeClient(latency=0.1)
+        budget = EditBudget(rate=50, burst=1)
+        budget.try_acquire(CHAT_ID)
+        editor = StreamEditor(client, CHAT_ID, budget, max_delay=0)
+        # Out of budget, the first text is sent by the timer once the budget allows it
+        await editor.update('Hello')
+        await asyncio.sleep(0.05)
+        self.assertFalse(editor._timer_sleeping)
+
+        await editor.finish('Hello there')
+        self.assertEqual(client.sent, ['Hello'])
+        self.assertEqual(client.edits, [(1, 'Hello there')])
+
+    async def test_finish_cancels_a_sleeping_timer(self):
+        client = FakeClient()
+        editor = StreamEditor(client, CHAT_ID, EditBudget(rate=1, burst=2), min_interval=10)
+        await editor.update('Hello')
+        await editor.update('Hello there')
+        timer = editor._timer
+        self.assertTrue(editor._timer_sleeping)
+
+        await editor.finish()
+        self.assertTrue(timer.cancelled())
+        self.assertEqual(client.sent, ['Hello'])
+        self.assertEqual(client.edits, [(1, 'Hello there')])
+
+    async def test_goes_on_in_a_new_message_once_one_is_full(self):
+        client = FakeClient()
+        editor = StreamEditor(client, CHAT_ID, EditBudget(rate=100, burst=10), min_interval=0, min_chars=1)
+        await editor.update('a' * 4000)
+        self.assertEqual(await editor.finish('a' * 4000 + 'b' * 5000), 4)
+        self.assertEqual(client.sent, ['a' * 4000, 'b' * 4096, 'b' * 808])
+        self.assertEqual(client.edits, [(1, 'a' * 4000 + 'b' * 96)])
+
+    async def test_splits_shorter_when_telegram_finds_the_message_too_long(self):
+        client = FakeClient(max_length=3000)
+        editor = StreamEditor(client, CHAT_ID, EditBudget(rate=100, burst=10))
+        with self.assertLogs(level='WARNING'):
+            await editor.finish('a' * 5000)
+        self.assertEqual(''.join(client.sent), 'a' * 5000)
+        self.assertTrue(all(len(text) <= 3000 for text in client.sent))
+
+    async def test_ignores_unchanged_final_text(self):
+        client = FakeClient()
+        editor = StreamEditor(client, CHAT_ID, EditBudget(rate=100, burst=10), min_interval=0, min_chars=1)
+        await editor.update('Hello')
+        editor.shown = ''
+        self.assertEqual(await editor.finish('Hello'), 1)
+        self.assertEqual(client.sent, ['Hello'])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,43 @@
+import unittest
+
+from core.idle_worker import IdleWorker
+from core.openai_helper import AsyncOpenAIHelper
+from tests import CONFIG
+
+
+class IdleWorkerTest(unittest.IsolatedAsyncioTestCase):
+    async def asyncSetUp(self):
+        self.helper = AsyncOpenAIHelper(CONFIG)
+        self.worker = IdleWorker(self.helper, cpu_share=1.0)
+        self.session = self.helper.sessions[1]
+        self.history = self.session['assistant']
+        for index in range(20):
+            self.history.append('user' if index % 2 == 0 else 'assistant', f'message number {index} of the chat')
+
+    async def asyncTearDown(self):
+        await self.helper.close()
+
+    def test_is_off_unless_configured(self):
+        self.assertIsNone(IdleWorker.from_config(self.helper, CONFIG))
+        self.assertIsNone(IdleWorker.from_config(self.helper, dict(CONFIG, idle_worker=None)))
+
+    async def test_leaves_histories_within_their_budget(self):
+        self.history.budget = self.history.tokens
+        await self.worker._prepare(self.session)
+        self.assertEqual(len(self.history), 21)
+        self.assertEqual(self.worker.prepared, 1)
+
+    async def test_leaves_histories_never_sent(self):
+        await self.worker._prepare(self.session)
+        self.assertEqual(len(self.history), 21)
+
+    async def test_trims_histories_to_the_budget_of_their_request(self):
+        budget = self.history.tokens - self.history[1].tokens - self.history[2].tokens
+        self.history.budget = budget
+        await self.worker._prepare(self.session)
+        self.assertEqual(len(self.history), 19)
+        self.assertLessEqual(self.history.tokens, budget)
+
+
+if __name__ == '__main__':
+    unittest.main()
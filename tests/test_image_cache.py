@@ -0,0 +1,58 @@
+import asyncio
+import os
+import tempfile
+import unittest
+
+from core.image_cache import ImageCache
+from tests.test_cache import Computation
+
+PNG = b'\x89PNG\r\n\x1a\n'
+
+
+class ImageCacheTest(unittest.IsolatedAsyncioTestCase):
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+
+    def tearDown(self):
+        self.directory.cleanup()
+
+    async def test_reads_cached_images_back(self):
+        cache = ImageCache(self.directory.name)
+        compute = Computation(PNG + b'fox')
+        compute.release.set()
+        self.assertEqual(await cache.aget_or_compute('a fox', '512x512', compute), PNG + b'fox')
+        self.assertEqual(await cache.aget_or_compute('a fox', '512x512', compute), PNG + b'fox')
+        self.assertEqual(compute.calls, 1)
+
+        reloaded = ImageCache(self.directory.name)
+        self.assertEqual(await reloaded.aget_or_compute('a fox', '512x512', compute), PNG + b'fox')
+        self.assertEqual(reloaded.stats()['hits'], 1)
+
+    async def test_evicts_the_least_recently_used_images(self):
+        cache = ImageCache(self.directory.name, max_bytes=2 * len(PNG))
+        for prompt in ('a', 'b', 'c'):
+            compute = Computation(PNG)
+            compute.release.set()
+            await cache.aget_or_compute(prompt, '256x256', compute)
+        self.assertEqual(cache.stats()['images'], 2)
+        self.assertFalse(os.path.exists(cache._file(cache.key('a', '256x256'))))
+
+    async def test_a_waiter_takes_over_from_a_cancelled_generation(self):
+        cache = ImageCache(self.directory.name)
+        compute = Computation(PNG)
+        leader = asyncio.ensure_future(cache.aget_or_compute('a fox', '512x512', compute))
+        await asyncio.sleep(0.01)
+        waiters = [asyncio.ensure_future(cache.aget_or_compute('a fox', '512x512', compute)) for _ in range(2)]
+        await asyncio.sleep(0.01)
+
+        leader.cancel()
+        await asyncio.sleep(0.01)
+        compute.release.set()
+        self.assertEqual(await asyncio.gather(*waiters), [PNG] * 2)
+        self.assertEqual(compute.calls, 2)
+        self.assertEqual(cache.stats()['coalesced'], 1)
+        self.assertEqual(cache.stats()['images'], 1)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,36 @@
+import math
+import unittest
+
+from core.metrics import Counter, Gauge, Histogram
+
+
+class MetricsTest(unittest.TestCase):
+    def test_renders_special_values(self):
+        gauge = Gauge('test_gauge', 'A gauge', ['kind'])
+        for kind, value in (('up', math.inf), ('down', -math.inf), ('none', math.nan), ('whole', 3.0),
+                            ('part', 0.5)):
+            gauge.labels(kind).set(value)
+        self.assertEqual(gauge.render()[2:], [
+            'test_gauge{kind="down"} -Inf',
+            'test_gauge{kind="none"} NaN',
+            'test_gauge{kind="part"} 0.5',
+            'test_gauge{kind="up"} +Inf',
+            'test_gauge{kind="whole"} 3',
+        ])
+
+    def test_renders_a_histogram_with_an_infinite_sum(self):
+        histogram = Histogram('test_seconds', 'A histogram', buckets=(1.0,))
+        histogram.observe(0.5)
+        histogram.observe(-math.inf)
+        lines = histogram.render()
+        self.assertIn('test_seconds_bucket{le="+Inf"} 2', lines)
+        self.assertIn('test_seconds_sum -Inf', lines)
+
+    def test_renders_counters(self):
+        counter = Counter('test_total', 'A counter')
+        counter.inc(2)
+        self.assertEqual(counter.render(), ['# HELP test_total A counter', '# TYPE test_total counter', 'test_total 2'])
+
+
+if __name__ == '__main__':
+    unittest.main()
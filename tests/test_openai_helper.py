@@ -0,0 +1,92 @@
+import unittest
+from unittest import mock
+
+import openai
+from openai.openai_object import OpenAIObject
+
+from core.openai_helper import AsyncOpenAIHelper, OpenAIHelper
+from tests import CONFIG
+
+SUMMARY_CONFIG = dict(CONFIG, summarise_history=True, prompt_budget=120, show_usage=False)
+
+
+def completion(request: dict) -> OpenAIObject:
+    summary = request['messages'][0]['content'].startswith('Summarise')
+    return OpenAIObject.construct_from({
+        'model': request['model'],
+        'choices': [{'index': 0, 'finish_reason': 'stop',
+                     'message': {'role': 'assistant', 'content': 'the summary' if summary else 'an answer'}}],
+        'usage': {'prompt_tokens': 10, 'completion_tokens': 2, 'total_tokens': 12},
+    })
+
+
+class FakeChatCompletion:
+    def __init__(self):
+        self.requests = []
+
+    def create(self, **request):
+        self.requests.append(request)
+        return completion(request)
+
+    async def acreate(self, **request):
+        return self.create(**request)
+
+
+class SummaryTest:
+    """
+    The history summary, as both helpers run it.
+    """
+
+    async def ask(self, query: str) -> str:
+        raise NotImplementedError
+
+    async def test_summarises_histories_over_the_budget(self):
+        for index in range(6):
+            self.assertEqual(await self.ask(f'question number {index} about the weather in the mountains'),
+                             'an answer')
+
+        history = self.helper.sessions[1]['assistant']
+        self.assertTrue(any(message.content == 'Summary of the earlier conversation: the summary'
+                            for message in history))
+        summaries = [request for request in self.chat.requests if len(request['messages']) == 2]
+        self.assertTrue(summaries)
+        self.assertLessEqual(history.tokens - history[-1].tokens, SUMMARY_CONFIG['prompt_budget'])
+
+    async def test_drops_turns_unless_enabled(self):
+        self.helper.config = dict(SUMMARY_CONFIG, summarise_history=False)
+        for index in range(6):
+            await self.ask(f'question number {index} about the weather in the mountains')
+
+        self.assertTrue(all(request['messages'][0]['content'] == CONFIG['assistant_prompt']
+                            for request in self.chat.requests))
+
+
+class OpenAIHelperTest(SummaryTest, unittest.IsolatedAsyncioTestCase):
+    async def asyncSetUp(self):
+        self.chat = FakeChatCompletion()
+        patcher = mock.patch.object(openai, 'ChatCompletion', self.chat)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        self.helper = OpenAIHelper(dict(SUMMARY_CONFIG))
+
+    async def ask(self, query: str) -> str:
+        return self.helper.get_chat_response(1, 'assistant', query)
+
+
+class AsyncOpenAIHelperTest(SummaryTest, unittest.IsolatedAsyncioTestCase):
+    async def asyncSetUp(self):
+        self.chat = FakeChatCompletion()
+        patcher = mock.patch.object(openai, 'ChatCompletion', self.chat)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        self.helper = AsyncOpenAIHelper(dict(SUMMARY_CONFIG))
+
+    async def asyncTearDown(self):
+        await self.helper.close()
+
+    async def ask(self, query: str) -> str:
+        return await self.helper.get_chat_response(1, 'assistant', query)
+
+
+if __name__ == '__main__':
+    unittest.main()
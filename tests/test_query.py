@@ -0,0 +1,78 @@
+import json
+import unittest
+
+from aiohttp import web
+from aiohttp.test_utils import TestClient, TestServer
+
+from api.web.query import BATCH_PROMPT, DictionApp
+
+
+class FakeHelper:
+    """
+    Answers lookups like the model would, failing every batch or word listed in `broken`.
+    """
+
+    def __init__(self, broken=()):
+        self.broken = set(broken)
+        self.queries = []
+
+    async def get_stateless_response(self, function: str, query: str, **overrides) -> str:
+        if query.startswith(BATCH_PROMPT):
+            words = json.loads(query[len(BATCH_PROMPT):])
+            self.queries.append(words)
+            if self.broken.intersection(words):
+                raise RuntimeError('The server is overloaded')
+            return 'Sure! ' + json.dumps({word: f'meaning of {word}' for word in words})
+        word = query[:-len('是什么意思?')]
+        self.queries.append(word)
+        if word in self.broken:
+            raise RuntimeError('The server is overloaded')
+        return f'meaning of {word}'
+
+
+class WordsTest(unittest.IsolatedAsyncioTestCase):
+    async def asyncSetUp(self):
+        self.helper = FakeHelper(broken={'bad'})
+        # Two words per batch
+        self.diction = DictionApp(self.helper, tokens_per_word=10, max_batch_tokens=25)
+        self.diction.cache.set('cached', 'meaning from the cache')
+        app = web.Application()
+        app.add_routes(self.diction.routes())
+        self.client = TestClient(TestServer(app))
+        await self.client.start_server()
+
+    async def asyncTearDown(self):
+        await self.client.close()
+
+    async def test_answers_cached_packed_and_failed_words(self):
+        with self.assertLogs(level='WARNING'):
+            response = await self.client.get('/words', params={'words': 'Cached,apple,pear,fig,bad'})
+        self.assertEqual(response.status, 200)
+        self.assertEqual(await response.json(), {
+            'cached': 'meaning from the cache',
+            'apple': 'meaning of apple',
+            'pear': 'meaning of pear',
+            'fig': 'meaning of fig',
+            'bad': None,
+        })
+        # The batch of fig and bad failed, so both were looked up again on their own
+        self.assertEqual(sorted(map(str, self.helper.queries)),
+                         sorted(["['apple', 'pear']", "['fig', 'bad']", 'fig', 'bad']))
+        self.assertEqual(self.diction.cache.get('fig'), 'meaning of fig')
+        self.assertIsNone(self.diction.cache.get('bad'))
+
+    async def test_streams_a_line_per_word(self):
+        with self.assertLogs(level='WARNING'):
+            response = await self.client.post('/words?stream=true', json=['cached', 'fig', 'bad'])
+            lines = [json.loads(line) for line in (await response.text()).splitlines()]
+        self.assertEqual(lines[0], {'word': 'cached', 'meaning': 'meaning from the cache'})
+        self.assertEqual(sorted(lines[1:], key=lambda line: line['word']),
+                         [{'word': 'bad', 'meaning': None}, {'word': 'fig', 'meaning': 'meaning of fig'}])
+
+    async def test_rejects_requests_without_words(self):
+        response = await self.client.get('/words')
+        self.assertEqual(response.status, 400)
+
+
+if __name__ == '__main__':
+    unittest.main()
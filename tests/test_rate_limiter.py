@@ -0,0 +1,98 @@
+import asyncio
+import socket
+import time
+import unittest
+
+import openai
+
+from benchmark.fake_openai import FakeOpenAI
+from core.openai_helper import AsyncOpenAIHelper
+from core.rate_limiter import RateLimiter
+from tests import CONFIG
+
+WINDOW = 0.5
+
+
+def free_port() -> int:
+    with socket.socket() as sock:
+        sock.bind(('127.0.0.1', 0))
+        return sock.getsockname()[1]
+
+
+class QuotaTest(unittest.IsolatedAsyncioTestCase):
+    """
+    Sends bursts through AsyncOpenAIHelper to a fake API that answers requests over its quota with a 429.
+    """
+
+    async def start(self, rate_limit: dict, **quota) -> FakeOpenAI:
+        fake = FakeOpenAI(port=free_port(), latency=0.01, tokens_per_second=10000, answer_tokens=5, window=WINDOW,
+                          **quota)
+        await fake.start()
+        self.addAsyncCleanup(fake.stop)
+        api_base = openai.api_base
+        openai.api_base = fake.api_base
+        self.addCleanup(setattr, openai, 'api_base', api_base)
+        self.helper = AsyncOpenAIHelper(dict(CONFIG, max_tokens=50, rate_limit=dict(rate_limit, window=WINDOW, seed=0)))
+        self.addAsyncCleanup(self.helper.close)
+        return fake
+
+    async def burst(self, count: int) -> list:
+        async def query(index: int) -> bool:
+            try:
+                await self.helper.get_stateless_response('assistant', f'question number {index}')
+                return True
+            except openai.error.OpenAIError:
+                return False
+        return await asyncio.gather(*(query(index) for index in range(count)))
+
+    async def test_pacing_avoids_rate_limits(self):
+        fake = await self.start(dict(requests_per_minute=4, tokens_per_minute=1000, base_delay=0.05),
+                                requests_per_minute=4, tokens_per_minute=1000)
+        self.assertEqual(await self.burst(10), [True] * 10)
+        self.assertEqual(fake.rate_limited, 0)
+        self.assertGreater(self.helper.rate_limiter.stats()['delayed'], 0)
+
+    async def test_retries_after_the_time_the_api_asked_for(self):
+        fake = await self.start(dict(base_delay=0.01, max_delay=0.02), requests_per_minute=1)
+        start = time.perf_counter()
+        self.assertEqual(await self.burst(2), [True, True])
+        # A retry sooner than the Retry-After time would have been rate limited again
+        self.assertEqual(fake.rate_limited, 1)
+        self.assertEqual(self.helper.rate_limiter.stats()['retries'], 1)
+        self.assertGreaterEqual(time.perf_counter() - start, WINDOW * 0.9)
+
+
+class RateLimiterTest(unittest.IsolatedAsyncioTestCase):
+    async def test_delays_calls_over_the_token_quota(self):
+        limiter = RateLimiter(tokens_per_minute=100, window=0.2, margin=0)
+        await limiter.acquire(60)
+        self.assertEqual(limiter.delay(40), 0)
+        self.assertGreater(limiter.delay(41), 0.1)
+
+        start = time.perf_counter()
+        await limiter.acquire(60)
+        self.assertGreaterEqual(time.perf_counter() - start, 0.15)
+        self.assertEqual(limiter.stats()['delayed'], 1)
+
+    async def test_raises_once_the_retries_are_used_up(self):
+        limiter = RateLimiter(max_retries=2, base_delay=0.001, seed=0)
+        calls = []
+
+        async def rate_limited():
+            calls.append(time.perf_counter())
+            raise openai.error.RateLimitError('Rate limit reached for requests per minute')
+
+        with self.assertLogs(level='WARNING'), self.assertRaises(openai.error.RateLimitError):
+            await limiter.call(rate_limited)
+        self.assertEqual(len(calls), 3)
+        self.assertEqual(limiter.stats()['failures'], 1)
+
+    def test_backoff_is_reproducible(self):
+        error = openai.error.ServiceUnavailableError('overloaded')
+        delays = [RateLimiter(seed=7).backoff(attempt, error) for attempt in (1, 2, 3)]
+        self.assertEqual(delays, [RateLimiter(seed=7).backoff(attempt, error) for attempt in (1, 2, 3)])
+        self.assertTrue(0.5 <= delays[0] <= 1 and 1 <= delays[1] <= 2 and 2 <= delays[2] <= 4)
+
+
+if __name__ == '__main__':
+    unittest.main()
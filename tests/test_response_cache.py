@@ -0,0 +1,96 @@
+import os
+import tempfile
+import unittest
+from unittest import mock
+
+from core.response_cache import NearDuplicateIndex, ResponseCache, trigrams
+
+
+def request(query: str, prompt: str = 'Polish the text.', model: str = 'gpt-3.5-turbo', temperature: float = 0) -> dict:
+    return {'model': model, 'temperature': temperature, 'max_tokens': 100,
+            'messages': [{'role': 'system', 'content': prompt}, {'role': 'user', 'content': query}]}
+
+
+class Answers:
+    def __init__(self):
+        self.calls = 0
+
+    def __call__(self) -> str:
+        self.calls += 1
+        return f'answer {self.calls}'
+
+
+class ResponseCacheTest(unittest.TestCase):
+    def setUp(self):
+        self.answers = Answers()
+
+    def ask(self, cache: ResponseCache, query: str, **changes) -> str:
+        return cache.get_or_compute('polish', request(query, **changes), self.answers)
+
+    def test_hits_the_same_request_only(self):
+        cache = ResponseCache(functions={'polish'})
+        self.assertEqual(self.ask(cache, 'I has a apple.'), 'answer 1')
+        self.assertEqual(self.ask(cache, '  I has a\napple. '), 'answer 1')
+        self.assertEqual(self.ask(cache, 'I has a apple.', prompt='Translate the text.'), 'answer 2')
+        self.assertEqual(self.ask(cache, 'I has a apple.', model='gpt-4'), 'answer 3')
+        self.assertEqual(cache.stats()['exact_hits'], 1)
+
+    def test_skips_sampled_requests_and_other_functions(self):
+        cache = ResponseCache(functions={'polish'})
+        self.ask(cache, 'I has a apple.', temperature=0.7)
+        self.ask(cache, 'I has a apple.', temperature=0.7)
+        cache.get_or_compute('assistant', request('I has a apple.'), self.answers)
+        self.assertEqual(self.answers.calls, 3)
+        self.assertEqual(cache.stats()['uncacheable'], 3)
+
+        sampled = ResponseCache(functions={'polish'}, cache_sampled=True)
+        self.ask(sampled, 'I has a apple.', temperature=0.7)
+        self.assertEqual(self.ask(sampled, 'I has a apple.', temperature=0.7), 'answer 4')
+
+    def test_matches_near_duplicates_from_the_similarity_threshold(self):
+        cached, near = 'I has a apple and two banana.', 'I has a apple and two bananas.'
+        index = NearDuplicateIndex()
+        index.add('cached', 'scope', cached)
+        score = sum(weight * index._vectors['cached'][1].get(gram, 0)
+                    for gram, weight in index._unit(trigrams(near)).items())
+        self.assertLess(score, 1)
+
+        cache = ResponseCache(functions={'polish'}, similarity=score)
+        self.ask(cache, cached)
+        self.assertEqual(self.ask(cache, near), 'answer 1')
+        self.assertEqual(self.ask(cache, near, prompt='Translate the text.'), 'answer 2')
+        self.assertEqual(cache.stats()['near_hits'], 1)
+
+        strict = ResponseCache(functions={'polish'}, similarity=score + 1e-6)
+        self.ask(strict, cached)
+        self.assertEqual(self.ask(strict, near), 'answer 4')
+
+    def test_saves_and_loads_its_answers(self):
+        with tempfile.TemporaryDirectory() as directory:
+            path = os.path.join(directory, 'responses.json')
+            with mock.patch('atexit.register'):
+                cache = ResponseCache(path=path, functions={'polish'}, similarity=0.9)
+                self.ask(cache, 'I has a apple and two banana for the lunch of tomorrow.')
+                cache.save()
+
+                loaded = ResponseCache(path=path, functions={'polish'}, similarity=0.9)
+            self.assertEqual(self.ask(loaded, 'I has a apple and two banana for the lunch of tomorrow.'), 'answer 1')
+            self.assertEqual(self.ask(loaded, 'I has a apple and two banana for the lunch of tomorrow!'), 'answer 1')
+            self.assertEqual(self.answers.calls, 1)
+            self.assertFalse(os.path.exists(f'{path}.tmp'))
+
+    def test_sweeps_expired_queries_from_the_index(self):
+        cache = ResponseCache(max_size=2, ttl=10, functions={'polish'}, similarity=0.9)
+        with mock.patch('time.monotonic', return_value=100.0):
+            for query in ('one', 'two', 'three', 'four'):
+                self.ask(cache, f'query number {query}')
+        self.assertEqual(len(cache._index), 4)
+
+        with mock.patch('time.monotonic', return_value=200.0):
+            self.ask(cache, 'query number five')
+            self.assertEqual(len(cache._index), 1)
+            self.assertEqual(self.ask(cache, 'query number four'), 'answer 6')
+
+
+if __name__ == '__main__':
+    unittest.main()
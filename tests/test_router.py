@@ -0,0 +1,106 @@
+import unittest
+from unittest import mock
+
+import openai
+from openai.openai_object import OpenAIObject
+
+from core.openai_helper import AsyncOpenAIHelper
+from core.router import Route, Router
+from tests import CONFIG
+
+ROUTED_CONFIG = dict(CONFIG, show_usage=False, fallback_models=['gpt-4'], routes=[
+    {'name': 'polish', 'functions': ['polish'], 'model': 'gpt-4', 'max_tokens': 400},
+    {'name': 'long', 'min_input_tokens': 100, 'model': 'gpt-4-32k', 'fallbacks': ['gpt-4']},
+    {'name': 'short', 'max_input_tokens': 10, 'temperature': 0},
+])
+
+
+class FakeChatCompletion:
+    """
+    Answers every model but the failing ones.
+    """
+
+    def __init__(self, failing=()):
+        self.failing = set(failing)
+        self.models = []
+
+    async def acreate(self, **request):
+        self.models.append(request['model'])
+        if request['model'] in self.failing:
+            raise openai.error.APIError('The server had an error while processing your request')
+        return OpenAIObject.construct_from({
+            'model': request['model'],
+            'choices': [{'index': 0, 'finish_reason': 'stop', 'message': {'role': 'assistant', 'content': 'an answer'}}],
+            'usage': {'prompt_tokens': 1000, 'completion_tokens': 500, 'total_tokens': 1500},
+        })
+
+
+class RouterTest(unittest.TestCase):
+    def setUp(self):
+        self.router = Router.from_config(ROUTED_CONFIG)
+
+    def test_takes_the_first_matching_route(self):
+        self.assertEqual(self.router.route('polish', 200).name, 'polish')
+        self.assertEqual(self.router.route('assistant', 200).name, 'long')
+        self.assertEqual(self.router.route('assistant', 5).name, 'short')
+        self.assertEqual(self.router.route('assistant', 50).name, 'default')
+
+    def test_routes_inherit_the_default_settings(self):
+        polish, long, short = self.router.routes
+        self.assertEqual((polish.model, polish.max_tokens, polish.temperature), ('gpt-4', 400, CONFIG['temperature']))
+        self.assertEqual((short.model, short.temperature), (CONFIG['model'], 0))
+        self.assertEqual(long.models, ['gpt-4-32k', 'gpt-4'])
+        self.assertEqual(self.router.default.models, [CONFIG['model'], 'gpt-4'])
+
+    def test_matches_history_bounds(self):
+        route = Route('chat', 'gpt-4', 100, 1, min_history_tokens=10, max_history_tokens=20)
+        self.assertFalse(route.matches('assistant', 1, 9))
+        self.assertTrue(route.matches('assistant', 1, 20))
+        self.assertFalse(route.matches('assistant', 1, 21))
+
+    def test_prices_versioned_models_by_prefix(self):
+        self.assertAlmostEqual(self.router.cost('gpt-4-0314', 1000, 500), 0.06)
+        self.assertAlmostEqual(self.router.cost('gpt-4-32k-0314', 1000, 500), 0.12)
+        self.assertEqual(self.router.cost('davinci', 1000, 500), 0.0)
+
+    def test_accounts_for_answers_and_cancelled_streams(self):
+        route = self.router.route('polish', 200)
+        self.router.start(route).finish('gpt-4', 500, 1000)
+        call = self.router.start(route)
+        call.prompt_tokens = 1000
+        call.cancel('gpt-4', 0)
+        stats = self.router.stats()['polish']
+        self.assertEqual((stats['requests'], stats['cancelled']), (1, 1))
+        self.assertAlmostEqual(stats['cost_usd'], 0.09)
+
+
+class FallbackTest(unittest.IsolatedAsyncioTestCase):
+    async def ask(self, failing) -> FakeChatCompletion:
+        chat = FakeChatCompletion(failing)
+        with mock.patch.object(openai, 'ChatCompletion', chat):
+            helper = AsyncOpenAIHelper(dict(ROUTED_CONFIG))
+            try:
+                self.answer = await helper.get_chat_response(1, 'assistant', 'Hello there, how are you doing?')
+            finally:
+                await helper.close()
+        self.stats = helper.router.stats()['default']
+        return chat
+
+    async def test_falls_back_to_the_next_model(self):
+        with self.assertLogs(level='WARNING'):
+            chat = await self.ask({CONFIG['model']})
+        self.assertEqual(chat.models, [CONFIG['model'], 'gpt-4'])
+        self.assertEqual(self.answer, 'an answer')
+        self.assertEqual((self.stats['requests'], self.stats['fallbacks'], self.stats['errors']), (1, 1, 0))
+        self.assertAlmostEqual(self.stats['cost_usd'], 0.06)
+
+    async def test_reports_the_error_of_the_last_model(self):
+        with self.assertLogs(level='WARNING'):
+            chat = await self.ask({CONFIG['model'], 'gpt-4'})
+        self.assertEqual(chat.models, [CONFIG['model'], 'gpt-4'])
+        self.assertIn('server had an error', self.answer)
+        self.assertEqual((self.stats['fallbacks'], self.stats['errors']), (1, 1))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,96 @@
+import asyncio
+import unittest
+
+from core.scheduler import ChatScheduler
+
+
+class Jobs:
+    """
+    Job functions that record the order they ran in and wait until they are released.
+    """
+
+    def __init__(self):
+        self.started = []
+        self.finished = []
+        self.releases = {}
+
+    def job(self, name: str):
+        async def run(items):
+            self.started.append((name, items))
+            await self.releases.setdefault(name, asyncio.Event()).wait()
+            self.finished.append(name)
+            return name, items
+        return run
+
+    def release(self, name: str):
+        self.releases.setdefault(name, asyncio.Event()).set()
+
+
+class ChatSchedulerTest(unittest.IsolatedAsyncioTestCase):
+    async def asyncSetUp(self):
+        self.jobs = Jobs()
+
+    async def test_runs_the_jobs_of_a_chat_in_order(self):
+        scheduler = ChatScheduler()
+        first = asyncio.ensure_future(scheduler.submit(1, self.jobs.job('first'), 'a'))
+        second = asyncio.ensure_future(scheduler.submit(1, self.jobs.job('second'), 'b'))
+        await asyncio.sleep(0.01)
+        self.assertEqual(self.jobs.started, [('first', ['a'])])
+        self.assertEqual(scheduler.queue_depth(1), 1)
+
+        self.jobs.release('second')
+        self.jobs.release('first')
+        self.assertEqual(await first, ('first', ['a']))
+        self.assertEqual(await second, ('second', ['b']))
+        self.assertEqual(self.jobs.finished, ['first', 'second'])
+
+    async def test_chats_take_turns(self):
+        scheduler = ChatScheduler(max_in_flight=1)
+        busy = [asyncio.ensure_future(scheduler.submit(1, self.jobs.job(f'busy{index}'), index)) for index in range(3)]
+        quiet = asyncio.ensure_future(scheduler.submit(2, self.jobs.job('quiet'), 'q'))
+        for name in ('busy0', 'busy1', 'busy2', 'quiet'):
+            self.jobs.release(name)
+        await asyncio.gather(quiet, *busy)
+        self.assertEqual(self.jobs.finished, ['busy0', 'quiet', 'busy1', 'busy2'])
+
+    async def test_merges_queued_mergeable_jobs(self):
+        scheduler = ChatScheduler()
+        run = self.jobs.job('reply')
+        running = asyncio.ensure_future(scheduler.submit(1, run, 'a', mergeable=True))
+        await asyncio.sleep(0.01)
+        merged = [asyncio.ensure_future(scheduler.submit(1, run, item, mergeable=True)) for item in 'bc']
+        await asyncio.sleep(0.01)
+        self.jobs.release('reply')
+        self.assertEqual(await running, ('reply', ['a']))
+        self.assertEqual(await asyncio.gather(*merged), [('reply', ['b', 'c'])] * 2)
+        self.assertEqual(scheduler.merged, 1)
+
+    async def test_cancel_stops_the_running_job_only(self):
+        scheduler = ChatScheduler()
+        running = asyncio.ensure_future(scheduler.submit(1, self.jobs.job('long'), 'a'))
+        queued = asyncio.ensure_future(scheduler.submit(1, self.jobs.job('next'), 'b'))
+        await asyncio.sleep(0.01)
+
+        self.assertTrue(await scheduler.cancel(1))
+        self.assertIsNone(await running)
+        self.assertNotIn('long', self.jobs.finished)
+
+        self.jobs.release('next')
+        self.assertEqual(await queued, ('next', ['b']))
+        self.assertEqual(scheduler.stats()['cancelled'], 1)
+        self.assertFalse(await scheduler.cancel(1))
+
+    async def test_raises_the_error_of_a_job(self):
+        scheduler = ChatScheduler()
+
+        async def fail(items):
+            raise ValueError(items)
+
+        with self.assertRaises(ValueError):
+            await scheduler.submit(1, fail, 'a')
+        self.jobs.release('after')
+        self.assertEqual(await scheduler.submit(1, self.jobs.job('after'), 'b'), ('after', ['b']))
+
+
+if __name__ == '__main__':
+    unittest.main()
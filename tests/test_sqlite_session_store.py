@@ -0,0 +1,104 @@
+import os
+import tempfile
+import unittest
+
+from core.sqlite_session_store import SqliteSessionStore
+
+PROMPT = 'You are a helpful assistant.'
+
+
+class SqliteSessionStoreTest(unittest.IsolatedAsyncioTestCase):
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        self.path = os.path.join(self.directory.name, 'sessions.sqlite3')
+        self.stores = []
+
+    def tearDown(self):
+        for store in self.stores:
+            store.close()
+        self.directory.cleanup()
+
+    def store(self, **kwargs) -> SqliteSessionStore:
+        store = SqliteSessionStore(self.path, PROMPT, flush_interval=0.01, **kwargs)
+        self.stores.append(store)
+        return store
+
+    def reopen(self, store: SqliteSessionStore) -> SqliteSessionStore:
+        store.close()
+        return self.store()
+
+    def test_round_trip(self):
+        store = self.store()
+        history = store[1]['assistant']
+        history.append('user', 'hello')
+        history.append('assistant', 'hi there')
+        store[2]['translate'].append('user', 'bonjour')
+
+        store = self.reopen(store)
+        self.assertEqual(store[1]['assistant'].messages[1:],
+                         [{'role': 'user', 'content': 'hello'}, {'role': 'assistant', 'content': 'hi there'}])
+        self.assertEqual(len(store[1]['translate']), 1)
+        self.assertEqual(store[2]['translate'].messages[1:], [{'role': 'user', 'content': 'bonjour'}])
+
+    def test_loads_the_newest_messages_within_the_budget(self):
+        store = self.store()
+        history = store[1]['assistant']
+        for index in range(10):
+            history.append('user', f'message {index}')
+        budget = sum(message.tokens for message in history[-3:])
+
+        store.close()
+        store = self.store(budget=budget)
+        self.assertEqual([message['content'] for message in store[1]['assistant'].messages[1:]],
+                         ['message 7', 'message 8', 'message 9'])
+
+    def test_persists_summaries(self):
+        store = self.store()
+        history = store[1]['assistant']
+        for index in range(6):
+            history.append('user' if index % 2 == 0 else 'assistant', f'turn {index}')
+        history.replace_with_summary(4, 'the first four turns')
+        history.append('user', 'turn 6')
+
+        store = self.reopen(store)
+        self.assertEqual(store[1]['assistant'].messages[1:], [
+            {'role': 'system', 'content': 'Summary of the earlier conversation: the first four turns'},
+            {'role': 'user', 'content': 'turn 4'},
+            {'role': 'assistant', 'content': 'turn 5'},
+            {'role': 'user', 'content': 'turn 6'},
+        ])
+
+    def test_reset_deletes_the_chat(self):
+        store = self.store()
+        store[1]['assistant'].append('user', 'hello')
+        store.reset(1)
+
+        store = self.reopen(store)
+        self.assertEqual(len(store[1]['assistant']), 1)
+
+    async def test_aload_reads_ahead_of_new_history(self):
+        store = self.store()
+        store[1]['assistant'].append('user', 'hello')
+        store = self.reopen(store)
+
+        await store.aload(1, 'assistant')
+        self.assertIn((1, 'assistant'), store._loaded)
+        self.assertEqual(store[1]['assistant'].messages[1:], [{'role': 'user', 'content': 'hello'}])
+        self.assertEqual(store._loaded, {})
+
+        # A history in memory is not read again
+        await store.aload(1, 'assistant')
+        self.assertEqual(store._loaded, {})
+
+    async def test_aload_sees_the_queued_writes_of_an_evicted_chat(self):
+        store = self.store(max_sessions=1)
+        store[1]['assistant'].append('user', 'hello')
+        store[2]['assistant']
+        self.assertNotIn(1, store)
+
+        await store.aload(1, 'assistant')
+        self.assertEqual(store[1]['assistant'].messages[1:], [{'role': 'user', 'content': 'hello'}])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,82 @@
+import os
+import unittest
+from types import SimpleNamespace
+from unittest import mock
+
+from core.openai_helper import AsyncOpenAIHelper
+
+from api.telegram.telegram_bot import TelegramBotApp
+from tests import CONFIG
+
+ALLOWED_CHAT_ID = 1
+OTHER_CHAT_ID = 2
+
+
+class FakeClient:
+    def __init__(self):
+        self.handlers = []
+
+    def on(self, event):
+        def register(handler):
+            self.handlers.append((event, handler))
+            return handler
+        return register
+
+
+class FakeDispatcher:
+    def __init__(self, accept: bool = True):
+        self.accept = accept
+        self.updates = []
+
+    def dispatch(self, update) -> bool:
+        if self.accept:
+            self.updates.append(update)
+        return self.accept
+
+
+class FakeEvent:
+    def __init__(self, chat_id: int, text: str):
+        self.chat_id = chat_id
+        self.message = SimpleNamespace(id=10, text=text, voice=None, audio=None)
+        self.replies = []
+
+    async def reply(self, text, **kwargs):
+        self.replies.append(text)
+
+
+class ForwardTest(unittest.IsolatedAsyncioTestCase):
+    async def asyncSetUp(self):
+        self.helper = AsyncOpenAIHelper(CONFIG)
+
+    async def asyncTearDown(self):
+        await self.helper.close()
+
+    def bot(self, dispatcher: FakeDispatcher) -> TelegramBotApp:
+        config = {'allowed_user_ids': str(ALLOWED_CHAT_ID), 'allowed_user_ids_variable': 'ALLOWED_TELEGRAM_USER_IDS'}
+        return TelegramBotApp(config, self.helper, client=FakeClient(), dispatcher=dispatcher)
+
+    async def test_forwards_allowed_chats(self):
+        dispatcher = FakeDispatcher()
+        await self.bot(dispatcher)._forward('prompt')(FakeEvent(ALLOWED_CHAT_ID, 'hello'))
+        [update] = dispatcher.updates
+        self.assertEqual((update.handler, update.chat_id, update.text), ('prompt', ALLOWED_CHAT_ID, 'hello'))
+
+    async def test_refuses_chats_missing_from_the_reloaded_allow_list(self):
+        dispatcher = FakeDispatcher()
+        bot = self.bot(dispatcher)
+        with mock.patch.dict(os.environ, {'ALLOWED_TELEGRAM_USER_IDS': str(OTHER_CHAT_ID)}):
+            bot.allowed.reload()
+        event = FakeEvent(ALLOWED_CHAT_ID, 'hello')
+        await bot._forward('prompt')(event)
+        self.assertEqual(dispatcher.updates, [])
+        self.assertEqual(event.replies, [bot.disallowed_message])
+
+    async def test_tells_the_chat_when_its_worker_is_full(self):
+        bot = self.bot(FakeDispatcher(accept=False))
+        event = FakeEvent(ALLOWED_CHAT_ID, 'hello')
+        await bot._forward('prompt')(event)
+        self.assertEqual(event.replies, [bot.busy_message])
+
+
+if __name__ == '__main__':
+    unittest.main()
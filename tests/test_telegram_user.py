@@ -0,0 +1,79 @@
+import unittest
+from types import SimpleNamespace
+
+from api.telegram.telegram_user import TelegramUserApp
+
+BOT_ID = 1000
+OWNER_ID = 2000
+OTHER_CHAT_ID = 3000
+
+
+class FakeOpenAI:
+    async def get_stateless_response(self, function: str, query: str, **kwargs) -> str:
+        return 'polished'
+
+
+class FakeUserClient:
+    def __init__(self, messages=()):
+        self.handlers = []
+        self.edits = []
+        self.messages = list(messages)
+
+    def on(self, event):
+        def register(handler):
+            self.handlers.append((event, handler))
+            return handler
+        return register
+
+    async def get_input_entity(self, peer):
+        return peer
+
+    async def iter_messages(self, entity, limit: int = 10):
+        for message in reversed(self.messages[-limit:]):
+            yield message
+
+    async def edit_message(self, entity, message, text=None):
+        self.edits.append((entity, getattr(message, 'id', message), text))
+
+
+def event(chat_id: int, message_id: int, text: str, sender_id: int = OWNER_ID):
+    return SimpleNamespace(chat_id=chat_id, sender_id=sender_id, message=SimpleNamespace(id=message_id, text=text))
+
+
+class PolishTest(unittest.IsolatedAsyncioTestCase):
+    def app(self, client: FakeUserClient) -> TelegramUserApp:
+        return TelegramUserApp({'token': f'{BOT_ID}:secret'}, FakeOpenAI(), client=client, owner_id=OWNER_ID)
+
+    def test_listens_to_the_bot_chat_only(self):
+        client = FakeUserClient()
+        self.app(client)
+        [(new_message, _)] = client.handlers
+        self.assertTrue(new_message.outgoing)
+        self.assertEqual(new_message.chats, BOT_ID)
+
+    async def test_edits_the_message_sent_to_the_bot(self):
+        client = FakeUserClient()
+        app = self.app(client)
+        await app._remember_sent(event(BOT_ID, 7, 'ok'))
+        await app._remember_sent(event(OTHER_CHAT_ID, 8, 'ok'))
+
+        await app._polish(event(OWNER_ID, 70, 'ok'))
+        self.assertEqual(client.edits, [(BOT_ID, 7, 'ok\n----\n**`polished`**')])
+
+    async def test_searches_the_bot_chat_for_unknown_messages(self):
+        client = FakeUserClient([SimpleNamespace(id=5, text='thanks', out=True),
+                                 SimpleNamespace(id=6, text='thanks', out=False)])
+        app = self.app(client)
+        await app._polish(event(OWNER_ID, 60, 'thanks'))
+        self.assertEqual(client.edits, [(BOT_ID, 5, 'thanks\n----\n**`polished`**')])
+
+    def test_polishes_only_the_messages_of_the_owner(self):
+        app = self.app(FakeUserClient())
+        self.assertTrue(app._check_allow_polish(event(OWNER_ID, 1, 'hello')))
+        self.assertFalse(app._check_allow_polish(event(OWNER_ID + 1, 1, 'hello', sender_id=OWNER_ID + 1)))
+        app.owner_id = None
+        self.assertFalse(app._check_allow_polish(event(OWNER_ID, 1, 'hello')))
+
+
+if __name__ == '__main__':
+    unittest.main()
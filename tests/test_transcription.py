@@ -0,0 +1,68 @@
+import io
+import math
+import struct
+import unittest
+import wave
+
+from core.transcription import TranscriptionPipeline
+
+
+def tone(seconds: int, rate: int = 8000) -> bytes:
+    """
+    Returns a WAV file of a tone that pauses for a quarter second every second.
+    """
+    samples = (int(8000 * math.sin(2 * math.pi * 440 * i / rate)) if i % rate < rate * 3 // 4 else 0
+               for i in range(seconds * rate))
+    output = io.BytesIO()
+    with wave.open(output, 'wb') as file:
+        file.setnchannels(1)
+        file.setsampwidth(2)
+        file.setframerate(rate)
+        file.writeframes(b''.join(struct.pack('<h', sample) for sample in samples))
+    return output.getvalue()
+
+
+class FakeOpenAI:
+    def __init__(self):
+        self.uploads = []
+
+    async def transcribe(self, audio) -> str:
+        self.uploads.append((audio.name, len(audio.getvalue())))
+        return f'part{len(self.uploads)}'
+
+
+class TranscriptionPipelineTest(unittest.IsolatedAsyncioTestCase):
+    async def asyncSetUp(self):
+        self.openai = FakeOpenAI()
+        self.pipeline = TranscriptionPipeline(self.openai, chunk_seconds=2, chunk_format='wav',
+                                              max_upload_bytes=64 * 1024)
+
+    async def asyncTearDown(self):
+        self.pipeline.close()
+
+    async def test_passes_small_files_through(self):
+        data = tone(2)
+        self.assertEqual(await self.pipeline.transcribe(data, 'voice.wav'), 'part1')
+        self.assertEqual(self.openai.uploads, [('audio.wav', len(data))])
+        self.assertIsNone(self.pipeline._executor)
+
+    async def test_splits_files_over_the_upload_limit(self):
+        data = tone(6)
+        self.assertGreater(len(data), self.pipeline.max_upload_bytes)
+        transcript = await self.pipeline.transcribe(data, 'voice.wav')
+
+        self.assertGreater(len(self.openai.uploads), 1)
+        self.assertTrue(all(size <= self.pipeline.max_upload_bytes for _, size in self.openai.uploads))
+        self.assertEqual(transcript, ' '.join(f'part{i + 1}' for i in range(len(self.openai.uploads))))
+
+    async def test_progressive_splits_files_over_the_upload_limit(self):
+        self.pipeline.chunk_threshold = 1024 * 1024
+        transcripts = [transcript async for transcript in self.pipeline.transcribe_progressive(tone(6), 'voice.wav')]
+        self.assertGreater(len(transcripts), 1)
+
+    def test_spawns_the_pool_and_close_stops_it(self):
+        pool = self.pipeline._pool()
+        self.assertEqual(pool._mp_context.get_start_method(), 'spawn')
+        self.pipeline.close()
+        self.assertIsNone(self.pipeline._executor)
+        self.assertTrue(pool._shutdown_thread)
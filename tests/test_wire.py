@@ -0,0 +1,39 @@
+import json
+import unittest
+from unittest import mock
+
+from openai import api_requestor
+
+from core import wire
+from core.history import ConversationHistory
+
+
+class WireTest(unittest.TestCase):
+    def setUp(self):
+        # Start from the stock requestor, which other tests may have replaced
+        self.addCleanup(setattr, api_requestor, 'APIRequestor', api_requestor.APIRequestor)
+        api_requestor.APIRequestor = wire.EncodedRequestor.__bases__[0]
+
+    def test_encodes_the_same_request_as_json(self):
+        history = ConversationHistory('You are a helpful assistant.')
+        history.append('user', 'Say "hello" in Ελληνικά\n')
+        history.append('assistant', 'Γεια σου')
+        history.prepare()
+        history.append('user', 'thanks')
+        params = dict(model='gpt-3.5-turbo', messages=history.encoded_messages(), temperature=0, stream=True)
+        self.assertEqual(json.loads(wire.encode_request(params)), dict(params, messages=history.messages))
+
+    def test_installs_on_the_supported_version(self):
+        self.assertTrue(wire.install())
+        self.assertIs(api_requestor.APIRequestor, wire.EncodedRequestor)
+        self.assertTrue(wire.install())
+
+    def test_keeps_the_stock_requestor_on_other_versions(self):
+        stock = api_requestor.APIRequestor
+        with mock.patch.object(wire.version, 'VERSION', '0.28.0'), self.assertLogs(level='WARNING'):
+            self.assertFalse(wire.install())
+        self.assertIs(api_requestor.APIRequestor, stock)
+
+
+if __name__ == '__main__':
+    unittest.main()